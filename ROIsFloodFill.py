@@ -13,6 +13,11 @@ import matplotlib.pyplot as plt
 
 sys.path.append(f'{os.path.expanduser("~")}/david/masterScripts/fMRI')
 from makeFloodFillMasks import makeFloodFillMasks
+try:
+    from .roi_stats import load_rois, roi_stats
+except ImportError:  # run as a script
+    sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+    from utils.roi_stats import load_rois, roi_stats
 
 def ROIsFloodFill(experiment, regions, sizes, Zthr, overwrite):
 
@@ -76,14 +81,19 @@ def ROIsFloodFill(experiment, regions, sizes, Zthr, overwrite):
                     if not op.isfile(actMap) or overwrite:
                         os.system(f'mri_vol2vol --lta {regFile} --mov {actMapOrig} --targ {refFunc} --o {actMap} --trilinear')
 
+                # location of peak activation in each region, from one read
+                # of the activation map
+                masksFuncCortex = {region: f'{regDir}/masks/{region}_cortex.nii.gz'
+                                   for region in regions}  # created by ROIsTransformVols.py
+                peaks = roi_stats(actMap, load_rois(masksFuncCortex))[
+                    ['peak_x', 'peak_y', 'peak_z']]
+
                 # floodfill masks
                 for region in regions:
 
-                    maskFuncCortex = f'{regDir}/masks/{region}_cortex.nii.gz' # created by ROIsTransformVols.py
-
-                    # get location of peak activation
-                    coords = os.popen(f'fslstats {actMap} -k {maskFuncCortex} -x')
-                    coords = coords.read()[:-2]
+                    maskFuncCortex = masksFuncCortex[region]
+                    peak = peaks.loc[region].tolist()
+                    coords = ' '.join(str(c) for c in peak)
 
                     print(f'{datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")} | Making FloodFilled ROIs | '
                           f'Subject: {subject} | Session: {session} | RegType: {regType} | Region: {region} |')
@@ -93,9 +103,9 @@ def ROIsFloodFill(experiment, regions, sizes, Zthr, overwrite):
                                                           'session': [session] * len(sizes),
                                                           'region': [region] * len(sizes),
                                                           'regType': [regType] * len(sizes),
-                                                          'peakX': [coords[0]] * len(sizes),
-                                                          'peakY': [coords[1]] * len(sizes),
-                                                          'peakZ': [coords[2]] * len(sizes),
+                                                          'peakX': [peak[0]] * len(sizes),
+                                                          'peakY': [peak[1]] * len(sizes),
+                                                          'peakZ': [peak[2]] * len(sizes),
                                                           'volTarget': [sizes],
                                                           'volAttained': [actualVols],
                                                           'nVoxFinal': [actualNvoxs],
@@ -7,6 +7,11 @@ import os.path as op
 import glob
 import datetime
 import pandas as pd
+try:
+    from .roi_stats import load_map, load_rois, roi_stats
+except ImportError:  # run as a script
+    sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+    from utils.roi_stats import load_map, load_rois, roi_stats
 
 def ROIsT1HighResToFunc(experiment, plotRegions, overwrite):
 
@@ -53,20 +58,27 @@ def ROIsT1HighResToFunc(experiment, plotRegions, overwrite):
                 if not os.path.isfile(actMap) or overwrite:
                     os.system(f'mri_vol2vol --lta {regFile} --mov {actMapOrig} --targ {refFunc} --o {actMap} --trilin')
 
+                # ranges of the underlays and peak activation in each
+                # region, reading each image once
+                Zthr = 3.1
+                actData = load_map(actMap)
+                maxAct = float(actData.max())
+                maxBrain = float(load_map(refFunc).max())
+                peaks = roi_stats(actData, load_rois({
+                    region: f'{regDir}/masks/{region}_cortex_thr{Zthr}.nii.gz'
+                    for region in plotRegions}))
+
                 for region in plotRegions:
                     # make plot using FSLeyes
-                    Zthr = 3.1
                     plotDir = f"{maskDirFunc}/plots"
                     os.makedirs(plotDir, exist_ok=True)
                     plotFile = f'{plotDir}/{region}.pdf'
                     cortex = f'{regDir}/masks/cortex.nii.gz'
-                    cortexRegLoc = f'{regDir}/masks/{region}_cortex_thr{Zthr}.nii.gz'
                     superficial = f'{regDir}/masks/{region}_cortex_superficial_thr{Zthr}.nii.gz'
                     middle = f'{regDir}/masks/{region}_cortex_middle_thr{Zthr}.nii.gz'
                     deep = f'{regDir}/masks/{region}_cortex_deep_thr{Zthr}.nii.gz'
-                    maxAct = float(os.popen(f'fslstats {actMap} -R').read().split()[1])
-                    maxBrain = float(os.popen(f'fslstats {refFunc} -R').read().split()[1])
-                    coords = os.popen(f'fslstats {actMap} -k {cortexRegLoc} -x').read()[:-2]
+                    coords = ' '.join(str(peaks.loc[region, f'peak_{axis}'])
+                                      for axis in 'xyz')
                     fsleyesCommand = f'fsleyes render --outfile {plotFile} --size 1600 600 --scene ortho ' \
                                      f'-vl {coords} -xz 2500 -yz 2500 -zz 2500 ' \
                                      f'{refFunc} -dr 0 {maxBrain} -cm greyscale ' \
@@ -0,0 +1,197 @@
+"""
+on-disk index of a dataset's directory tree, in place of repeated globbing
+
+Directory listings are kept in an SQLite database (index_path()) with each
+directory's mtime. A lookup stats only the directories it touches and lists a
+directory again only if its mtime has changed (i.e. entries were added,
+removed or renamed), so on a network file system a lookup costs a few stats
+rather than a directory scan per pattern. A listing made within RACY_SECONDS
+of the directory's mtime is not trusted and is redone on the next lookup, as
+a change in the same clock tick would leave the mtime unchanged.
+
+glob() is a drop-in replacement for glob.glob (including ** with
+recursive=True), and query() finds files by their BIDS entities, e.g.
+
+    query('sub-M001/ses-1/func', task='restingState', part='mag',
+          suffix='bold', extension='.nii')
+
+The database is on local disk, one per dataset root, as SQLite's locking (and
+its WAL journal, which lets pool workers read while another writes) is not
+reliable on network file systems. It is only a cache, so losing it costs
+one relisting of each directory.
+"""
+
+import os
+import os.path as op
+import time
+import hashlib
+import tempfile
+import sqlite3
+import fnmatch
+import threading
+
+INDEX_DIR = op.join(tempfile.gettempdir(), f'bids_index-{os.getuid()}')
+RACY_SECONDS = 2
+_local = threading.local()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime INTEGER);
+CREATE TABLE IF NOT EXISTS entries (dir TEXT, name TEXT, is_dir INTEGER,
+                                    PRIMARY KEY (dir, name));
+CREATE TABLE IF NOT EXISTS entities (dir TEXT, name TEXT, key TEXT,
+                                     value TEXT);
+CREATE INDEX IF NOT EXISTS entities_lookup ON entities (dir, key, value);
+'''
+
+
+def index_path(root='.'):
+
+    """ local database of the dataset at root """
+
+    key = hashlib.sha1(op.abspath(root).encode()).hexdigest()[:16]
+    return f'{INDEX_DIR}/{op.basename(op.abspath(root))}-{key}.sqlite'
+
+
+def _db():
+
+    """ connection for this thread and process """
+
+    if getattr(_local, 'pid', None) != os.getpid():
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        db = sqlite3.connect(index_path(), timeout=60)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(SCHEMA)
+        _local.db, _local.pid = db, os.getpid()
+    return _local.db
+
+
+def parse_entities(name):
+
+    """
+    BIDS entities of a file name, with its suffix and extension, e.g.
+    sub-M001_ses-1_T1w.nii.gz gives sub M001, ses 1, suffix T1w and
+    extension .nii.gz
+    """
+
+    stem, dot, extension = name.partition('.')
+    entities = {'extension': dot + extension} if dot else {}
+    for part in stem.split('_'):
+        key, dash, value = part.partition('-')
+        if dash:
+            entities[key] = value
+        else:
+            entities['suffix'] = part
+    return entities
+
+
+def refresh(directory):
+
+    """
+    relists directory if it has changed since it was indexed. Returns False
+    if it does not exist.
+    """
+
+    directory = op.normpath(directory)
+    db = _db()
+    if not op.isdir(directory):
+        with db:
+            db.execute('DELETE FROM dirs WHERE path = ?', (directory,))
+            db.execute('DELETE FROM entries WHERE dir = ?', (directory,))
+            db.execute('DELETE FROM entities WHERE dir = ?', (directory,))
+        return False
+    mtime = os.stat(directory).st_mtime_ns
+    row = db.execute('SELECT mtime FROM dirs WHERE path = ?',
+                     (directory,)).fetchone()
+    if row and row[0] == mtime:
+        return True
+    entries = [(entry.name, entry.is_dir()) for entry in os.scandir(directory)]
+    racy = time.time_ns() - mtime < RACY_SECONDS * 1e9
+    with db:
+        db.execute('DELETE FROM entries WHERE dir = ?', (directory,))
+        db.execute('DELETE FROM entities WHERE dir = ?', (directory,))
+        db.executemany('INSERT INTO entries VALUES (?, ?, ?)', [
+            (directory, name, is_dir) for name, is_dir in entries])
+        db.executemany('INSERT INTO entities VALUES (?, ?, ?, ?)', [
+            (directory, name, key, value) for name, is_dir in entries
+            if not is_dir for key, value in parse_entities(name).items()])
+        db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                   (directory, None if racy else mtime))
+    return True
+
+
+def _list(directory):
+
+    """ (name, is_dir) of each entry of directory """
+
+    if not refresh(directory or '.'):
+        return []
+    return _db().execute('SELECT name, is_dir FROM entries WHERE dir = ?',
+                         (op.normpath(directory or '.'),)).fetchall()
+
+
+def _join(head, name):
+    return op.join(head, name) if head else name
+
+
+def _descendants(head, files):
+
+    """ head's non-hidden subdirectories (and files) at any depth """
+
+    paths = []
+    for name, is_dir in _list(head):
+        if name.startswith('.'):
+            continue
+        if is_dir:
+            paths.append(_join(head, name))
+            paths += _descendants(_join(head, name), files)
+        elif files:
+            paths.append(_join(head, name))
+    return paths
+
+
+def glob(pattern, recursive=False):
+
+    """ as glob.glob(pattern, recursive), answered from the index """
+
+    parts = pattern.split('/')
+    heads = ['/'] if pattern.startswith('/') else ['']
+    parts = [part for part in parts if part]
+    for p, part in enumerate(parts):
+        last = p == len(parts) - 1
+        matches = []
+        for head in heads:
+            if recursive and part == '**':
+                matches += ([head] if not last else []) + \
+                    _descendants(head, files=last)
+            elif not any(c in part for c in '*?['):
+                if not last:
+                    matches.append(_join(head, part))
+                elif part in {name for name, _ in _list(head)}:
+                    matches.append(_join(head, part))
+            else:
+                matches += [_join(head, name) for name, is_dir in _list(head)
+                            if (is_dir or last) and
+                            fnmatch.fnmatchcase(name, part) and
+                            (part.startswith('.') or not name.startswith('.'))]
+        heads = list(dict.fromkeys(matches))
+    return sorted(heads) if parts else []
+
+
+def query(directory, **entities):
+
+    """
+    paths of the files in directory with the given BIDS entities, which may
+    include suffix and extension
+    """
+
+    directory = op.normpath(directory)
+    if not refresh(directory):
+        return []
+    sql = 'SELECT name FROM entries WHERE dir = ? AND NOT is_dir'
+    args = [directory]
+    for key, value in entities.items():
+        sql += (' AND name IN (SELECT name FROM entities '
+                'WHERE dir = ? AND key = ? AND value = ?)')
+        args += [directory, key, str(value)]
+    return sorted(op.join(directory, name)
+                  for name, in _db().execute(sql, args))
@@ -0,0 +1,168 @@
+"""
+incremental build cache
+
+For every output, records a fingerprint of each input file, the command line
+and the parameters used to make it. A step is rerun only if its outputs are
+missing or something upstream really changed. Input files are compared by
+size and mtime first, and only hashed if those differ, so touching a file
+without changing its content does not trigger a rebuild.
+
+Outputs that already exist but were made before the cache existed are adopted
+as up to date the first time they are checked. Inputs that have since been
+deleted (e.g. intermediate files that are cleaned up) do not make an output
+stale, as it could not be remade anyway.
+"""
+
+import os
+import os.path as op
+import json
+import fcntl
+import hashlib
+import threading
+from . import tracing
+from .compression import run_fsl
+
+CACHE_PATH = '.build_cache.json'  # relative to the dataset root
+_lock = threading.Lock()
+
+
+def file_hash(path, block_size=2**24):
+
+    """ sha1 of a file's contents (follows symlinks) """
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _fingerprint(path, previous=None):
+    if not op.exists(path):
+        return None
+    st = os.stat(path)
+    fp = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+    if previous and previous['size'] == fp['size'] and \
+            previous['mtime'] == fp['mtime']:
+        fp['hash'] = previous['hash']  # fast path
+    else:
+        fp['hash'] = file_hash(path)
+    return fp
+
+
+def _normalise(params):
+    return json.loads(json.dumps(params, sort_keys=True, default=str))
+
+
+def _load():
+    if not op.isfile(CACHE_PATH):
+        return {}
+    with open(CACHE_PATH) as f:
+        return json.load(f)
+
+
+def _update(records):
+
+    """ merges records into the cache file, safe across threads/processes """
+
+    with _lock, open(f'{CACHE_PATH}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        db = _load()
+        db.update(records)
+        tmp = f'{CACHE_PATH}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(db, f, indent=1)
+        os.replace(tmp, CACHE_PATH)
+
+
+def content_hash(path):
+
+    """
+    sha1 of a file's contents (follows symlinks), remembered by size and
+    mtime so that an unchanged file is only hashed once
+    """
+
+    key = f'content:{op.realpath(path)}'
+    previous = _load().get(key)
+    current = _fingerprint(op.realpath(path), previous)
+    assert current, f'{path} does not exist'
+    if current != previous:
+        _update({key: current})
+    return current['hash']
+
+
+def record(outputs, inputs=(), cmd=None, params=None):
+
+    """ stores the current fingerprint of the inputs for each output """
+
+    db = _load()
+    records = {}
+    for out in outputs:
+        previous = db.get(op.normpath(out), {}).get('inputs', {})
+        records[op.normpath(out)] = {
+            'inputs': {op.normpath(i): _fingerprint(
+                i, previous.get(op.normpath(i))) for i in inputs},
+            'cmd': cmd,
+            'params': _normalise(params)}
+    _update(records)
+
+
+def needs_update(outputs, inputs=(), cmd=None, params=None):
+
+    """
+    True if any output is missing, or if the inputs, command or parameters
+    differ from those recorded when it was made.
+    """
+
+    if not all(op.exists(out) for out in outputs):
+        return True
+    db = _load()
+    stale, refreshed, adopted = False, {}, []
+    for out in outputs:
+        rec = db.get(op.normpath(out))
+        if rec is None:
+            adopted.append(out)
+            continue
+        if rec['cmd'] != cmd or rec['params'] != _normalise(params) or \
+                set(rec['inputs']) != {op.normpath(i) for i in inputs}:
+            return True
+        for inp, previous in rec['inputs'].items():
+            if not op.exists(inp):
+                continue  # deleted since, so the output cannot be remade
+            current = _fingerprint(inp, previous)
+            if previous is None or current['hash'] != previous['hash']:
+                stale = True
+            elif current != previous:
+                # touched but unchanged; store new mtime to skip rehashing
+                new = refreshed.setdefault(op.normpath(out), dict(
+                    rec, inputs=dict(rec['inputs'])))
+                new['inputs'][inp] = current
+    if stale:
+        return True
+    if refreshed:
+        _update(refreshed)
+    if adopted:
+        record(adopted, inputs, cmd, params)
+    return False
+
+
+def run(cmd, outputs, inputs=(), params=None, force=False, fsl_images=None):
+
+    """
+    runs a shell command if its outputs are out of date, and records the
+    build if it succeeds. Returns True if the command was run.
+    fsl_images: for FSL commands, every image the command writes (with or
+        without extension). They are written uncompressed and then gzipped
+        in parallel (see compression.run_fsl).
+    """
+
+    if not force and not needs_update(outputs, inputs, cmd, params):
+        return False
+    if fsl_images is None:
+        status = tracing.run(cmd)
+    else:
+        status = run_fsl(cmd, [image.split('.nii')[0]
+                               for image in fsl_images])
+    if status == 0 and all(op.exists(out) for out in outputs):
+        record(outputs, inputs, cmd, params)
+    return True
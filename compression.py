@@ -0,0 +1,176 @@
+"""
+compression policy for NIfTI outputs, and a parallel gzip writer
+
+Hot intermediates, which the pipeline reads again (e.g. the magnitude and
+phase calculated for NORDIC, or motion correction chunks), are written
+uncompressed: they can then be memory-mapped, and no CPU is spent on
+compression that is undone moments later. Final derivatives are gzipped by
+ParallelGzipWriter, which deflates blocks in a thread pool as pigz does: each
+block is primed with the end of the previous one and ends on a byte boundary
+(sync flush), so together they form one standard gzip stream that any reader
+can decompress. The block boundaries are also seek points for random access
+(see gzip_index). FSL tools compress in a single thread, so run_fsl has them
+write uncompressed and gzips their final outputs in parallel. Gzip files from
+other tools (e.g. fmriprep) have no seek points Python's zlib can restart
+from, so index_gzip rewrites them once through ParallelGzipWriter when they
+are first read at random.
+"""
+
+import os
+import os.path as op
+import gzip
+import shutil
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from .resources import n_cores
+from .gzip_index import write_index, load_index, move
+from . import tracing
+
+HOT, FINAL = 'hot', 'final'
+_WINDOW = 32768  # deflate history carried into the next block
+
+
+def nifti_ext(role):
+
+    """ extension of an image written for role (HOT or FINAL) """
+
+    assert role in [HOT, FINAL], f'unknown role {role}'
+    return '.nii' if role == HOT else '.nii.gz'
+
+
+def _deflate(block, dictionary, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15,
+                                  **({'zdict': dictionary} if dictionary
+                                     else {}))
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter:
+
+    """
+    file-like writer of a gzip file, compressing blocks of block_size bytes
+    in n_procs threads (zlib releases the GIL while compressing)
+
+        with ParallelGzipWriter(path) as f:
+            f.write(data)
+    """
+
+    def __init__(self, path, level=6, block_size=2 ** 20, n_procs=None,
+                 span=2 ** 22):
+        self.path, self.level, self.block_size = path, level, block_size
+        self.n_procs = n_procs or n_cores()
+        self.pool = ThreadPoolExecutor(self.n_procs)
+        self.pending = []  # (compressed block, seek point), in order
+        self.buffer = bytearray()
+        self.previous = b''
+        self.crc, self.size = 0, 0
+        self.span, self.points = span, [(10, 0, b'')]  # see gzip_index
+        self.f = open(path, 'wb')
+        self.f.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')  # header
+
+    def _flush(self):
+        future, point = self.pending.pop(0)
+        if point:
+            self.points.append((self.f.tell(),) + point)
+        self.f.write(future.result())
+
+    def _submit(self, block, last=False):
+        point = (self.size, self.previous) if block and \
+            self.size - self.points[-1][1] >= self.span else None
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append((self.pool.submit(
+            _deflate, block, self.previous, self.level, last), point))
+        self.previous = block[-_WINDOW:]
+        while self.pending and (len(self.pending) > 2 * self.n_procs or
+                                self.pending[0][0].done()):
+            self._flush()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return memoryview(data).nbytes
+
+    def close(self):
+        if self.f.closed:
+            return
+        self._submit(bytes(self.buffer), last=True)
+        while self.pending:
+            self._flush()
+        self.f.write(struct.pack('<II', self.crc, self.size & 0xffffffff))
+        self.f.close()
+        self.pool.shutdown()
+        if len(self.points) > 1:
+            write_index(self.path, self.points, self.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            self.pool.shutdown(cancel_futures=True)
+
+
+def gzip_file(path, out_path=None, level=6, n_procs=None):
+
+    """
+    compresses path to out_path (default: path + .gz) in parallel, removes
+    path and returns out_path
+    """
+
+    out_path = out_path or f'{path}.gz'
+    tmp_path = f'{out_path}.tmp{os.getpid()}'
+    with tracing.span('gzip', 'python'), open(path, 'rb') as f_in, \
+            ParallelGzipWriter(tmp_path, level, n_procs=n_procs) as f_out:
+        shutil.copyfileobj(f_in, f_out, 2 ** 22)
+    move(tmp_path, out_path)
+    os.remove(path)
+    return out_path
+
+
+def index_gzip(path, n_procs=None):
+
+    """
+    gives a gzip file written by another tool a seek-point index, by
+    rewriting it once through ParallelGzipWriter. The uncompressed data are
+    unchanged, but the compressed bytes are not, so build_cache sees the
+    file as changed once. Files smaller than one span or in read-only
+    directories are left as they are. Returns whether path is indexed.
+    """
+
+    path = op.realpath(path)  # e.g. links into the motion correction store
+    if load_index(path):
+        return True
+    if op.getsize(path) < 2 ** 22 or not os.access(op.dirname(path),
+                                                   os.W_OK):
+        return False
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with tracing.span('gzip index', 'python'), gzip.open(path) as f_in, \
+            ParallelGzipWriter(tmp_path, n_procs=n_procs) as f_out:
+        shutil.copyfileobj(f_in, f_out, 2 ** 22)
+    shutil.copymode(path, tmp_path)
+    move(tmp_path, path)
+    return load_index(path) is not None
+
+
+def run_fsl(cmd, out_bases=(), role=FINAL):
+
+    """
+    runs an FSL command with uncompressed outputs and, if they are FINAL,
+    gzips the outputs named in out_bases (paths without extension) in
+    parallel. Returns the exit status.
+    """
+
+    status = tracing.run(f'FSLOUTPUTTYPE=NIFTI {cmd}')
+    if status == 0 and role == FINAL:
+        for base in out_bases:
+            if os.path.isfile(f'{base}.nii'):  # else written compressed
+                gzip_file(f'{base}.nii')
+    return status
@@ -0,0 +1,75 @@
+"""
+runs container jobs (e.g. one fmriprep or mriqc participant each) side by side
+
+The core and memory budget is split into equal slots, one job per slot, with
+each slot getting at least min_procs cores and min_mem_gb of RAM. Each job's
+command is built for the resources of its slot, its output goes to its own
+log file, and the exit codes of all jobs are returned.
+"""
+
+import os
+import os.path as op
+import subprocess
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from .resources import n_cores, total_memory_gb
+from . import tracing
+
+
+def container_job(name, cmd, log_path=None):
+
+    """
+    name: label for the job, e.g. the participant label.
+    cmd: function taking (n_procs, mem_gb) and returning the command string.
+    log_path: file for the job's stdout/stderr.
+    """
+
+    return {'name': name, 'cmd': cmd, 'log_path': log_path}
+
+
+def container_slots(n_jobs, n_procs, mem_gb, min_procs, min_mem_gb):
+
+    """ number of jobs to run at once, and the cores / GB given to each """
+
+    n_slots = max(1, min(n_jobs,
+                         n_procs // min_procs,
+                         int(mem_gb // min_mem_gb)))
+    return n_slots, max(1, n_procs // n_slots), int(mem_gb // n_slots)
+
+
+def _run_job(job, procs, mem_gb):
+    cmd = job['cmd'](procs, mem_gb)
+    print(f'{datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")} | '
+          f'{job["name"]} | {cmd}')
+    if job['log_path']:
+        os.makedirs(op.dirname(job['log_path']), exist_ok=True)
+        with open(job['log_path'], 'w') as log:
+            return tracing.run(cmd, stdout=log, stderr=subprocess.STDOUT)
+    return tracing.run(cmd)
+
+
+def run_containers(jobs, n_procs=None, mem_gb=None, min_procs=8,
+                   min_mem_gb=32):
+
+    """
+    runs the jobs in parallel slots and returns {job name: exit code}.
+    n_procs / mem_gb default to the whole machine (leaving 10% of RAM free).
+    """
+
+    if not jobs:
+        return {}
+    n_procs = n_procs or n_cores()
+    mem_gb = mem_gb or total_memory_gb() * .9
+    n_slots, procs, mem = container_slots(
+        len(jobs), n_procs, mem_gb, min_procs, min_mem_gb)
+    print(f'running {len(jobs)} container jobs, {n_slots} at a time '
+          f'({procs} cores, {mem} GB each)')
+    with ThreadPoolExecutor(max_workers=n_slots) as pool:
+        futures = {job['name']: pool.submit(_run_job, job, procs, mem)
+                   for job in jobs}
+    exit_codes = {name: future.result() for name, future in futures.items()}
+    for job in jobs:
+        if exit_codes[job['name']]:
+            print(f'{job["name"]} failed with exit code '
+                  f'{exit_codes[job["name"]]} (log: {job["log_path"]})')
+    return exit_codes
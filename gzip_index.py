@@ -0,0 +1,195 @@
+"""
+seek-point index of gzip files, for random access into .nii.gz images
+
+gzip can only be decompressed from the start, so reading a few volumes near
+the end of a large .nii.gz normally means inflating everything before them.
+An index records seek points, offsets in the compressed and uncompressed
+data where decompression can restart, each with the 32 KB of data before it
+that deflate may refer back to (as in zlib's zran example). A read then
+starts from the nearest point before it, so takes time in proportion to the
+amount read (plus at most one span between points), and spans can be
+decompressed in parallel.
+
+Python's zlib cannot restart mid-byte, so the seek points are the
+byte-aligned block boundaries that compression.ParallelGzipWriter produces.
+It saves the index as a hidden sidecar (.{name}.gzidx) when it closes. The
+blocks of other gzip files (e.g. from FSL or fmriprep) end mid-byte, so an
+index cannot be built for them as they are: nifti_io.read_volumes rewrites
+them once through ParallelGzipWriter (compression.index_gzip) the first time
+they are read at random, and other readers read them sequentially until
+then. An index is ignored once the file's size or gzip trailer no longer
+match it.
+"""
+
+import os
+import os.path as op
+import bisect
+import gzip
+import shutil
+import zlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .resources import n_cores
+
+
+def index_path(path):
+    return op.join(op.dirname(path), f'.{op.basename(path)}.gzidx')
+
+
+def _trailer(path):
+    with open(path, 'rb') as f:
+        f.seek(-8, os.SEEK_END)
+        return np.frombuffer(f.read(), np.uint8)
+
+
+def write_index(path, points, length):
+
+    """
+    saves the index of path. points: (compressed offset, uncompressed
+    offset, window) of each seek point; length: uncompressed size.
+    """
+
+    tmp_path = f'{index_path(path)}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 comp=np.array([point[0] for point in points], np.int64),
+                 uncomp=np.array([point[1] for point in points], np.int64),
+                 window_len=np.array([len(point[2]) for point in points]),
+                 windows=np.frombuffer(b''.join(
+                     point[2] for point in points), np.uint8),
+                 length=np.int64(length),
+                 comp_size=np.int64(op.getsize(path)),
+                 trailer=_trailer(path))
+    os.replace(tmp_path, index_path(path))
+
+
+def load_index(path):
+
+    """ {'points': [(comp, uncomp, window)], 'length': n} or None """
+
+    path = op.realpath(path)  # e.g. links into the motion correction store
+    if not op.isfile(index_path(path)):
+        return None
+    with np.load(index_path(path)) as index:
+        if index['comp_size'] != op.getsize(path) or \
+                not np.array_equal(index['trailer'], _trailer(path)):
+            return None  # stale
+        ends = np.cumsum(index['window_len'])
+        windows = index['windows'].tobytes()
+        points = [(int(comp), int(uncomp), windows[end - n:end])
+                  for comp, uncomp, n, end in zip(
+                      index['comp'], index['uncomp'], index['window_len'],
+                      ends)]
+        return {'points': points, 'length': int(index['length'])}
+
+
+def move(src, dst):
+
+    """ os.replace for a gzip file together with its index """
+
+    os.replace(src, dst)
+    if op.isfile(index_path(src)):
+        os.replace(index_path(src), index_path(dst))
+    elif op.isfile(index_path(dst)):
+        os.remove(index_path(dst))
+
+
+class IndexedGzipReader:
+
+    """ read-only file object with random access through an index """
+
+    def __init__(self, path, index):
+        self.f = open(path, 'rb')
+        self.points, self.length = index['points'], index['length']
+        self.offsets = [point[1] for point in self.points]
+        self.pos, self.upos, self.d = 0, 0, None
+
+    def _restart(self, point):
+        comp, self.upos, window = point
+        self.d = zlib.decompressobj(-15, **({'zdict': window} if window
+                                            else {}))
+        self.f.seek(comp)
+
+    def _inflate(self, n):
+
+        """ up to n bytes from the decompressor's position (upos) """
+
+        out = bytearray()
+        while len(out) < n and not self.d.eof:
+            data = self.d.unconsumed_tail or self.f.read(2 ** 16)
+            if not data:
+                break
+            out += self.d.decompress(data, n - len(out))
+        self.upos += len(out)
+        return out
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.pos = {os.SEEK_SET: 0, os.SEEK_CUR: self.pos,
+                    os.SEEK_END: self.length}[whence] + offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        size = self.length - self.pos if size is None or size < 0 else size
+        p = bisect.bisect_right(self.offsets, self.pos) - 1
+        if self.d is None or self.upos > self.pos or \
+                self.offsets[p] > self.upos:
+            self._restart(self.points[p])
+        while self.upos < self.pos:  # skip to pos
+            self._inflate(min(self.pos - self.upos, 2 ** 22))
+        data = bytes(self._inflate(size))
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_gzip(path):
+
+    """ random-access reader of path if it is indexed, else gzip.open """
+
+    index = load_index(path)
+    return IndexedGzipReader(path, index) if index else gzip.open(path)
+
+
+def decompress(path, out_path, n_procs=None):
+
+    """
+    decompresses path to out_path, splitting an indexed file between up to
+    n_procs threads (zlib releases the GIL while decompressing)
+    """
+
+    index = load_index(path)
+    if index is None:
+        with gzip.open(path) as f_in, open(out_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 ** 2)
+        return
+    starts = [point[1] for point in index['points']] + [index['length']]
+    groups = np.array_split(np.arange(len(starts) - 1),
+                            min(n_procs or n_cores(), len(starts) - 1))
+    with open(out_path, 'wb') as f_out:
+        f_out.truncate(index['length'])
+
+    def inflate(group):
+        start, end = starts[group[0]], starts[group[-1] + 1]
+        with IndexedGzipReader(path, index) as f_in, \
+                open(out_path, 'r+b') as f_out:
+            f_in.seek(start)
+            while start < end:
+                data = f_in.read(min(2 ** 22, end - start))
+                assert data, f'{path} is truncated'
+                os.pwrite(f_out.fileno(), data, start)
+                start += len(data)
+
+    with ThreadPoolExecutor(len(groups)) as pool:
+        [future.result() for future in [pool.submit(inflate, group)
+                                        for group in groups]]
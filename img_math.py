@@ -0,0 +1,350 @@
+"""
+lazy, fused image arithmetic in place of fslmaths chains
+
+An Img is a node in an expression graph; nothing is read or computed until
+write() or compute(). For example
+
+    ts = Img(timeseries)
+    ts.bptf(15).add(ts.tmean()).write(out)  # fslmaths -bptf 15 -1 -add Tmean
+    Img(lh).add(Img(rh)).bin().write(out)  # fslmaths lh -add rh -bin
+
+Element-wise operations are fused without intermediate files, and each input
+image is read once however often it appears. A graph without temporal
+filtering is evaluated on chunks of volumes read in order (iter_chunks), so
+gzipped inputs are streamed rather than decompressed. Temporal reductions
+(tmean, tstd) are accumulated over the chunks in float64 (as in tsnr.py),
+taking one extra pass over the inputs per level of nesting. A graph with
+temporal filtering (bptf, x - fit + c0 as in fslmaths -bptf since FSL 5.0.7,
+see temporal_filter.py) needs every volume of a voxel at once, so it is
+evaluated in a single pass over slabs of slices, decompressing gzipped inputs
+to temporary files. As in fslmaths, 3D images and temporal reductions apply
+to every volume of a 4D image, division by zero gives zero, and outputs are
+float32.
+"""
+
+import numpy as np
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from .nifti_io import (nifti_path, load_header, open_memmap, uncompressed,
+                       apply_scaling, iter_chunks, load_data, output_header,
+                       SlabWriter, VolumeWriter)
+from .temporal_filter import bptf_matrix
+from .resources import n_cores
+
+
+def _div(a, b):
+    return np.divide(a, b, out=np.zeros(np.broadcast(a, b).shape,
+                                        np.float32), where=b != 0)
+
+
+def _tstd(a):
+    if a.shape[3] < 2:
+        return np.zeros_like(a[..., :1])
+    return a.std(axis=3, ddof=1, keepdims=True, dtype=np.float64).astype(
+        np.float32)
+
+
+_BINARY = {'add': np.add, 'sub': np.subtract, 'mul': np.multiply,
+           'div': _div}
+_UNARY = {'abs': np.abs, 'sqrt': np.sqrt,
+          'bin': lambda a: (a > 0).astype(np.float32),
+          'tmean': lambda a: a.mean(axis=3, keepdims=True, dtype=np.float64
+                                    ).astype(np.float32),
+          'tstd': _tstd}
+_REDUCTIONS = ['tmean', 'tstd']
+
+
+def _graph(roots, known=()):
+
+    """
+    the nodes roots depend on, operands before the nodes using them, leaving
+    out the nodes in known (ids of nodes already evaluated) and their operands
+    """
+
+    nodes, seen = [], set(known)
+
+    def visit(node):
+        if id(node) in seen:
+            return
+        seen.add(id(node))
+        for arg in node.args:
+            if isinstance(arg, Img):
+                visit(arg)
+        nodes.append(node)
+
+    for root in roots:
+        visit(root)
+    return nodes
+
+
+def _evaluate(roots, load, filters=None, known=None):
+
+    """
+    values of roots, as float32 x, y, z, t arrays. load(path): an input
+    image's values; known: values of nodes already evaluated, by id
+    """
+
+    values = dict(known or {})
+    for node in _graph(roots, values):
+        args = [values[id(arg)] if isinstance(arg, Img) else arg
+                for arg in node.args]
+        if node.op == 'load':
+            value = load(args[0])
+        elif node.op in _BINARY:
+            value = _BINARY[node.op](*args).astype(np.float32, copy=False)
+        elif node.op in _UNARY:
+            value = _UNARY[node.op](args[0])
+        elif node.op == 'thr':
+            value = np.where(args[0] < args[1], 0, args[0]).astype(
+                np.float32)
+        elif node.op == 'bptf':
+            series = args[0].reshape(-1, args[0].shape[3])
+            value = (series @ filters[id(node)].T).reshape(args[0].shape)
+        values[id(node)] = value
+    return [values[id(root)] for root in roots]
+
+
+def _merge(stats, chunk):
+
+    """ adds a chunk of volumes to running (n, mean, sum of squares) """
+
+    n, mean, m2 = stats
+    n_chunk = chunk.shape[3]
+    mean_chunk = chunk.mean(axis=3, dtype=np.float64)
+    m2_chunk = np.square(chunk - mean_chunk[..., None]).sum(axis=3)
+    delta = mean_chunk - mean
+    n += n_chunk
+    mean = mean + delta * (n_chunk / n)
+    m2 = m2 + m2_chunk + np.square(delta) * ((n - n_chunk) * n_chunk / n)
+    return n, mean, m2
+
+
+class Img:
+
+    def __init__(self, source, *args):
+
+        """
+        source: image path (with or without extension), or an operation
+        name followed by its operands (used internally)
+        """
+
+        if args:
+            self.op, self.args = source, args
+        else:
+            self.op, self.args = 'load', (nifti_path(source),)
+
+    # element-wise operations with another Img or a number
+    def add(self, other):
+        return Img('add', self, other)
+
+    def sub(self, other):
+        return Img('sub', self, other)
+
+    def mul(self, other):
+        return Img('mul', self, other)
+
+    def div(self, other):
+        return Img('div', self, other)
+
+    __add__, __sub__, __mul__, __truediv__ = add, sub, mul, div
+
+    def thr(self, value):
+
+        """ zero everything below value """
+
+        return Img('thr', self, value)
+
+    def bin(self):
+        return Img('bin', self)
+
+    def abs(self):
+        return Img('abs', self)
+
+    def sqrt(self):
+        return Img('sqrt', self)
+
+    # temporal operations
+    def tmean(self):
+        return Img('tmean', self)
+
+    def tstd(self):
+        return Img('tstd', self)
+
+    def bptf(self, hp_sigma, lp_sigma=-1):
+
+        """
+        high-pass temporal filter, as fslmaths -bptf hp_sigma -1 (FSL 5.0.7
+        and later, with its c0 term)
+        """
+
+        assert lp_sigma < 0, 'only high-pass filtering is supported'
+        return Img('bptf', self, hp_sigma)
+
+    def _nodes(self):
+
+        """ all nodes of the graph, operands before the nodes using them """
+
+        return _graph([self])
+
+    def _n_vols(self, headers):
+
+        """ number of volumes of the result, None if 3D """
+
+        if self.op == 'load':
+            shape = headers[self.args[0]].get_data_shape()
+            return shape[3] if len(shape) > 3 else None
+        if self.op in ['tmean', 'tstd']:
+            return None
+        n_vols = {arg._n_vols(headers) for arg in self.args
+                  if isinstance(arg, Img)} - {None}
+        assert len(n_vols) <= 1, f'mismatched volumes: {n_vols}'
+        return n_vols.pop() if n_vols else None
+
+    def _headers(self):
+        headers = {node.args[0]: load_header(node.args[0])
+                   for node in self._nodes() if node.op == 'load'}
+        shapes = {header.get_data_shape()[:3] for header in headers.values()}
+        assert len(shapes) == 1, f'mismatched image dimensions: {shapes}'
+        return headers
+
+    def _by_slab(self):
+
+        """ whether the graph has to be evaluated by slab (see above) """
+
+        return any(node.op == 'bptf' for node in self._nodes())
+
+    def _evaluate_slab(self, z, leaves, filters):
+
+        def load(path):
+            header, data = leaves[path]
+            return apply_scaling(data[:, :, z], header, np.float32)
+
+        return _evaluate([self], load, filters)[0]
+
+    def _slabs(self, headers, slab_size, n_procs):
+
+        """ yields (slice, result slab) with up to n_procs slabs at a time """
+
+        n_slices = next(iter(headers.values())).get_data_shape()[2]
+        filters = {id(node): bptf_matrix(node.args[0]._n_vols(headers),
+                                         node.args[1]).astype(np.float32)
+                   for node in self._nodes() if node.op == 'bptf'}
+        with ExitStack() as stack, ThreadPoolExecutor(n_procs) as pool:
+            leaves = {path: open_memmap(stack.enter_context(
+                uncompressed(path))) for path in headers}
+            pending = []
+            for start in range(0, n_slices, slab_size):
+                z = slice(start, min(start + slab_size, n_slices))
+                pending.append((z, pool.submit(self._evaluate_slab, z,
+                                               leaves, filters)))
+                if len(pending) >= n_procs:
+                    z, future = pending.pop(0)
+                    yield z, future.result()
+            for z, future in pending:
+                yield z, future.result()
+
+    @staticmethod
+    def _iter_values(roots, headers, known, chunk_vols, n_procs):
+
+        """
+        yields the values of roots for each chunk of volumes of the 4D
+        inputs they use (once if they use none), evaluating up to n_procs
+        chunks at a time
+        """
+
+        paths = {node.args[0] for node in _graph(roots, known)
+                 if node.op == 'load'}
+        series = sorted(path for path in paths
+                        if len(headers[path].get_data_shape()) > 3)
+        images = {path: load_data(path)[..., None] for path in paths
+                  if path not in series}
+        chunks = zip(*[iter_chunks(path, chunk_vols, np.float32)
+                       for path in series]) if series else [()]
+        with ThreadPoolExecutor(n_procs) as pool:
+            pending = []
+            for chunk in chunks:
+                leaves = dict(images, **dict(zip(series, chunk)))
+                pending.append(pool.submit(_evaluate, roots,
+                                           leaves.__getitem__, None, known))
+                if len(pending) >= n_procs:
+                    yield pending.pop(0).result()
+            for future in pending:
+                yield future.result()
+
+    def _reductions(self, headers, chunk_vols, n_procs):
+
+        """
+        values of the graph's tmean and tstd nodes, by id, streamed through
+        chunks of volumes. Reductions that do not use each other are made
+        in the same pass.
+        """
+
+        known = {}
+        todo = [node for node in self._nodes() if node.op in _REDUCTIONS]
+        while todo:
+            ids = {id(node) for node in todo}
+            level = [node for node in todo if not any(
+                id(other) in ids for other in _graph([node.args[0]], known))]
+            stats = [(0, 0., 0.)] * len(level)
+            for values in self._iter_values([node.args[0] for node in level],
+                                            headers, known, chunk_vols,
+                                            n_procs):
+                stats = [_merge(s, value) for s, value in zip(stats, values)]
+            for node, (n, mean, m2) in zip(level, stats):
+                if node.op == 'tmean':
+                    value = mean
+                else:
+                    value = np.sqrt(m2 / (n - 1)) if n > 1 else \
+                        np.zeros_like(mean)
+                known[id(node)] = value[..., None].astype(np.float32)
+            todo = [node for node in todo if id(node) not in known]
+        return known
+
+    def _chunks(self, headers, chunk_vols, n_procs):
+
+        """ yields the result for each chunk of volumes (once if 3D) """
+
+        known = self._reductions(headers, chunk_vols, n_procs)
+        for values in self._iter_values([self], headers, known, chunk_vols,
+                                        n_procs):
+            yield values[0]
+
+    def compute(self, slab_size=8, n_procs=None, chunk_vols=16):
+
+        """ evaluates the expression, returning a 3D or 4D float32 array """
+
+        headers = self._headers()
+        n_vols = self._n_vols(headers)
+        shape = next(iter(headers.values())).get_data_shape()[:3]
+        out = np.zeros(shape + (n_vols or 1,), np.float32)
+        n_procs = n_procs or n_cores()
+        if self._by_slab():
+            for z, slab in self._slabs(headers, slab_size, n_procs):
+                out[:, :, z] = slab
+        else:
+            start = 0
+            for chunk in self._chunks(headers, chunk_vols, n_procs):
+                out[..., start:start + chunk.shape[3]] = chunk
+                start += chunk.shape[3]
+        return out if n_vols else out[..., 0]
+
+    def write(self, path, slab_size=8, n_procs=None, chunk_vols=16):
+
+        """
+        evaluates the expression into path (float32, with the geometry of
+        the first image in the expression) and returns path
+        """
+
+        headers = self._headers()
+        header = output_header(next(iter(headers.values())),
+                               self._n_vols(headers))
+        n_procs = n_procs or n_cores()
+        if self._by_slab():
+            with SlabWriter(path, header) as writer:
+                for z, slab in self._slabs(headers, slab_size, n_procs):
+                    writer.write(z, slab)
+        else:
+            with VolumeWriter(path, header) as writer:
+                for chunk in self._chunks(headers, chunk_vols, n_procs):
+                    writer.write(chunk)
+        return path
@@ -8,68 +8,114 @@ For future projects, try to use dcm2bids (https://andysbrainbook.readthedocs.io/
 import os
 import os.path as op
 import sys
-import glob
 import shutil
 import json
 import time
+import multiprocessing as mp
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from . import bids_index
 from .seconds_to_text import seconds_to_text
 from .philips_slice_timing import philips_slice_timing
 from .make_anat_slices import make_anat_slices
+from .staging import stage_file
+from .resources import n_cores
+from . import tracing
 
 
-def initialise_BIDS():
+def initialise_BIDS(n_procs=None):
+
+    """
+    sessions are independent, so each is ingested in its own process (up to
+    n_procs at a time, default: all cores), with its output in
+    derivatives/logs/initialise_BIDS/sub-{subject}_ses-{session}.log
+    """
 
     print(f"Initializing BIDS...")
     subjects = json.load(open("participants.json", "r+"))
-    
-    for subject in subjects:
 
+    # anatomical slices are made once per subject, from its first anat scan
+    sessions, slice_subjects = [], set()
+    for subject in subjects:
         for s, session in enumerate(subjects[subject]):
-
-            filetypes = ["nii","json"] # do not include other filetypes that may cause BIDS errors
-            sourcedir = f"sourcedata/sub-{subject}/ses-{s+1}/raw_data"
-            sessID = subjects[subject][session]["sessID"]
-
-            # detect DICOM or NIFTI format for raw data
-            if len(glob.glob(f"{sourcedir}/*.DCM")): # if DICOM format
-                os.system(f"dcm2niix {op.abspath(sourcedir)}") # convert to nifti, json etc
-                copy_or_move = shutil.move # move files, don't copy
-            else: # if NIFTI format
-                copy_or_move = shutil.copy # copy files, don't move
-
-
-            ### ANAT ###
-
-            anatscan = subjects[subject][session]["anat"]
+            make_slices = subject not in slice_subjects and \
+                subjects[subject][session]["anat"] is not None
+            if make_slices:
+                slice_subjects.add(subject)
+            sessions.append((subject, s, subjects[subject][session],
+                             make_slices))
+
+    n_procs = n_procs or n_cores()
+    n_workers = max(1, min(len(sessions), n_procs))
+    print(f'ingesting {len(sessions)} sessions, {n_workers} at a time')
+    with ProcessPoolExecutor(
+            n_workers, mp_context=mp.get_context('spawn')) as pool:
+        futures = {f'sub-{subject}_ses-{s + 1}': pool.submit(
+            _initialise_session, subject, s, session_info, make_slices)
+            for subject, s, session_info, make_slices in sessions}
+    failed = [name for name, future in futures.items() if future.exception()]
+    for name in failed:
+        print(f'{name} failed: {futures[name].exception()!r} (log: '
+              f'derivatives/logs/initialise_BIDS/{name}.log)')
+    if failed:
+        raise RuntimeError(f'BIDS initialisation failed for {failed}')
+
+
+@contextmanager
+def _log_to(path):
+
+    """
+    sends this process's stdout and stderr, including that of the commands
+    it runs, to path
+    """
+
+    os.makedirs(op.dirname(path), exist_ok=True)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(path, 'w') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, saved_fd in zip([1, 2], saved):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+
+
+def _initialise_session(subject, s, session_info, make_slices):
+
+    with _log_to(f'derivatives/logs/initialise_BIDS/'
+                 f'sub-{subject}_ses-{s + 1}.log'):
+
+        filetypes = ["nii","json"] # do not include other filetypes that may cause BIDS errors
+        sourcedir = f"sourcedata/sub-{subject}/ses-{s+1}/raw_data"
+        sessID = session_info["sessID"]
+
+        # detect DICOM or NIFTI format for raw data
+        if len(bids_index.glob(f"{sourcedir}/*.DCM")): # if DICOM format
+            tracing.run(f"dcm2niix {op.abspath(sourcedir)}") # convert to nifti, json etc
+            copy_or_move = shutil.move # move files, don't copy
+        else: # if NIFTI format
+            # stage files rather than copying them where possible; json
+            # files are edited in place below, so are never hardlinked
+            copy_or_move = lambda src, dst: stage_file(
+                src, dst, modify=dst.endswith('.json'))
+
+
+        ### ANAT ###
+
+        # de-identification and slice images run alongside the func and
+        # fmap copying
+        anatscan = session_info["anat"]
+        with ThreadPoolExecutor(1) as anat_pool:
             if anatscan is not None:
-
-                anat_ses = s+1
-                anatdir = f"sub-{subject}/ses-{anat_ses}/anat"
-                os.makedirs(anatdir, exist_ok=True)
-
-                # json file
-                files = glob.glob(f"{sourcedir}/*{sessID}.{anatscan:02}*.json")
-                assert len(files) == 1
-                inpath = files[0]
-                outpath = f"{anatdir}/sub-{subject}_ses-{s+1}_T1w.json"
-                if not op.isfile(outpath):
-                    copy_or_move(inpath, outpath)
-
-                # nii file
-                files = glob.glob(f"{sourcedir}/*{sessID}.{anatscan:02}*.nii")
-                assert len(files) == 1
-                inpath = files[0]
-
-                # deidentify anatomical image
-                outpath = f"{anatdir}/sub-{subject}_ses-{anat_ses}_T1w.nii"
-                if not op.isfile(outpath):
-                    os.system(f'mideface --i {inpath} --o {outpath}')
-
-            # make T1 images for subject
-            slice_dir = op.expanduser(
-                f'~/david/subjects/for_subjects/sub-{subject}/2D')
-            if not op.isdir(slice_dir):
-                make_anat_slices(f'sub-{subject}', inpath, slice_dir)
+                anat_job = anat_pool.submit(
+                    _initialise_anat, subject, s, sourcedir, sessID,
+                    anatscan, copy_or_move, make_slices)
 
 
             ### FUNC ###
@@ -78,7 +124,7 @@ def initialise_BIDS():
             os.makedirs(funcdir, exist_ok=True)
             fmapdir = f"sub-{subject}/ses-{s + 1}/fmap"
             os.makedirs(fmapdir, exist_ok=True)
-            for funcscan, runs in subjects[subject][session]["func"].items():
+            for funcscan, runs in session_info["func"].items():
                 for run, scan_num in enumerate(runs):
 
                     # copy/move over nii and json files from sourcedata
@@ -86,8 +132,8 @@ def initialise_BIDS():
                             ['01', '01_real', '01_imaginary', '01_ph'],
                             ['mag', 'real', 'imag', 'phase']):
                         for filetype in filetypes:
-                            files = glob.glob(f"{sourcedir}/*{sessID}."
-                                          f"{scan_num:02}*{cpnt}.{filetype}")
+                            files = bids_index.glob(f"{sourcedir}/*{sessID}."
+                                                    f"{scan_num:02}*{cpnt}.{filetype}")
                             if len(files):
                                 inpath = files[0]
                                 outpath = (f"{funcdir}/sub-{subject}_ses-" \
@@ -120,31 +166,65 @@ def initialise_BIDS():
 
             # b0
             for c, component in enumerate(["magnitude", "fieldmap"]):
-
-                # b0
-                for c, component in enumerate(["magnitude", "fieldmap"]):
-                    for filetype in filetypes:
-                        files = glob.glob(
-                            f"{sourcedir}/*{sessID}.{subjects[subject][session]['fmap']['b0']:02}*B0_shimmed*e{c + 1}*.{filetype}")
-                        assert len(files) == 1
-                        inpath = files[0]
-                        outpath = f"{fmapdir}/sub-{subject}_ses-{s + 1}_acq-b0_{component}.{filetype}"
-                        if not op.isfile(outpath):
-                            copy_or_move(inpath, outpath)
-
-                # add required meta data to json file
-                jsonpath = f"{fmapdir}/sub-{subject}_ses-" \
-                           f"{s + 1}_acq-b0_{component}.json"
-                scandata = json.load(open(jsonpath, "r+"))
-                if "IntendedFor" not in scandata:
-                    intendedscans = glob.glob(f"sub-{subject}/ses-{s+1}/"
-                                              f"anat/*.nii")
-                    intendedscans += glob.glob(f"sub-{subject}/ses-{s+1}/"
-                                               f"func/*part-mag_bold.nii")
-                    scandata["IntendedFor"] = sorted([x[9:] for x in intendedscans])
-                if component == "fieldmap" and "Units" not in scandata:
-                    scandata["Units"] = "Hz"
-                json.dump(scandata, open(jsonpath, "w+"), sort_keys=True, indent=4)
+                for filetype in filetypes:
+                    files = bids_index.glob(
+                        f"{sourcedir}/*{sessID}.{session_info['fmap']['b0']:02}*B0_shimmed*e{c + 1}*.{filetype}")
+                    assert len(files) == 1
+                    inpath = files[0]
+                    outpath = f"{fmapdir}/sub-{subject}_ses-{s + 1}_acq-b0_{component}.{filetype}"
+                    if not op.isfile(outpath):
+                        copy_or_move(inpath, outpath)
+
+            # IntendedFor lists the anatomical image, so wait for it
+            if anatscan is not None:
+                anat_job.result()
+
+        # add required meta data to json file
+        for component in ["magnitude", "fieldmap"]:
+            jsonpath = f"{fmapdir}/sub-{subject}_ses-" \
+                       f"{s + 1}_acq-b0_{component}.json"
+            scandata = json.load(open(jsonpath, "r+"))
+            if "IntendedFor" not in scandata:
+                intendedscans = bids_index.glob(f"sub-{subject}/ses-{s+1}/"
+                                                f"anat/*.nii")
+                intendedscans += bids_index.glob(f"sub-{subject}/ses-{s+1}/"
+                                                 f"func/*part-mag_bold.nii")
+                scandata["IntendedFor"] = sorted([x[9:] for x in intendedscans])
+            if component == "fieldmap" and "Units" not in scandata:
+                scandata["Units"] = "Hz"
+            json.dump(scandata, open(jsonpath, "w+"), sort_keys=True, indent=4)
+
+
+def _initialise_anat(subject, s, sourcedir, sessID, anatscan, copy_or_move,
+                     make_slices):
+
+    anat_ses = s+1
+    anatdir = f"sub-{subject}/ses-{anat_ses}/anat"
+    os.makedirs(anatdir, exist_ok=True)
+
+    # json file
+    files = bids_index.glob(f"{sourcedir}/*{sessID}.{anatscan:02}*.json")
+    assert len(files) == 1
+    inpath = files[0]
+    outpath = f"{anatdir}/sub-{subject}_ses-{s+1}_T1w.json"
+    if not op.isfile(outpath):
+        copy_or_move(inpath, outpath)
+
+    # nii file
+    files = bids_index.glob(f"{sourcedir}/*{sessID}.{anatscan:02}*.nii")
+    assert len(files) == 1
+    inpath = files[0]
+
+    # deidentify anatomical image
+    outpath = f"{anatdir}/sub-{subject}_ses-{anat_ses}_T1w.nii"
+    if not op.isfile(outpath):
+        tracing.run(f'mideface --i {inpath} --o {outpath}')
+
+    # make T1 images for subject
+    slice_dir = op.expanduser(
+        f'~/david/subjects/for_subjects/sub-{subject}/2D')
+    if make_slices and not op.isdir(slice_dir):
+        make_anat_slices(f'sub-{subject}', inpath, slice_dir)
 
 
 
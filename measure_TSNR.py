@@ -10,141 +10,192 @@ from tabulate import tabulate
 import datetime
 import sys
 import os.path as op
-import glob
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 
 sys.path.append(op.expanduser('~/david/master_scripts/misc'))
 from plot_utils import export_legend, custom_defaults
+from . import bids_index, build_cache, results_store
+from .tsnr import write_temporal_stats
+from .roi_stats import load_rois, roi_stats
+from .motion_correction import motion_correct
+from .resources import n_cores
 plt.rcParams.update(custom_defaults)
+POSTPROCS = ['no further processing',
+             'after motion correction',
+             'after motion correction and linear trend removal']
 
-def measure_TSNR(overwrite):
-    
+def tsnr_maps(ts, overwrite, save_stats=True, hp_sigma=None):
+
+    """
+    makes the tSNR map of a timeseries (and its Tmean and Tstd maps if
+    save_stats) in a single pass over the data, returning the three paths.
+    hp_sigma: measure after high-pass filtering (as fslmaths -bptf hp_sigma
+    -1 with the mean added back); the maps are named as for an _ltr file.
+    """
+
+    base = ts.split('.nii')[0] + ('_ltr' if hp_sigma else '')
+    pathTmean, pathTstd, pathTSNR = [
+        f'{base}_{stat}.nii.gz' for stat in ['Tmean', 'Tstd', 'tSNR']]
+    outputs = [pathTSNR] + ([pathTmean, pathTstd] if save_stats else [])
+    params = {'hp_sigma': hp_sigma} if hp_sigma else None
+    if build_cache.needs_update(outputs, inputs=[ts], params=params) or \
+            overwrite:
+        print('Calculating mean, std and tSNR maps...')
+        write_temporal_stats(ts, *outputs, hp_sigma=hp_sigma)
+        build_cache.record(outputs, inputs=[ts], params=params)
+    return pathTmean, pathTstd, pathTSNR
+
+
+def _measure_variant(pp, preproc_dir, tsnr_dir, subject, masks, overwrite,
+                     save_stats, n_procs):
+
+    """
+    motion corrects one preprocessing variant and measures its tSNR in every
+    ROI, with and without further processing, storing the results of those
+    ROIs whose tSNR map or mask has changed. Returns the variant's name.
+    """
+
+    if pp == 0:
+        preproc = 'raw_data_meas'
+        timeseries_orig = bids_index.glob(
+            f'{preproc_dir}/*restingState*acq-meas*part-mag_bold.nii')
+    elif pp == 1:
+        preproc = 'raw_data_calc'
+        timeseries_orig = bids_index.glob(
+            f'{preproc_dir}/*restingState*acq-calc*part-mag_bold.nii*')
+    else:
+        preproc = preproc_dir.split('/')[1]
+        timeseries_orig = bids_index.glob(f'{preproc_dir}/*restingState*bold.nii')
+    assert(len(timeseries_orig) == 1)
+    timeseries_orig = timeseries_orig[0]
+
+    out_dir = f'{tsnr_dir}/{preproc}'
+    os.makedirs(out_dir, exist_ok=True)
+
+    # link to raw data
+    if not os.path.exists(f'{out_dir}/{op.basename(timeseries_orig)}'):
+        os.system(f'ln -s {op.abspath(timeseries_orig)} {out_dir}')
+    timeseries = f'{out_dir}/{op.basename(timeseries_orig)}'
+
+    # other preprocessing: motion correction
+    timeseries_mc = (f'{timeseries.split(".")[0]}_motcor.nii.gz')
+    motion_correct(timeseries, timeseries_mc.split('.nii')[0],
+                   overwrite=overwrite, n_procs=n_procs)
+
+    # other preprocessing: linear trend removal aka temporal
+    # filtering in this case, applied while measuring tSNR
+    for p, (postproc, ts, hp_sigma) in enumerate(zip(
+            POSTPROCS,
+            [timeseries, timeseries_mc, timeseries_mc],
+            [None, None, 15])):
+
+        pathTSNR = tsnr_maps(ts, overwrite, save_stats, hp_sigma)[2]
+
+        # get tSNR values in the ROIs whose inputs have changed
+        partitions = {region: dict(subject=subject, preproc=preproc,
+                                   postproc=postproc, region=region)
+                      for region in masks}
+        fps = {region: results_store.fingerprint(pathTSNR, mask)
+               for region, mask in masks.items()}
+        todo = [region for region in masks if overwrite or not
+                results_store.has('tSNR', partitions[region], fps[region])]
+        if todo:
+            stats = roi_stats(pathTSNR, load_rois(
+                {region: masks[region] for region in todo}))
+            for region in todo:
+                results_store.write('tSNR', partitions[region], fps[region],
+                                    stats.loc[[region]])
+
+    return preproc
+
+
+def measure_TSNR(overwrite, save_stats=True, regions=('V1',), n_procs=None):
+
+    """
+    save_stats: also keep the Tmean and Tstd maps of each timeseries (the
+    tSNR maps are always kept)
+    regions: ROIs (masks {region}_cortex.nii.gz made by make_ROIs) in which
+    tSNR is measured, all from one read of each tSNR map. Results are kept
+    in the 'tSNR' table of results_store and only remeasured for ROIs whose
+    tSNR map or mask has changed.
+    n_procs: cores shared by the preprocessing variants, which are measured
+    in parallel (default: all)
+    """
 
     subject = 'M001'
     roi_dir = f'derivatives/ROIs/sub-{subject}'
     os.makedirs(roi_dir, exist_ok=True)
     tsnr_dir = f'derivatives/tSNR'
     preproc_dirs = ['sub-M001/ses-1/func'] * 2
-    preproc_dirs += [d for d in sorted(glob.glob('derivatives/**/ses-1/func',
-                                    recursive=True)) if 'mriqc' not in d]
-
-
-    tsnr_path = f'{tsnr_dir}/tSNR_V1.csv'
-    if not op.isfile(tsnr_path) or overwrite:
-        df = pd.DataFrame()
-        preprocs = []
-        for pp, preproc_dir in enumerate(preproc_dirs):
-
-            if pp == 0:
-                preproc = 'raw_data_meas'
-                timeseries_orig = glob.glob(
-                    f'{preproc_dir}/*restingState*acq-meas*part-mag_bold.nii')
-            elif pp == 1:
-                preproc = 'raw_data_calc'
-                timeseries_orig = glob.glob(
-                    f'{preproc_dir}/*restingState*acq-calc*part-mag_bold.nii*')
-            else:
-                preproc = preproc_dir.split('/')[1]
-                timeseries_orig = glob.glob(f'{preproc_dir}/*restingState*bold.nii')
-            assert(len(timeseries_orig) == 1)
-            timeseries_orig = timeseries_orig[0]
-            preprocs.append(preproc)
-
-            out_dir = f'{tsnr_dir}/{preproc}'
-            os.makedirs(out_dir, exist_ok=True)
-
-            # link to raw data
-            if not os.path.exists(f'{out_dir}/{op.basename(timeseries_orig)}'):
-                os.system(f'ln -s {op.abspath(timeseries_orig)} {out_dir}')
-            timeseries = f'{out_dir}/{op.basename(timeseries_orig)}'
-
-            # other preprocessing: motion correction
-            timeseries_mc = (f'{timeseries.split(".")[0]}_motcor.nii.gz')
-            if not os.path.exists(timeseries_mc) or overwrite:
-                os.system(f'mcflirt -in {timeseries} -out {timeseries_mc}')
-
-            # other preprocessing: linear trend removal aka temporal filtering in this case
-            timeseries_mc_ltr = f'{timeseries_mc.split(".")[0]}_ltr.nii.gz'
-            if not os.path.exists(timeseries_mc_ltr) or overwrite:
-                # get Tmean so it can be added back afterward
-                timeseries_mc_Tmean = f'{timeseries_mc[:-7]}_Tmean.nii.gz'
-                os.system(
-                    f'fslmaths {timeseries_mc} -Tmean {timeseries_mc_Tmean}')
-
-                os.system(
-                    f'fslmaths {timeseries_mc} -bptf 15 -1 '
-                    f'-add {timeseries_mc_Tmean} {timeseries_mc_ltr}')
-
-
-            for p, (postproc, ts) in enumerate(zip(
-                    ['no further processing',
-                     'after motion correction',
-                     'after motion correction and linear trend removal'],
-                    [timeseries, timeseries_mc, timeseries_mc_ltr])):
-
-                # calculate tSNR if not done already
-                pathTmean = f"{ts.split('.nii')[0]}_Tmean.nii.gz"
-                pathTstd = f"{ts.split('.nii')[0]}_Tstd.nii.gz"
-                pathTSNR = f"{ts.split('.nii')[0]}_tSNR.nii.gz"
-                if not os.path.exists(pathTmean) or overwrite:
-                    print('Creating mean of timeseries...')
-                    os.system(f'fslmaths {ts} -Tmean {pathTmean}')
-                if not os.path.exists(pathTstd) or overwrite:
-                    print('Creating std of timeseries...')
-                    os.system(f'fslmaths {ts} -Tstd {pathTstd}')
-                if not os.path.exists(pathTSNR) or overwrite:
-                    print('Calculating tSNR map...')
-                    os.system(f'fslmaths {pathTmean} -div {pathTstd} {pathTSNR}')
-
-
-                # get tSNR values
-                mask = f'{roi_dir}/V1_cortex.nii.gz'
-                tSNR_mean = float(os.popen(f'fslstats {pathTSNR} -k {mask} -m').read())
-                tSNR_std = float(os.popen(f'fslstats {pathTSNR} -k {mask} -s').read())
-
-                # store data
-                df = pd.concat([df, pd.DataFrame({
-                    'preproc': [preproc],
-                    'postproc': [postproc],
-                    'mean': [tSNR_mean],
-                    'std': [tSNR_std]})])
-
-        df.to_csv(f'{tsnr_dir}/tSNR_V1.csv', index=False)
-    else:
-        df = pd.read_csv(tsnr_path)
-        preprocs = df.preproc.unique()
-
-    # plots across scans and preprocessing
-    fig, axes = plt.subplots(3, 1, figsize=(7, 7), sharex=True)
-    for a, (pp, postproc) in enumerate(zip(
-            ['none', 'mc', 'mc_ltr'],
-            ['no further processing',
-             'after motion correction',
-             'after motion correction and linear trend removal'])):
-
-        ax = axes[a]
-        colors = list(mcolors.TABLEAU_COLORS)
-        for p, preproc in enumerate(df.preproc.unique()):
-            value = df['mean'][
-                (df['postproc'] == postproc) &
-                (df['preproc'] == preproc)]
-            error = df['std'][
-                (df['postproc'] == postproc) &
-                (df['preproc'] == preproc)]
-            ax.bar(p, value, yerr=error, color=colors[p])
-        if a == 2:
-            ax.set_xticks(range(len(preprocs)),
-                       labels=preprocs,
-                       ha="right", rotation=25)
-        ax.set_ylim((0, 64))
-        if a == 1:
-            ax.set_ylabel('tSNR')
-        ax.set_title(postproc)
-    plt.tight_layout()
-    plt.savefig(f'{tsnr_dir}/tSNR_V1.pdf')
-    plt.show()
-    plt.close()
+    preproc_dirs += [d for d in bids_index.glob('derivatives/**/ses-1/func',
+                                                recursive=True)
+                     if 'mriqc' not in d]
+
+
+    regions = list(regions)
+    masks = {region: f'{roi_dir}/{region}_cortex.nii.gz'
+             for region in regions}
+
+    # each variant in its own process, splitting the cores between them;
+    # results are read back from the store once all have finished
+    n_procs = n_procs or n_cores()
+    n_workers = max(1, min(len(preproc_dirs), n_procs))
+    print(f'measuring tSNR for {len(preproc_dirs)} preprocessing '
+          f'variants, {n_workers} at a time')
+    with ProcessPoolExecutor(
+            n_workers, mp_context=mp.get_context('spawn')) as pool:
+        futures = [pool.submit(_measure_variant, pp, preproc_dir, tsnr_dir,
+                               subject, masks, overwrite, save_stats,
+                               max(1, n_procs // n_workers))
+                   for pp, preproc_dir in enumerate(preproc_dirs)]
+        preprocs = [future.result() for future in futures]
+    df = results_store.query(
+        'tSNR', ['preproc', 'postproc', 'region', 'mean', 'std'],
+        subject=subject, preproc=preprocs, region=regions)
+    # back in the order measured, as the store returns rows in the order of
+    # its partition paths
+    order = {'preproc': preprocs, 'postproc': POSTPROCS}
+    df = df.sort_values(['preproc', 'postproc'], key=lambda column: column.map(
+        {value: i for i, value in enumerate(order[column.name])}))
+
+    # tables (tSNR_{region}.csv / .txt, written from the store for existing
+    # readers) and plots across scans and preprocessing, for each region
+    for region in regions:
+        df_region = df[df.region == region]
+        table = df_region[['preproc', 'postproc', 'mean', 'std']]
+        table.to_csv(f'{tsnr_dir}/tSNR_{region}.csv', index=False)
+        with open(f'{tsnr_dir}/tSNR_{region}.txt', 'w+') as c:
+            c.write(tabulate(table))
+
+        fig, axes = plt.subplots(3, 1, figsize=(7, 7), sharex=True)
+        for a, (pp, postproc) in enumerate(zip(
+                ['none', 'mc', 'mc_ltr'], POSTPROCS)):
+
+            ax = axes[a]
+            colors = list(mcolors.TABLEAU_COLORS)
+            for p, preproc in enumerate(df_region.preproc.unique()):
+                value = df_region['mean'][
+                    (df_region['postproc'] == postproc) &
+                    (df_region['preproc'] == preproc)]
+                error = df_region['std'][
+                    (df_region['postproc'] == postproc) &
+                    (df_region['preproc'] == preproc)]
+                ax.bar(p, value, yerr=error, color=colors[p])
+            if a == 2:
+                ax.set_xticks(range(len(preprocs)),
+                           labels=preprocs,
+                           ha="right", rotation=25)
+            ax.set_ylim((0, 64))
+            if a == 1:
+                ax.set_ylabel('tSNR')
+            ax.set_title(postproc)
+        plt.tight_layout()
+        plt.savefig(f'{tsnr_dir}/tSNR_{region}.pdf')
+        plt.show()
+        plt.close()
 
     # legend
     outpath = f'{tsnr_dir}/legend.pdf'
@@ -155,11 +206,6 @@ def measure_TSNR(overwrite):
         legend = plt.legend(handles, preprocs, loc=3)
         export_legend(legend, filename=outpath)
 
-    # viewable text version of table
-    txt_path = os.path.join(tsnr_dir, 'tSNR_V1.txt')
-    with open(txt_path, 'w+') as c:
-        c.write(tabulate(df))
-
         """
         # make histogram of tSNR values in cortical mask
         pathTSNR = f'{tsnr_dir}/tSNR.nii.gz'
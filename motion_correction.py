@@ -0,0 +1,135 @@
+"""
+content-addressed store of motion correction results
+
+mcflirt is run once per distinct input, identified by the hash of the
+timeseries' contents and the mcflirt options, however many stages (and
+however many links or copies of the file) ask for it. Each result holds the
+corrected timeseries, its motion parameters (.par) and its temporal mean,
+and is stored under derivatives/.artifacts/mcflirt/<hash>. Consumers get
+symlinks named as they expect. A lock per entry makes concurrent consumers
+wait for the first one rather than repeat the work.
+
+Long runs (at least 2 * CHUNK_VOLS volumes) are split into temporal chunks
+of CHUNK_VOLS volumes that are motion corrected in parallel, all against the
+volume mcflirt would use as its reference (the middle one), and then merged
+into one timeseries and .par file. Whether and how a run is chunked depends
+only on its length, never on the cores the caller has, so every consumer of
+a run gets the same store entry; n_procs only sets how many chunks are
+corrected at once.
+The chunks are hot intermediates, so are written uncompressed.
+"""
+
+import os
+import os.path as op
+import fcntl
+import hashlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from .build_cache import content_hash
+from .nifti_io import (nifti_path, n_volumes, iter_chunks, read_volumes,
+                       output_header, write_volumes, VolumeWriter)
+from .img_math import Img
+from .compression import HOT, FINAL, run_fsl, index_gzip
+
+STORE_DIR = 'derivatives/.artifacts/mcflirt'  # relative to the dataset root
+CHUNK_VOLS = 50
+_refreshed = set()  # entries recomputed by this process (overwrite=True)
+
+
+def _link(src, dst):
+    tmp = f'{dst}.{os.getpid()}.tmp'
+    os.symlink(op.abspath(src), tmp)
+    os.replace(tmp, dst)
+
+
+def _mcflirt(timeseries, out, options, role=FINAL):
+    status = run_fsl(f'mcflirt -in {timeseries} -out {out} -plots {options}',
+                     [out], role)
+    assert status == 0, f'mcflirt failed on {timeseries}'
+
+
+def _mcflirt_chunked(timeseries, out, options, chunk_vols, n_procs):
+
+    """
+    splits the run into temporal chunks of chunk_vols volumes, motion
+    corrects them (n_procs at a time) against the middle volume, and merges
+    the outputs into {out}.nii.gz and {out}.par
+    """
+
+    tmp = f'{out}_chunks'
+    os.makedirs(tmp)
+    n_vols = n_volumes(timeseries)
+    n_chunks = -(-n_vols // chunk_vols)
+    write_volumes(f'{tmp}/ref.nii', [read_volumes(timeseries, n_vols // 2)],
+                  output_header(timeseries, None))
+    chunks = [f'{tmp}/chunk{c}.nii' for c in range(n_chunks)]
+
+    # each chunk is read (from its seek point, if the input is an indexed
+    # .nii.gz) and corrected in its own thread
+    def correct(c):
+        start = c * chunk_vols
+        chunk = read_volumes(timeseries, start,
+                             min(chunk_vols, n_vols - start))
+        write_volumes(chunks[c], [chunk], output_header(
+            timeseries, chunk.shape[3], chunk.dtype))
+        _mcflirt(chunks[c], chunks[c][:-4] + '_mc',
+                 f'-reffile {tmp}/ref.nii {options}', HOT)
+
+    with ThreadPoolExecutor(max(1, min(n_procs, n_chunks))) as pool:
+        [future.result() for future in [pool.submit(correct, c)
+                                        for c in range(n_chunks)]]
+    with VolumeWriter(f'{out}.nii.gz', output_header(
+            f'{chunks[0][:-4]}_mc.nii', n_vols)) as writer, \
+            open(f'{out}.par', 'w') as par:
+        for path in chunks:
+            for chunk in iter_chunks(f'{path[:-4]}_mc.nii'):
+                writer.write(chunk)
+            with open(f'{path[:-4]}_mc.par') as f:
+                par.write(f.read())
+    shutil.rmtree(tmp)
+
+
+def motion_correct(timeseries, out_base, options='', overwrite=False,
+                   n_procs=1):
+
+    """
+    motion corrects timeseries (path with or without extension) and links
+    the results to {out_base}.nii.gz, {out_base}.par and
+    {out_base}_Tmean.nii.gz, which are returned. overwrite: recompute the
+    stored result (once per process). n_procs: chunks of a long run
+    corrected at once.
+    """
+
+    timeseries = nifti_path(timeseries)
+    chunked = n_volumes(timeseries) >= 2 * CHUNK_VOLS
+    if chunked and timeseries.endswith('.gz'):
+        index_gzip(timeseries)  # before hashing, as it rewrites the file
+    mode = f' chunks={CHUNK_VOLS}' if chunked else ''
+    key = hashlib.sha1(
+        f'{content_hash(timeseries)} {options}{mode}'.encode()).hexdigest()
+    entry = f'{STORE_DIR}/{key}'
+    os.makedirs(STORE_DIR, exist_ok=True)
+    with open(f'{entry}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if overwrite and key not in _refreshed and op.isdir(entry):
+            shutil.rmtree(entry)
+        if not op.isdir(entry):
+            print(f'Motion correcting {timeseries}...')
+            tmp = f'{entry}.tmp'
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            if chunked:
+                _mcflirt_chunked(op.abspath(timeseries), f'{tmp}/motcor',
+                                 options, CHUNK_VOLS, n_procs)
+            else:
+                _mcflirt(op.abspath(timeseries), f'{tmp}/motcor', options)
+            Img(f'{tmp}/motcor').tmean().write(f'{tmp}/motcor_Tmean.nii.gz')
+            os.rename(tmp, entry)
+            _refreshed.add(key)
+
+    outputs = [f'{out_base}.nii.gz', f'{out_base}.par',
+               f'{out_base}_Tmean.nii.gz']
+    for src, dst in zip([nifti_path(f'{entry}/motcor'), f'{entry}/motcor.par',
+                         f'{entry}/motcor_Tmean.nii.gz'], outputs):
+        _link(src, dst)
+    return outputs
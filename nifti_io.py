@@ -0,0 +1,358 @@
+"""
+chunked NIfTI-1 reading and writing shared by the in-process image modules
+
+Images are read in chunks of whole volumes (iter_chunks, iter_volumes) or in
+slabs of slices through all volumes (iter_slabs). Uncompressed images are
+memory-mapped; gzipped ones are read sequentially (or, for slabs,
+decompressed once to a temporary file) unless they have a seek-point index
+(see gzip_index), which read_volumes uses to read from any volume. Gzipped
+images without one are indexed by read_volumes on first use. Data
+keep their on-disk dtype unless a dtype is requested or the header scales
+them. Outputs are written incrementally, by volume (VolumeWriter) or by slab
+(SlabWriter), so memory use scales with the chunk size rather than the
+length of the run, and gzipped outputs are compressed in parallel (see
+compression).
+"""
+
+import os
+import os.path as op
+import glob
+import json
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+import nibabel as nib
+from .compression import ParallelGzipWriter, gzip_file, index_gzip
+from .gzip_index import open_gzip, decompress, move
+
+
+def nifti_path(path):
+
+    """ resolves a path given with or without its .nii / .nii.gz extension """
+
+    if op.isfile(path):
+        return path
+    paths = sorted(glob.glob(f'{path}.nii*'))
+    assert len(paths), f'no nifti found for {path}'
+    return paths[0]
+
+
+def _open(path, mode='rb'):
+    if not path.endswith('.gz'):
+        return open(path, mode)
+    return ParallelGzipWriter(path) if mode == 'wb' else open_gzip(path)
+
+
+def load_header(path):
+    with _open(nifti_path(path)) as f:
+        return nib.Nifti1Header.from_fileobj(f)
+
+
+def n_volumes(path):
+    shape = load_header(path).get_data_shape()
+    return shape[3] if len(shape) > 3 else 1
+
+
+def sidecar_tr(path):
+
+    """ RepetitionTime (s) from the BIDS json sidecar of an image """
+
+    with open(f'{path.split(".nii")[0]}.json') as f:
+        return float(json.load(f)['RepetitionTime'])
+
+
+def _shape4(header):
+    shape = header.get_data_shape()
+    return shape[:3] + ((shape[3] if len(shape) > 3 else 1),)
+
+
+def apply_scaling(data, header, dtype=None):
+
+    """ applies any scl_slope/inter; scaled data default to float32 """
+
+    slope, inter = header.get_slope_inter()
+    scale = slope is not None and (slope != 1 or inter != 0)
+    if dtype is None:
+        if not scale:
+            return np.asarray(data)
+        dtype = np.float32
+    data = np.asarray(data).astype(dtype)
+    if scale:
+        data = data * dtype(slope) + dtype(inter)
+    return data
+
+
+def open_memmap(path, mode='r'):
+
+    """ (header, 4D F-ordered memmap of the data) of an uncompressed image """
+
+    path = nifti_path(path)
+    assert not path.endswith('.gz'), f'cannot memory-map {path}'
+    header = load_header(path)
+    data = np.memmap(path, header.get_data_dtype(), mode,
+                     offset=int(header['vox_offset']), shape=_shape4(header),
+                     order='F')
+    return header, data
+
+
+@contextmanager
+def uncompressed(path):
+
+    """ path itself if uncompressed, else a temporary decompressed copy """
+
+    if not path.endswith('.gz'):
+        yield path
+        return
+    fd, tmp_path = tempfile.mkstemp(suffix='.nii', dir=op.dirname(path) or '.')
+    os.close(fd)
+    try:
+        decompress(path, tmp_path)
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
+
+
+def iter_chunks(path, chunk_vols=16, dtype=None):
+
+    """ yields 4D blocks of up to chunk_vols consecutive volumes """
+
+    path = nifti_path(path)
+    if not path.endswith('.gz'):
+        header, data = open_memmap(path)
+        for start in range(0, data.shape[3], chunk_vols):
+            yield apply_scaling(data[..., start:start + chunk_vols], header,
+                                dtype)
+        return
+    with _open(path) as f:
+        header = nib.Nifti1Header.from_fileobj(f)
+        shape = _shape4(header)
+        on_disk = header.get_data_dtype()
+        vol_bytes = int(np.prod(shape[:3])) * on_disk.itemsize
+        f.seek(int(header['vox_offset']))
+        for start in range(0, shape[3], chunk_vols):
+            n = min(chunk_vols, shape[3] - start)
+            chunk = np.frombuffer(f.read(n * vol_bytes), on_disk).reshape(
+                shape[:3] + (n,), order='F')
+            yield apply_scaling(chunk, header, dtype)
+
+
+def read_volumes(path, start, n_vols=1, dtype=None):
+
+    """
+    4D block of n_vols volumes from volume start, read without the volumes
+    before it (a gzipped image is indexed first, see compression.index_gzip)
+    """
+
+    path = nifti_path(path)
+    if path.endswith('.gz'):
+        index_gzip(path)
+    with _open(path) as f:
+        header = nib.Nifti1Header.from_fileobj(f)
+        shape = _shape4(header)
+        assert 0 <= start and start + n_vols <= shape[3], \
+            f'no volumes {start} to {start + n_vols - 1} in {path}'
+        on_disk = header.get_data_dtype()
+        vol_bytes = int(np.prod(shape[:3])) * on_disk.itemsize
+        f.seek(int(header['vox_offset']) + start * vol_bytes)
+        data = np.frombuffer(f.read(n_vols * vol_bytes), on_disk).reshape(
+            shape[:3] + (n_vols,), order='F')
+    return apply_scaling(data, header, dtype)
+
+
+def iter_volumes(path, dtype=None):
+
+    """ yields each 3D volume in turn """
+
+    for chunk in iter_chunks(path, 1, dtype):
+        yield chunk[..., 0]
+
+
+def iter_slabs(path, slab_size=8, dtype=None):
+
+    """
+    yields (slice, 4D block) for slabs of up to slab_size slices along the
+    third axis, each holding all volumes (e.g. for filtering along time)
+    """
+
+    with uncompressed(nifti_path(path)) as path:
+        header, data = open_memmap(path)
+        for start in range(0, data.shape[2], slab_size):
+            z = slice(start, min(start + slab_size, data.shape[2]))
+            yield z, apply_scaling(data[:, :, z], header, dtype)
+
+
+def load_data(path, dtype=np.float32):
+
+    """
+    whole image as an array of dtype, filled chunk by chunk so that no
+    intermediate copy (e.g. float64) of the whole image is made
+    """
+
+    header = load_header(path)
+    shape = header.get_data_shape()
+    data = np.empty(_shape4(header), dtype)
+    start = 0
+    for chunk in iter_chunks(path, dtype=dtype):
+        data[..., start:start + chunk.shape[3]] = chunk
+        start += chunk.shape[3]
+    return data.reshape(shape, order='F')
+
+
+def output_header(template, n_vols, dtype=np.float32):
+
+    """
+    header for a new single-file image with the geometry (affines, voxel
+    sizes, units, TR) of template, a path or Nifti1Header. n_vols=None gives
+    a 3D image.
+    """
+
+    if not isinstance(template, nib.Nifti1Header):
+        template = load_header(template)
+    header = nib.Nifti1Header()
+    for field in ['pixdim', 'xyzt_units', 'dim_info', 'qform_code',
+                  'sform_code', 'quatern_b', 'quatern_c', 'quatern_d',
+                  'qoffset_x', 'qoffset_y', 'qoffset_z', 'srow_x', 'srow_y',
+                  'srow_z', 'slice_code', 'slice_start', 'slice_end',
+                  'slice_duration', 'toffset', 'descrip']:
+        header[field] = template[field]
+    header.set_data_shape(template.get_data_shape()[:3] + (
+        (n_vols,) if n_vols else ()))
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(1, 0)
+    header['vox_offset'] = 352
+    return header
+
+
+class VolumeWriter:
+
+    """
+    writes a single-file NIfTI incrementally, a volume (3D) or a chunk of
+    consecutive volumes (4D) at a time:
+
+        with VolumeWriter(path, header) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    """
+
+    def __init__(self, path, header):
+        self.path, self.header = path, header
+        self.dtype = header.get_data_dtype()
+        shape = header.get_data_shape()
+        self.n_vols = shape[3] if len(shape) > 3 else 1
+        self.n_written = 0
+        self.f = _open(path, 'wb')
+        self.f.write(header.binaryblock)
+        self.f.write(b'\x00' * (int(header['vox_offset']) - len(
+            header.binaryblock)))  # no extensions
+
+    def write(self, data):
+        data = np.asarray(data, self.dtype)
+        self.f.write(data.tobytes(order='F'))
+        self.n_written += data.shape[3] if data.ndim > 3 else 1
+
+    def close(self):
+        self.f.close()
+        assert self.n_written == self.n_vols, \
+            f'{self.path}: wrote {self.n_written} of {self.n_vols} volumes'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+
+
+class SlabWriter:
+
+    """
+    writes a single-file NIfTI a slab of slices (through all volumes) at a
+    time, into a memory-mapped file. Gzipped outputs are written to a
+    temporary uncompressed file and compressed on close.
+
+        with SlabWriter(path, header) as writer:
+            for z, slab in iter_slabs(in_path):
+                writer.write(z, f(slab))
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        self.tmp_path = f'{path[:-7]}.tmp{os.getpid()}.nii' \
+            if path.endswith('.gz') else path
+        shape = _shape4(header)
+        vox_offset = int(header['vox_offset'])
+        with open(self.tmp_path, 'wb') as f:
+            f.write(header.binaryblock)
+            f.truncate(vox_offset + int(np.prod(shape)) *
+                       header.get_data_dtype().itemsize)  # zero-filled
+        self.data = np.memmap(self.tmp_path, header.get_data_dtype(), 'r+',
+                              offset=vox_offset, shape=shape, order='F')
+
+    def write(self, z, slab):
+        self.data[:, :, z] = slab
+
+    def close(self):
+        self.data.flush()
+        del self.data
+        if self.tmp_path != self.path:
+            gzip_file(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self.tmp_path != self.path:
+            del self.data
+            os.remove(self.tmp_path)
+
+
+def write_volumes(path, volumes, header):
+
+    """ writes an iterable of volumes (or chunks) behind header """
+
+    with VolumeWriter(path, header) as writer:
+        for volume in volumes:
+            writer.write(volume)
+
+
+def trim_volumes(path, n_vols, tr=None, out_path=None):
+
+    """
+    keeps the first n_vols volumes of a 4D image and optionally sets its TR
+    (seconds). An uncompressed image trimmed in place only has its header
+    rewritten and the file truncated; otherwise the header and the kept
+    volumes are streamed to out_path (default: path, replaced atomically).
+    """
+
+    path = nifti_path(path)
+    out_path = out_path or path
+    header = load_header(path)
+    shape = header.get_data_shape()
+    assert len(shape) == 4 and 0 < n_vols <= shape[3], \
+        f'cannot keep {n_vols} volumes of {path} {shape}'
+    header.set_data_shape(shape[:3] + (n_vols,))
+    if tr is not None:
+        scale = {'msec': 1e3, 'usec': 1e6}.get(header.get_xyzt_units()[1], 1)
+        header['pixdim'][4] = tr * scale
+    vox_offset = int(header['vox_offset'])
+    vol_bytes = int(np.prod(shape[:3])) * header.get_data_dtype().itemsize
+
+    if out_path == path and not path.endswith('.gz'):
+        with open(path, 'r+b') as f:
+            f.write(header.binaryblock)
+            f.truncate(vox_offset + n_vols * vol_bytes)
+        return
+
+    tmp_path = f'{out_path}.tmp{os.getpid()}' + (
+        '.gz' if out_path.endswith('.gz') else '')
+    with _open(path) as f_in, _open(tmp_path, 'wb') as f_out:
+        # header, then any extensions as they are
+        f_out.write(header.binaryblock)
+        f_out.write(f_in.read(vox_offset)[len(header.binaryblock):])
+        for _ in range(n_vols):
+            f_out.write(f_in.read(vol_bytes))
+    move(tmp_path, out_path)
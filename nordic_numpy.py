@@ -0,0 +1,222 @@
+"""
+NumPy implementation of NORDIC denoising (Vizioli et al., 2021,
+https://www.nature.com/articles/s41467-021-25431-8), following the steps of
+NIFTI_NORDIC from the NORDIC_Raw MATLAB package:
+
+1. combine magnitude and phase into complex data
+2. remove the slowly varying phase (k-space Hann filter per slice/volume)
+3. estimate a g-factor (spatial noise) map from locally low-rank patches and
+   divide it out, so that the noise is spatially uniform
+4. measure the noise level from the noise volume(s), if acquired
+5. locally low-rank denoising: singular values of each patch's Casorati
+   matrix (voxels x volumes) below the noise threshold are zeroed, and
+   overlapping patches are averaged
+
+Patches are processed in batches with np.linalg.svd over stacked Casorati
+matrices, one row of patches per task, in a thread pool (LAPACK releases
+the GIL). The same arg keys as NIFTI_NORDIC are supported:
+phase_filter_width, noise_volume_last and use_magn_for_gfactor.
+"""
+
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+from .resources import n_cores
+from .nifti_io import nifti_path, load_data, output_header, VolumeWriter
+
+
+def _rescale_phase(phase):
+
+    """ maps phase from its stored range (e.g. scanner units) to [-pi, pi) """
+
+    lo, hi = phase.min(), phase.max()
+    if hi - lo == 0:
+        return np.zeros_like(phase)
+    return ((phase - lo) / (hi - lo) - .5) * 2 * np.pi
+
+
+def _phase_filter(data, width):
+
+    """
+    low-pass filtered version of each 2D slice of each volume, using a Hann
+    (tukeywin(n, 1)) k-space window raised to the power of width
+    """
+
+    nx, ny = data.shape[:2]
+    window = (np.hanning(nx)[:, None] ** width *
+              np.hanning(ny)[None, :] ** width).astype(np.float32)
+    window = window.reshape(nx, ny, *[1] * (data.ndim - 2))
+    ksp = np.fft.fftshift(np.fft.fft2(data, axes=(0, 1)), axes=(0, 1))
+    return np.fft.ifft2(np.fft.ifftshift(ksp * window, axes=(0, 1)),
+                        axes=(0, 1)).astype(data.dtype)
+
+
+def _patch_starts(dim, size):
+
+    """ start indices of half-overlapping patches covering the whole axis """
+
+    step = max(size // 2, 1)
+    starts = list(range(0, dim - size + 1, step))
+    if starts[-1] != dim - size:
+        starts.append(dim - size)
+    return np.array(starts)
+
+
+def _llr_row(data, kernel, x, z, starts_y, func):
+
+    """
+    applies func to the stacked Casorati matrices (n_patches, voxels, vols) of
+    the row of patches starting at x, z, returning its output per patch
+    """
+
+    kx, ky, kz = kernel
+    block = data[x:x + kx, :, z:z + kz]
+    windows = sliding_window_view(block, ky, axis=1)[:, starts_y]
+    # (kx, ny, kz, T, ky) -> (ny, kx, ky, kz, T)
+    casorati = windows.transpose(1, 0, 4, 2, 3).reshape(
+        len(starts_y), kx * ky * kz, data.shape[3])
+    return func(np.ascontiguousarray(casorati))
+
+
+def _llr(data, kernel, func, n_procs, out_vols):
+
+    """
+    runs func over all patches and averages the overlapping patch outputs.
+    func maps (n_patches, voxels, vols) to (n_patches, voxels, out_vols).
+    """
+
+    kx, ky, kz = kernel
+    starts_x = _patch_starts(data.shape[0], kx)
+    starts_y = _patch_starts(data.shape[1], ky)
+    starts_z = _patch_starts(data.shape[2], kz)
+    out = np.zeros(data.shape[:3] + (out_vols,), dtype=np.result_type(
+        data.dtype, np.float32))
+    weights = np.zeros(data.shape[:3], dtype=np.float32)
+
+    def add(x, z, future):
+        patches = future.result().reshape(len(starts_y), kx, ky, kz, out_vols)
+        for j, y in enumerate(starts_y):
+            out[x:x + kx, y:y + ky, z:z + kz] += patches[j]
+            weights[x:x + kx, y:y + ky, z:z + kz] += 1
+
+    # rows are added in order, with at most 2 * n_procs pending, so that
+    # finished rows do not pile up in memory behind a slow one
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=n_procs) as pool:
+        for z in starts_z:
+            for x in starts_x:
+                pending.append((x, z, pool.submit(
+                    _llr_row, data, kernel, x, z, starts_y, func)))
+                if len(pending) > 2 * n_procs:
+                    add(*pending.popleft())
+        while pending:
+            add(*pending.popleft())
+    return out / weights[..., None]
+
+
+def _noise_threshold(n_voxels, n_vols, n_iter=10, seed=0):
+
+    """
+    mean largest singular value of unit-variance Gaussian noise matrices of
+    the patch size, as in NIFTI_NORDIC
+    """
+
+    rng = np.random.default_rng(seed)
+    noise = rng.standard_normal((n_iter, n_voxels, n_vols), dtype=np.float32)
+    return float(np.linalg.svd(noise, compute_uv=False)[:, 0].mean())
+
+
+def _gfactor(data, kernel, n_procs):
+
+    """
+    spatial noise map: the noise level of each patch is estimated from its
+    smallest singular value, s_min ~ sigma * (sqrt(voxels) - sqrt(vols))
+    """
+
+    n_voxels = int(np.prod(kernel))
+    n_vols = data.shape[3]
+    scale = max(np.sqrt(n_voxels) - np.sqrt(n_vols), 1)
+
+    def patch_noise(casorati):
+        s = np.linalg.svd(casorati, compute_uv=False)
+        sigma = (s[:, -1] / scale).astype(np.float32)
+        return np.broadcast_to(sigma[:, None, None],
+                               (len(sigma), n_voxels, 1))
+
+    gfactor = _llr(data, kernel, patch_noise, n_procs, 1)[..., 0].real
+    gfactor[gfactor <= 0] = gfactor[gfactor > 0].min() if \
+        np.any(gfactor > 0) else 1
+    return gfactor
+
+
+def NIFTI_NORDIC(mag_path, phase_path, out_path, arg, n_procs=None,
+                 dtype=np.float32):
+
+    """
+    denoises a magnitude/phase timeseries and writes the denoised magnitude
+    to {out_path}.nii (float32, same geometry and length as the input).
+    arg: dict with the NIFTI_NORDIC keys phase_filter_width (default 10),
+        noise_volume_last (number of noise volumes at the end, default 0) and
+        use_magn_for_gfactor (estimate the g-factor from magnitude only).
+    """
+
+    n_procs = n_procs or n_cores()
+    complex_dtype = np.result_type(dtype, np.complex64)
+    mag_path = nifti_path(mag_path)
+    mag = load_data(mag_path, dtype)
+    if mag.ndim == 3:
+        mag = mag[..., None]
+    n_noise = int(arg.get('noise_volume_last', 0))
+
+    # complex data
+    if phase_path is not None:
+        phase = load_data(nifti_path(phase_path), dtype)
+        if phase.ndim == 3:
+            phase = phase[..., None]
+        data = (mag * np.exp(1j * _rescale_phase(phase))).astype(
+            complex_dtype)
+        del phase
+        width = float(arg.get('phase_filter_width', 10.))
+        if width > 0:
+            data *= np.exp(-1j * np.angle(_phase_filter(data, width)))
+    else:
+        data = mag.astype(complex_dtype)
+
+    # kernel with an 11:1 ratio of voxels to volumes, as in NIFTI_NORDIC
+    n_vols = data.shape[3]
+    size = int(round((11 * n_vols) ** (1 / 3)))
+    kernel = tuple(min(size, dim) for dim in data.shape[:3])
+
+    # g-factor from (up to) the first 90 signal volumes
+    signal = data[..., :n_vols - n_noise][..., :90]
+    if arg.get('use_magn_for_gfactor', 0):
+        signal = np.abs(signal).astype(dtype)
+    gfactor = _gfactor(signal, kernel, n_procs)
+    del signal
+    data /= gfactor[..., None]
+
+    # noise level, measured from the noise volume(s) if available
+    if n_noise:
+        noise = data[..., -n_noise:]
+        noise_level = float(np.std(noise[noise != 0]))
+    else:
+        noise_level = 1.
+
+    # locally low-rank denoising
+    threshold = _noise_threshold(int(np.prod(kernel)), n_vols) * noise_level
+
+    def denoise(casorati):
+        u, s, vh = np.linalg.svd(casorati, full_matrices=False)
+        s[s < threshold] = 0
+        return np.matmul(u * s[:, None, :].astype(u.dtype), vh)
+
+    denoised = _llr(data, kernel, denoise, n_procs, n_vols)
+    del data
+
+    # magnitude output (the phase removed above does not affect |x|)
+    out = (np.abs(denoised) * gfactor[..., None]).astype(np.float32)
+    out_path = out_path.split('.nii')[0]
+    with VolumeWriter(f'{out_path}.nii', output_header(
+            mag_path, n_vols if n_vols > 1 else None)) as writer:
+        writer.write(out)
@@ -11,39 +11,131 @@ import glob
 from utils import (
     seconds_to_text,
     initialise_BIDS,
-    preprocess,
-    registration,
     make_ROIs,
     measure_TSNR)
+from utils.test_NORDIC import test_NORDIC
+from utils.preprocess import run_mriqc, run_fmriprep, convert_anatomicals
+from utils.registration import (
+    registration_anat_std, registration_func_anat, registration_func_std)
+from utils.scheduler import stage, run_stages
+from utils.resources import total_memory_gb
+from utils import tracing
 
-# get master scripts
-for script in [
-    'seconds_to_text', 'plot_utils', 'get_wang_atlas', 'run_NORDIC',
-    'apply_topup', 'philips_slice_timing', 'make_anat_slices', 'make_3D_brain']:
-    dst = f'utils/{script}.py'
-    if not op.exists(dst):
-        srcs = glob.glob(op.expanduser(f'~/david/master_scripts/*/{script}.py'))
-        assert len(srcs) == 1
-        src = srcs[0]
-        os.system(f'ln -s {src} {dst}')
+def get_master_scripts():
+
+    """
+    links missing master scripts into utils. Only called from the main
+    process: spawned workers re-import this module from the data directory.
+    """
+
+    utils_dir = op.join(op.dirname(op.abspath(__file__)), 'utils')
+    for script in [
+        'seconds_to_text', 'plot_utils', 'get_wang_atlas', 'run_NORDIC',
+        'apply_topup', 'philips_slice_timing', 'make_anat_slices',
+        'make_3D_brain']:
+        dst = f'{utils_dir}/{script}.py'
+        if not op.exists(dst):
+            srcs = glob.glob(
+                op.expanduser(f'~/david/master_scripts/*/{script}.py'))
+            assert len(srcs) == 1
+            src = srcs[0]
+            os.system(f'ln -s {src} {dst}')
 
 
 if __name__ == "__main__":
 
+    get_master_scripts()
     os.chdir('../data/v10')
     #time.sleep(10000)
     n_procs = 8
+    mem_gb = total_memory_gb() * .9  # leave 10% free
     start = time.time()
-    """
-    initialise_BIDS()
-
-    preprocess(n_procs)
 
-    registration(overwrite=[])
+    # each stage declares the files it reads and writes; stages that do not
+    # depend on each other run at the same time within the n_procs budget
+    subject = 'M001'
+    func_dir = f'sub-{subject}/ses-1/func'
+    fs_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subject}'
+    fnirt_dir = f'{fs_dir}/mri/transforms/fnirt'
+    reg_dir = f'derivatives/registration/sub-{subject}'
+    nordic_dirs = [f'derivatives/NORDIC_mag-{m}_phase-{p}_noise-{n}'
+                   for m in ['meas', 'calc'] for p in ['meas', 'calc']
+                   for n in ['vol', 'est']]
+    stages = [
+        stage('initialise_BIDS', initialise_BIDS, args=[n_procs],
+              n_procs=n_procs,
+              inputs=['sourcedata', 'participants.json'],
+              outputs=[f'sub-{subject}']),
+        # test_NORDIC runs alongside fmriprep, so it gets the other half
+        stage('test_NORDIC', test_NORDIC, args=['matlab', n_procs // 2],
+              n_procs=n_procs // 2,
+              inputs=[func_dir],
+              outputs=nordic_dirs),
+        # mriqc and fmriprep run side by side, so each gets half the cores
+        # and half the memory
+        stage('mriqc', run_mriqc, args=[n_procs // 2, mem_gb / 2],
+              n_procs=n_procs // 2,
+              inputs=nordic_dirs + [f'sub-{subject}'],
+              outputs=['derivatives/mriqc-23.1.0']),
+        stage('fmriprep', run_fmriprep, args=[n_procs // 2, mem_gb / 2],
+              n_procs=n_procs // 2,
+              inputs=[f'sub-{subject}/ses-1/anat'],
+              outputs=['derivatives/fmriprep-23.0.2', fs_dir]),
+        stage('convert_anatomicals', convert_anatomicals,
+              inputs=[f'{fs_dir}/mri/T1.mgz', f'{fs_dir}/mri/orig/001.mgz'],
+              outputs=[f'{fs_dir}/mri/orig/001.nii',
+                       f'{fs_dir}/mri/orig/001_brain.nii.gz']),
+        stage('registration_anat_std', registration_anat_std, args=[[]],
+              inputs=[f'{fs_dir}/mri/orig/001.nii',
+                      f'{fs_dir}/mri/orig/001_brain.nii.gz'],
+              outputs=[f'{fs_dir}/mri/transforms/reg.mni152.2mm.lta',
+                       fnirt_dir,
+                       f'{reg_dir}/highres2standard.png']),
+        stage('registration_func_anat', registration_func_anat,
+              args=[[], n_procs // 2], n_procs=n_procs // 2,
+              inputs=[func_dir, f'{fs_dir}/mri/orig/001.nii'],
+              outputs=[f'{reg_dir}/example_func2highres.mat',
+                       f'{reg_dir}/highres2example_func.mat',
+                       f'{reg_dir}/example_func2highres.png'],
+              after=['test_NORDIC']),  # test_NORDIC renames func files
+        stage('registration_func_std', registration_func_std, args=[[]],
+              inputs=[f'{reg_dir}/example_func2highres.mat',
+                      f'{reg_dir}/highres2example_func.mat', fnirt_dir],
+              outputs=[f'{reg_dir}/example_func2standard_warp.nii.gz',
+                       f'{reg_dir}/standard2example_func_warp.nii.gz',
+                       'derivatives/registration/plots']),
+        stage('make_ROIs', make_ROIs, args=[False],
+              inputs=[f'{reg_dir}/highres2example_func.mat',
+                      f'{reg_dir}/standard2example_func_warp.nii.gz',
+                      f'{fs_dir}/mri/lh.ribbon.mgz',
+                      f'{fs_dir}/mri/rh.ribbon.mgz'],
+              outputs=[f'derivatives/ROIs/sub-{subject}']),
+        stage('measure_TSNR', measure_TSNR, args=[False],
+              inputs=nordic_dirs + [func_dir,
+                                    f'derivatives/ROIs/sub-{subject}'],
+              outputs=['derivatives/tSNR']),
+    ]
 
-    make_ROIs(overwrite=False)
-    """
-    measure_TSNR(overwrite=False)
+    # comment out stages to skip them (their outputs are assumed to exist)
+    targets = [
+        #'initialise_BIDS',
+        #'test_NORDIC',
+        #'mriqc',
+        #'fmriprep',
+        #'convert_anatomicals',
+        #'registration_anat_std',
+        #'registration_func_anat',
+        #'registration_func_std',
+        #'make_ROIs',
+        'measure_TSNR',
+    ]
+    # every stage and command is recorded in derivatives/logs/trace/<run>
+    run_dir = tracing.start_run()
+    try:
+        run_stages(stages, n_procs, targets)
+    finally:
+        print(tracing.finish_run())
+        print(f'trace and summary saved to {run_dir}')
 
     finish = time.time()
     print(f'analysis took {seconds_to_text(finish - start)} to complete')
@@ -6,44 +6,63 @@ import glob
 import datetime
 import nighres
 import os.path as op
-import subprocess
 import itertools
+from . import build_cache
+from .motion_correction import motion_correct
+from . import tracing
 
-def registration(overwrite):
+def _paths():
+
+    """ directories and reference images shared by the registration steps """
 
-    print('Performing registration...')
     subject, session = 'M001', '1'
     fs_subject = f'sub-{subject}'
-
-    # directories
     fs_dir = f'{os.environ["SUBJECTS_DIR"]}/{fs_subject}'
-    xform_dir = f'{fs_dir}/mri/transforms'
-    fnirt_dir = f'{fs_dir}/mri/transforms/fnirt'
+    ref_std = f'{os.environ["FSLDIR"]}/data/standard/MNI152_T1_2mm.nii.gz'
+    return dict(
+        subject=subject,
+        fs_subject=fs_subject,
+        fs_dir=fs_dir,
+        xform_dir=f'{fs_dir}/mri/transforms',
+        fnirt_dir=f'{fs_dir}/mri/transforms/fnirt',
+        reg_dir=f'derivatives/registration/sub-{subject}',
+        ref_func=(f'sub-{subject}/ses-{session}/func/sub-'
+                  f'{subject}_ses-{session}_task-restingState_run-1_part'
+                  f'-mag_bold_motcor_Tmean.nii.gz'),
+        ref_anat=f'{fs_dir}/mri/orig/001.nii',
+        ref_anat_brain=f'{fs_dir}/mri/orig/001_brain.nii.gz',
+        ref_std=ref_std,
+        ref_std_brain=f'{ref_std[:-7]}_brain.nii.gz',
+        ref_std_mask=f'{ref_std[:-7]}_brain_mask_dil.nii.gz')
+
+
+def registration(overwrite):
+
+    print('Performing registration...')
+    registration_anat_std(overwrite)
+    registration_func_anat(overwrite)
+    registration_func_std(overwrite)
+
+
+def registration_anat_std(overwrite):
+
+    p = _paths()
+    fs_subject, xform_dir, fnirt_dir, reg_dir = (
+        p['fs_subject'], p['xform_dir'], p['fnirt_dir'], p['reg_dir'])
+    ref_anat, ref_anat_brain = p['ref_anat'], p['ref_anat_brain']
+    ref_std, ref_std_brain, ref_std_mask = (
+        p['ref_std'], p['ref_std_brain'], p['ref_std_mask'])
     os.makedirs(fnirt_dir, exist_ok=True)
-    reg_dir = f'derivatives/registration/sub-{subject}'
     os.makedirs(reg_dir, exist_ok=True)
 
-    # reference images
-    ref_func = (f'sub-{subject}/ses-{session}/func/sub-'
-                f'{subject}_ses-{session}_task-restingState_run-1_part'
-                f'-mag_bold_motcor_Tmean.nii.gz')
-    if not op.isfile(ref_func):
-        ref_base = ref_func.split("_motcor")[0]
-        os.system(f'mcflirt -in {ref_base} -out {ref_base}_motcor')
-        os.system(f'fslmaths {ref_base}_motcor -Tmean {ref_func}')
-    ref_anat = f'{fs_dir}/mri/orig/001.nii'
-    ref_anat_brain = f'{fs_dir}/mri/orig/001_brain.nii.gz'
-    ref_std = f'{os.environ["FSLDIR"]}/data/standard/MNI152_T1_2mm.nii.gz'
-    ref_std_brain = f'{ref_std[:-7]}_brain.nii.gz'
-    ref_std_mask = f'{ref_std[:-7]}_brain_mask_dil.nii.gz'
-
     # transform 1: between standard space and anatomical space
     # this is all done in subject's freesurfer directory
 
     # freesurfer method
     standard2highres_lta = f'{xform_dir}/reg.mni152.2mm.lta'
-    if not op.isfile(standard2highres_lta):
-        os.system(f'mni152reg --s {fs_subject}')
+    build_cache.run(f'mni152reg --s {fs_subject}',
+                    outputs=[standard2highres_lta],
+                    inputs=[f'{p["fs_dir"]}/mri/orig.mgz'])
 
     # FSL method
 
@@ -57,56 +76,73 @@ def registration(overwrite):
 
     # linear
     highres2standard = f'{fnirt_dir}/highres2standard.mat'
-    if not op.isfile(highres2standard) or 'anat_std' in overwrite:
-        os.system(f'flirt '
-                  f'-in {ref_anat} '
-                  f'-ref {ref_std} '
-                  f'-omat {highres2standard} '
-                  f'-cost corratio '
-                  f'-dof 12 '
-                  f'-searchrx -90 90 '
-                  f'-searchry -90 90 '
-                  f'-searchrz -90 90 '
-                  f'-interp trilinear')
+    build_cache.run(f'flirt '
+                    f'-in {ref_anat} '
+                    f'-ref {ref_std} '
+                    f'-omat {highres2standard} '
+                    f'-cost corratio '
+                    f'-dof 12 '
+                    f'-searchrx -90 90 '
+                    f'-searchry -90 90 '
+                    f'-searchrz -90 90 '
+                    f'-interp trilinear',
+                    outputs=[highres2standard],
+                    inputs=[ref_anat, ref_std],
+                    force='anat_std' in overwrite)
     standard2highres = f'{fnirt_dir}/standard2highres.mat'
-    if not op.isfile(standard2highres) or 'anat_std' in overwrite:
-        os.system(f'convert_xfm -inverse '
-                  f'-omat {standard2highres} '
-                  f'{highres2standard}')
+    build_cache.run(f'convert_xfm -inverse '
+                    f'-omat {standard2highres} '
+                    f'{highres2standard}',
+                    outputs=[standard2highres],
+                    inputs=[highres2standard],
+                    force='anat_std' in overwrite)
 
     # non-linear
     highres2standard_warp = f'{fnirt_dir}/highres2standard_warp.nii.gz'
-    if not op.isfile(highres2standard_warp) or 'anat_std' in overwrite:
-        os.system(f'fnirt '
-                  f'--in={ref_anat} '
-                  f'--ref={ref_std} '
-                  f'--refmask={ref_std_mask} '
-                  f'--config=T1_2_MNI152_2mm '
-                  f'--aff={highres2standard} '
-                  f'--cout={highres2standard_warp} '
-                  f'--iout={fnirt_dir}/highres2standard_head '
-                  f'--jout={fnirt_dir}/highres2highres_jac '
-                  f'--warpres=10,10,10')
+    build_cache.run(f'fnirt '
+                    f'--in={ref_anat} '
+                    f'--ref={ref_std} '
+                    f'--refmask={ref_std_mask} '
+                    f'--config=T1_2_MNI152_2mm '
+                    f'--aff={highres2standard} '
+                    f'--cout={highres2standard_warp} '
+                    f'--iout={fnirt_dir}/highres2standard_head '
+                    f'--jout={fnirt_dir}/highres2highres_jac '
+                    f'--warpres=10,10,10',
+                    outputs=[highres2standard_warp],
+                    inputs=[ref_anat, ref_std, ref_std_mask, highres2standard],
+                    force='anat_std' in overwrite,
+                    fsl_images=[highres2standard_warp,
+                                f'{fnirt_dir}/highres2standard_head',
+                                f'{fnirt_dir}/highres2highres_jac'])
     standard2highres_warp = f'{fnirt_dir}/standard2highres_warp.nii.gz'
-    if not op.isfile(standard2highres_warp) or 'anat_std' in overwrite:
-        os.system(f'invwarp '
-                  f'-w {highres2standard_warp} '
-                  f'-o {standard2highres_warp} '
-                  f'-r {ref_anat}')
+    build_cache.run(f'invwarp '
+                    f'-w {highres2standard_warp} '
+                    f'-o {standard2highres_warp} '
+                    f'-r {ref_anat}',
+                    outputs=[standard2highres_warp],
+                    inputs=[highres2standard_warp, ref_anat],
+                    force='anat_std' in overwrite,
+                    fsl_images=[standard2highres_warp])
 
     # apply transform to ref anat
     highres2standard_img = f'{fnirt_dir}/highres2standard.nii.gz'
-    if not op.isfile(highres2standard_img) or 'anat_std' in overwrite:
-        os.system(f'applywarp '
-                  f'-i {ref_anat_brain} '
-                  f'-r {ref_std_brain} '
-                  f'-o {highres2standard_img} '
-                  f'-w {highres2standard_warp}')
+    build_cache.run(f'applywarp '
+                    f'-i {ref_anat_brain} '
+                    f'-r {ref_std_brain} '
+                    f'-o {highres2standard_img} '
+                    f'-w {highres2standard_warp}',
+                    outputs=[highres2standard_img],
+                    inputs=[ref_anat_brain, ref_std_brain,
+                            highres2standard_warp],
+                    force='anat_std' in overwrite,
+                    fsl_images=[highres2standard_img])
 
     # make reg images
     d = fnirt_dir
-    if not op.isfile(
-            f'{d}/highres2standard.png') or 'anat_std' in overwrite:
+    png = f'{d}/highres2standard.png'
+    if build_cache.needs_update([png], inputs=[highres2standard_img]) or \
+            'anat_std' in overwrite:
         slicer_str = (
             f'-x 0.35 {d}/sla.png -x 0.45 {d}/slb.png '
             f'-x 0.55 {d}/slc.png -x 0.65 {d}/sld.png '
@@ -116,21 +152,16 @@ def registration(overwrite):
             f'-z 0.55 {d}/slk.png -z 0.65 {d}/sll.png')
         append_str = ' + '.join([f'{d}/sl{i}.png' for i in 'abcdefghijkl'])
 
-        cmd = f'slicer {d}/highres2standard {d}/standard -s 2 {slicer_str}'
-        subprocess.Popen(cmd.split()).wait()
-
-        cmd = f'pngappend {append_str} {d}/highres2standard1.png'
-        subprocess.Popen(cmd.split()).wait()
-
-        cmd = f'slicer {d}/standard {d}/highres2standard -s 2 {slicer_str}'
-        subprocess.Popen(cmd.split()).wait()
-
-        cmd = f'pngappend {append_str} {d}/highres2standard2.png'
-        subprocess.Popen(cmd.split()).wait()
-
-        cmd = (f'pngappend {d}/highres2standard1.png - '
-               f'{d}/highres2standard2.png {d}/highres2standard.png')
-        subprocess.Popen(cmd.split()).wait()
+        cmds = [
+            f'slicer {d}/highres2standard {d}/standard -s 2 {slicer_str}',
+            f'pngappend {append_str} {d}/highres2standard1.png',
+            f'slicer {d}/standard {d}/highres2standard -s 2 {slicer_str}',
+            f'pngappend {append_str} {d}/highres2standard2.png',
+            f'pngappend {d}/highres2standard1.png - '
+            f'{d}/highres2standard2.png {d}/highres2standard.png',
+        ]
+        if all(tracing.run(cmd) == 0 for cmd in cmds):
+            build_cache.record([png], inputs=[highres2standard_img])
 
     # clean up
     for search in ['*1.png', '*2.png', 'sl?.png']:
@@ -145,6 +176,29 @@ def registration(overwrite):
         if not op.exists(outpath):
             os.system(f'ln -s {path} {outpath}')
 
+
+def registration_func_anat(overwrite, n_procs=1):
+
+    p = _paths()
+    fs_subject, reg_dir = p['fs_subject'], p['reg_dir']
+    ref_func, ref_anat, ref_anat_brain = (
+        p['ref_func'], p['ref_anat'], p['ref_anat_brain'])
+    os.makedirs(reg_dir, exist_ok=True)
+
+    # reference func image, the Tmean of the motion corrected run (shared
+    # with measure_TSNR via the motion correction store). test_NORDIC
+    # renames the raw run to acq-meas.
+    ref_base = ref_func.split("_motcor")[0]
+    ref_raw = glob.glob(f'{ref_base}.nii*') or glob.glob(
+        f'{ref_base.replace("run-1", "acq-meas")}.nii*')
+    assert len(ref_raw), f'no raw data found for {ref_base}'
+    motion_correct(ref_raw[0], f'{ref_base}_motcor', n_procs=n_procs)
+
+    # link to highres (also linked via fnirt dir by registration_anat_std)
+    out_path = f'{reg_dir}/highres.nii.gz'
+    if not op.exists(out_path):
+        os.system(f'ln -s {ref_anat} {out_path}')
+
     # transform 2: between anatomical space and functional space
     method = 'freesurfer'# 'FSL'
 
@@ -156,74 +210,89 @@ def registration(overwrite):
     if method == 'FSL':
 
         example_func2highres = f'{reg_dir}/example_func2highres.mat'
-        if not op.isfile(example_func2highres) or 'func_anat' in overwrite:
-            # BBR
-            os.system(
-                f'epi_reg '
-                f'--epi={ref_func} '
-                f'--t1={ref_anat} '
-                f'--t1brain='
-                f'{ref_anat_brain} '
-                f'--out={example_func2highres[:-4]}')
-
-            # linear search
-            # os.system(f'flirt -in {ref_anat_brain} -ref {ref_func}
-            #     -omat {highres2example_func}')
+        # BBR
+        build_cache.run(f'epi_reg '
+                        f'--epi={ref_func} '
+                        f'--t1={ref_anat} '
+                        f'--t1brain='
+                        f'{ref_anat_brain} '
+                        f'--out={example_func2highres[:-4]}',
+                        outputs=[example_func2highres],
+                        inputs=[ref_func, ref_anat, ref_anat_brain],
+                        force='func_anat' in overwrite)
+
+        # linear search
+        # os.system(f'flirt -in {ref_anat_brain} -ref {ref_func}
+        #     -omat {highres2example_func}')
 
         highres2example_func = f'{reg_dir}/highres2example_func.mat'
-        if not op.isfile(highres2example_func) or 'func_anat' in overwrite:
-            os.system(f'convert_xfm '
-                      f'-omat {highres2example_func} '
-                      f'-inverse '
-                      f'{example_func2highres}')
+        build_cache.run(f'convert_xfm '
+                        f'-omat {highres2example_func} '
+                        f'-inverse '
+                        f'{example_func2highres}',
+                        outputs=[highres2example_func],
+                        inputs=[example_func2highres],
+                        force='func_anat' in overwrite)
 
     elif method == 'freesurfer':
 
         lta = f'{reg_dir}/example_func2highres.lta'
-        if not op.isfile(lta) or 'func_anat' in overwrite:
-            os.system(f'bbregister '
-                      f'--s {fs_subject} '
-                      f'--mov {ref_func} '
-                      f'--init-fsl '
-                      f'--lta {lta} '
-                      f'--bold')
+        build_cache.run(f'bbregister '
+                        f'--s {fs_subject} '
+                        f'--mov {ref_func} '
+                        f'--init-fsl '
+                        f'--lta {lta} '
+                        f'--bold',
+                        outputs=[lta],
+                        inputs=[ref_func],
+                        force='func_anat' in overwrite)
 
         example_func2highres = f'{reg_dir}/example_func2highres.mat'
-        if not op.isfile(example_func2highres) or 'func_anat' in overwrite:
-            os.system(f'lta_convert '
-                      f'--inlta {lta} '
-                      f'--outfsl {example_func2highres} '
-                      f'--src {ref_func} '
-                      f'--trg {ref_anat}')
+        build_cache.run(f'lta_convert '
+                        f'--inlta {lta} '
+                        f'--outfsl {example_func2highres} '
+                        f'--src {ref_func} '
+                        f'--trg {ref_anat}',
+                        outputs=[example_func2highres],
+                        inputs=[lta, ref_func, ref_anat],
+                        force='func_anat' in overwrite)
 
         lta_inv = f'{reg_dir}/highres2example_func.lta'
-        if not op.isfile(lta_inv) or 'func_anat' in overwrite:
-            os.system(f'lta_convert '
-                      f'--inlta {lta} '
-                      f'--outlta {lta_inv} '
-                      f'--invert')
+        build_cache.run(f'lta_convert '
+                        f'--inlta {lta} '
+                        f'--outlta {lta_inv} '
+                        f'--invert',
+                        outputs=[lta_inv],
+                        inputs=[lta],
+                        force='func_anat' in overwrite)
 
         highres2example_func = f'{reg_dir}/highres2example_func.mat'
-        if not op.isfile(highres2example_func) or 'func_anat' in overwrite:
-            os.system(f'lta_convert '
-                      f'--inlta {lta_inv} '
-                      f'--outfsl {highres2example_func} '
-                      f'--src {ref_anat} '
-                      f'--trg {ref_func}')
+        build_cache.run(f'lta_convert '
+                        f'--inlta {lta_inv} '
+                        f'--outfsl {highres2example_func} '
+                        f'--src {ref_anat} '
+                        f'--trg {ref_func}',
+                        outputs=[highres2example_func],
+                        inputs=[lta_inv, ref_anat, ref_func],
+                        force='func_anat' in overwrite)
 
     # apply transform to ref func
     example_func2highres_img = f'{reg_dir}/example_func2highres.nii.gz'
-    if not op.isfile(example_func2highres_img) or 'func_anat' in overwrite:
-        os.system(f'flirt '
-                  f'-in {ref_func} '
-                  f'-ref {ref_anat} '
-                  f'-applyxfm -init {example_func2highres} '
-                  f'-out {example_func2highres_img}')
+    build_cache.run(f'flirt '
+                    f'-in {ref_func} '
+                    f'-ref {ref_anat} '
+                    f'-applyxfm -init {example_func2highres} '
+                    f'-out {example_func2highres_img}',
+                    outputs=[example_func2highres_img],
+                    inputs=[ref_func, ref_anat, example_func2highres],
+                    force='func_anat' in overwrite,
+                    fsl_images=[example_func2highres_img])
 
     # make reg images
     d = reg_dir
-    if (not op.isfile(f'{d}/example_func2highres.png') or 'func_anat' in
-            overwrite):
+    png = f'{d}/example_func2highres.png'
+    if build_cache.needs_update([png], inputs=[example_func2highres_img]) or \
+            'func_anat' in overwrite:
         slicer_str = (
             f'-x 0.35 {d}/sla.png -x 0.45 {d}/slb.png '
             f'-x 0.55 {d}/slc.png -x 0.65 {d}/sld.png '
@@ -234,22 +303,17 @@ def registration(overwrite):
         append_str = ' + '.join(
             [f'{d}/sl{i}.png' for i in 'abcdefghijkl'])
 
-        cmd = f'slicer {d}/example_func2highres {d}/highres -s 2 {slicer_str}'
-        subprocess.Popen(cmd.split()).wait()
-
-        cmd = f'pngappend {append_str} {d}/example_func2highres1.png'
-        subprocess.Popen(cmd.split()).wait()
-
-        cmd = (f'slicer {d}/highres {d}/example_func2highres -s 2'
-               f' {slicer_str}')
-        subprocess.Popen(cmd.split()).wait()
-
-        cmd = f'pngappend {append_str} {d}/example_func2highres2.png'
-        subprocess.Popen(cmd.split()).wait()
-
-        cmd = (f'pngappend {d}/example_func2highres1.png - '
-               f'{d}/example_func2highres2.png {d}/example_func2highres.png')
-        subprocess.Popen(cmd.split()).wait()
+        cmds = [
+            f'slicer {d}/example_func2highres {d}/highres -s 2 {slicer_str}',
+            f'pngappend {append_str} {d}/example_func2highres1.png',
+            f'slicer {d}/highres {d}/example_func2highres -s 2'
+            f' {slicer_str}',
+            f'pngappend {append_str} {d}/example_func2highres2.png',
+            f'pngappend {d}/example_func2highres1.png - '
+            f'{d}/example_func2highres2.png {d}/example_func2highres.png',
+        ]
+        if all(tracing.run(cmd) == 0 for cmd in cmds):
+            build_cache.record([png], inputs=[example_func2highres_img])
 
     # clean up
     for search in ['*1.png', '*2.png', 'sl?.png']:
@@ -258,49 +322,77 @@ def registration(overwrite):
             os.remove(img)
 
 
+def registration_func_std(overwrite):
+
+    p = _paths()
+    subject, fnirt_dir, reg_dir = p['subject'], p['fnirt_dir'], p['reg_dir']
+    ref_func, ref_std_brain = p['ref_func'], p['ref_std_brain']
+    example_func2highres = f'{reg_dir}/example_func2highres.mat'
+    highres2example_func = f'{reg_dir}/highres2example_func.mat'
+    highres2standard = f'{fnirt_dir}/highres2standard.mat'
+    standard2highres = f'{fnirt_dir}/standard2highres.mat'
+    highres2standard_warp = f'{fnirt_dir}/highres2standard_warp.nii.gz'
+
     # transform 3: between functional space and standard space
 
     # concatenate func to standard and standard to func (linear)
     example_func2standard = f'{reg_dir}/example_func2standard.mat'
-    if not op.isfile(example_func2standard) or len(overwrite):
-        os.system(f'convert_xfm '
-                  f'-omat {example_func2standard} '
-                  f'-concat {example_func2highres} {highres2standard}')
+    build_cache.run(f'convert_xfm '
+                    f'-omat {example_func2standard} '
+                    f'-concat {example_func2highres} {highres2standard}',
+                    outputs=[example_func2standard],
+                    inputs=[example_func2highres, highres2standard],
+                    force=len(overwrite))
     standard2example_func = f'{reg_dir}/standard2example_func.mat'
-    if not op.isfile(standard2example_func) or len(overwrite):
-        os.system(f'convert_xfm '
-                  f'-omat {standard2example_func} '
-                  f'-concat {standard2highres} {highres2example_func}')
+    build_cache.run(f'convert_xfm '
+                    f'-omat {standard2example_func} '
+                    f'-concat {standard2highres} {highres2example_func}',
+                    outputs=[standard2example_func],
+                    inputs=[standard2highres, highres2example_func],
+                    force=len(overwrite))
 
     # concatenate func to standard and standard to func (non-linear)
     example_func2standard_warp = (
         f'{reg_dir}/example_func2standard_warp.nii.gz')
-    if not op.isfile(example_func2standard_warp) or len(overwrite):
-        os.system(f'convertwarp '
-                  f'--ref={ref_std_brain} '
-                  f'--premat={example_func2highres} '
-                  f'--warp1={highres2standard_warp} '
-                  f'--out={example_func2standard_warp}')
+    build_cache.run(f'convertwarp '
+                    f'--ref={ref_std_brain} '
+                    f'--premat={example_func2highres} '
+                    f'--warp1={highres2standard_warp} '
+                    f'--out={example_func2standard_warp}',
+                    outputs=[example_func2standard_warp],
+                    inputs=[ref_std_brain, example_func2highres,
+                            highres2standard_warp],
+                    force=len(overwrite),
+                    fsl_images=[example_func2standard_warp])
     standard2example_func_warp = (
         f'{reg_dir}/standard2example_func_warp.nii.gz')
-    if not op.isfile(standard2example_func_warp) or len(overwrite):
-        os.system(f'invwarp '
-                  f'-w {example_func2standard_warp} '
-                  f'-o {standard2example_func_warp} '
-                  f'-r {ref_func}')
+    build_cache.run(f'invwarp '
+                    f'-w {example_func2standard_warp} '
+                    f'-o {standard2example_func_warp} '
+                    f'-r {ref_func}',
+                    outputs=[standard2example_func_warp],
+                    inputs=[example_func2standard_warp, ref_func],
+                    force=len(overwrite),
+                    fsl_images=[standard2example_func_warp])
 
     # apply transform to ref func
     example_func2standard_img = f'{reg_dir}/example_func2standard.nii.gz'
-    if not op.isfile(example_func2standard_img) or len(overwrite):
-        os.system(f'applywarp '
-                  f'-i {ref_func} '
-                  f'-r {ref_std_brain} '
-                  f'-o {reg_dir}/example_func2standard '
-                  f'-w {reg_dir}/example_func2standard_warp')
+    build_cache.run(f'applywarp '
+                    f'-i {ref_func} '
+                    f'-r {ref_std_brain} '
+                    f'-o {reg_dir}/example_func2standard '
+                    f'-w {reg_dir}/example_func2standard_warp',
+                    outputs=[example_func2standard_img],
+                    inputs=[ref_func, ref_std_brain,
+                            example_func2standard_warp],
+                    force=len(overwrite),
+                    fsl_images=[example_func2standard_img])
 
     # make reg images
     d = reg_dir
-    if not op.isfile(f'{d}/example_func2standard.png') or len(overwrite):
+    png = f'{d}/example_func2standard.png'
+    if build_cache.needs_update([png], inputs=[example_func2standard_img]) \
+            or len(overwrite):
         slicer_str = (
             f'-x 0.35 {d}/sla.png -x 0.45 {d}/slb.png '
             f'-x 0.55 {d}/slc.png -x 0.65 {d}/sld.png '
@@ -310,21 +402,16 @@ def registration(overwrite):
             f'-z 0.55 {d}/slk.png -z 0.65 {d}/sll.png')
         append_str = ' + '.join([f'{d}/sl{i}.png' for i in 'abcdefghijkl'])
 
-        cmd = f'slicer {d}/example_func2standard {d}/standard -s 2 {slicer_str}'
-        subprocess.Popen(cmd.split()).wait()
-
-        cmd = f'pngappend {append_str} {d}/example_func2standard1.png'
-        subprocess.Popen(cmd.split()).wait()
-
-        cmd = f'slicer {d}/standard {d}/example_func2standard -s 2 {slicer_str}'
-        subprocess.Popen(cmd.split()).wait()
-
-        cmd = f'pngappend {append_str} {d}/example_func2standard2.png'
-        subprocess.Popen(cmd.split()).wait()
-
-        cmd = (f'pngappend {d}/example_func2standard1.png - '
-               f'{d}/example_func2standard2.png {d}/example_func2standard.png')
-        subprocess.Popen(cmd.split()).wait()
+        cmds = [
+            f'slicer {d}/example_func2standard {d}/standard -s 2 {slicer_str}',
+            f'pngappend {append_str} {d}/example_func2standard1.png',
+            f'slicer {d}/standard {d}/example_func2standard -s 2 {slicer_str}',
+            f'pngappend {append_str} {d}/example_func2standard2.png',
+            f'pngappend {d}/example_func2standard1.png - '
+            f'{d}/example_func2standard2.png {d}/example_func2standard.png',
+        ]
+        if all(tracing.run(cmd) == 0 for cmd in cmds):
+            build_cache.record([png], inputs=[example_func2standard_img])
 
     for search in ['*1.png', '*2.png', 'sl?.png']:
         imgs = glob.glob(f'{d}/{search}')
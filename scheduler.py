@@ -0,0 +1,139 @@
+"""
+dependency-graph scheduler for the pipeline stages
+
+Each stage declares the files (or directories) it reads and writes. A stage
+waits for every stage that writes one of its inputs, and stages with no
+dependency between them run at the same time, sharing the n_procs budget.
+"""
+
+import os.path as op
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .seconds_to_text import seconds_to_text
+from . import tracing
+
+
+def stage(name, func, args=(), kwargs=None, inputs=(), outputs=(),
+          n_procs=1, after=()):
+
+    """
+    describes one pipeline stage.
+    inputs / outputs: paths read / written by the stage. A directory path
+        covers everything inside it.
+    n_procs: number of cores the stage occupies while running.
+    after: names of stages that must finish first regardless of files.
+    """
+
+    return {'name': name,
+            'func': func,
+            'args': tuple(args),
+            'kwargs': kwargs or {},
+            'inputs': [op.normpath(p) for p in inputs],
+            'outputs': [op.normpath(p) for p in outputs],
+            'n_procs': n_procs,
+            'after': list(after)}
+
+
+def _overlaps(path_a, path_b):
+    return (path_a == path_b or path_a.startswith(path_b + '/') or
+            path_b.startswith(path_a + '/'))
+
+
+def stage_dependencies(stages):
+
+    """ returns {stage name: set of stage names it must wait for} """
+
+    deps = {s['name']: set(s['after']) for s in stages}
+    for s in stages:
+        for other in stages:
+            if other is s:
+                continue
+            if any(_overlaps(i, o) for i in s['inputs']
+                   for o in other['outputs']):
+                deps[s['name']].add(other['name'])
+
+    # check for cycles
+    visited, stack = set(), set()
+
+    def visit(name):
+        if name in stack:
+            raise ValueError(f'dependency cycle involving stage {name}')
+        if name not in visited:
+            stack.add(name)
+            for dep in deps[name]:
+                visit(dep)
+            stack.remove(name)
+            visited.add(name)
+
+    for name in deps:
+        visit(name)
+
+    return deps
+
+
+def _run_stage(s):
+    start = time.time()
+    print(f'starting stage: {s["name"]}')
+    with tracing.span(s['name']):
+        s['func'](*s['args'], **s['kwargs'])
+    print(f'finished stage: {s["name"]} '
+          f'({seconds_to_text(time.time() - start)})')
+
+
+def run_stages(stages, n_procs, targets=None):
+
+    """
+    runs the stages in dependency order, starting any stage whose
+    dependencies have finished as long as its n_procs fit in the budget.
+    targets: names of the stages to run. Stages not in targets are skipped,
+        and their outputs are assumed to exist already.
+    """
+
+    names = [s['name'] for s in stages]
+    assert len(set(names)) == len(names), 'stage names must be unique'
+    unknown = set(targets or []) - set(names)
+    assert not unknown, f'unknown stages: {sorted(unknown)}'
+    by_name = {s['name']: s for s in stages}
+    deps = stage_dependencies(stages)
+    if targets is not None:
+        deps = {n: deps[n] & set(targets) for n in names if n in targets}
+
+    pending = [n for n in names if n in deps]
+    done, failed, running = set(), set(), {}
+    free_procs = n_procs
+    with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as pool:
+        while pending or running:
+
+            # stages downstream of a failure cannot run
+            for name in list(pending):
+                if deps[name] & failed:
+                    print(f'skipping stage {name}: upstream stage failed')
+                    pending.remove(name)
+                    failed.add(name)
+
+            # launch every ready stage that fits in the remaining budget
+            for name in list(pending):
+                procs = min(by_name[name]['n_procs'], n_procs)
+                if deps[name] <= done and procs <= free_procs:
+                    future = pool.submit(_run_stage, by_name[name])
+                    running[future] = (name, procs)
+                    free_procs -= procs
+                    pending.remove(name)
+
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, procs = running.pop(future)
+                free_procs += procs
+                try:
+                    future.result()
+                    done.add(name)
+                except Exception:
+                    traceback.print_exc()
+                    print(f'stage {name} failed')
+                    failed.add(name)
+
+    if failed:
+        raise RuntimeError(f'pipeline stages failed: {sorted(failed)}')
@@ -0,0 +1,55 @@
+"""
+staging files into other directories without copying their data
+
+stage_file gives dst the contents of src by the cheapest means that is safe
+for how dst will be used: a reflink (a copy-on-write clone sharing src's
+blocks, on file systems such as btrfs and XFS) where the file system supports
+it, otherwise a hardlink if dst will only be read, and a full copy only if
+dst is going to be modified in place. A hardlinked dst is the same file as
+src, so it may be removed or replaced but must never be written to.
+"""
+
+import os
+import shutil
+import fcntl
+
+FICLONE = 0x40049409  # from linux/fs.h
+
+
+def reflink(src, dst):
+
+    """ clones src to dst, returning False if the file system cannot """
+
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        try:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+            cloned = True
+        except OSError:
+            cloned = False
+    if not cloned:
+        os.remove(dst)
+    return cloned
+
+
+def stage_file(src, dst, modify=False):
+
+    """
+    makes dst hold the contents of src (with its permissions) by reflink,
+    hardlink (only if not modify) or copy, and returns which was used
+    """
+
+    tmp = f'{dst}.{os.getpid()}.tmp'
+    method = 'copy'
+    if reflink(src, tmp):
+        shutil.copymode(src, tmp)
+        method = 'reflink'
+    elif not modify:
+        try:
+            os.link(src, tmp)
+            method = 'hardlink'
+        except OSError:  # e.g. on another file system
+            pass
+    if method == 'copy':
+        shutil.copy(src, tmp)
+    os.replace(tmp, dst)
+    return method
@@ -0,0 +1,20 @@
+import os.path as op
+import numpy as np
+import nibabel as nib
+from utils.gzip_index import index_path, load_index
+from utils.nifti_io import read_volumes, load_data
+
+
+def test_foreign_gzip_indexed_on_first_read(tmp_path):
+
+    """ a gzip file without seek points is indexed by its first read """
+
+    path = f'{tmp_path}/ts.nii.gz'
+    data = np.random.default_rng(0).random((64, 64, 32, 10), np.float32)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)  # single gzip member
+    assert load_index(path) is None
+
+    np.testing.assert_array_equal(read_volumes(path, 8, 2), data[..., 8:])
+    assert op.isfile(index_path(path)) and len(load_index(path)['points']) > 1
+    np.testing.assert_array_equal(load_data(path), data)
+    np.testing.assert_array_equal(nib.load(path).get_fdata(), data)
@@ -0,0 +1,47 @@
+import numpy as np
+import nibabel as nib
+import pytest
+from utils import nifti_io
+from utils.img_math import Img
+from utils.temporal_filter import temporal_filter
+
+
+@pytest.fixture
+def images(tmp_path):
+    rng = np.random.default_rng(0)
+    ts = rng.normal(100, 10, (5, 4, 3, 40)).astype(np.float32)
+    mask = (rng.random((5, 4, 3)) > .5).astype(np.float32)
+    nib.save(nib.Nifti1Image(ts, np.eye(4)), f'{tmp_path}/ts.nii.gz')
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), f'{tmp_path}/mask.nii.gz')
+    return f'{tmp_path}/ts.nii.gz', ts, f'{tmp_path}/mask.nii.gz', mask
+
+
+def test_reductions_stream(images, monkeypatch):
+
+    """ tmean / tstd of gzipped images read them in order, once per pass """
+
+    ts_path, ts, mask_path, mask = images
+    monkeypatch.setattr(nifti_io, 'decompress', None)  # must not be used
+    ts_img = Img(ts_path)
+    np.testing.assert_allclose(ts_img.tmean().compute(chunk_vols=7),
+                               ts.mean(3), rtol=1e-5)
+    tsnr = ts_img.tmean().div(ts_img.tstd()).mul(Img(mask_path))
+    np.testing.assert_allclose(tsnr.compute(chunk_vols=7),
+                               ts.mean(3) / ts.std(3, ddof=1) * mask,
+                               rtol=1e-4)
+    demeaned = ts_img.sub(ts_img.tmean())
+    np.testing.assert_allclose(demeaned.tstd().compute(chunk_vols=7),
+                               ts.std(3, ddof=1), rtol=1e-4)
+    out = ts_img.sub(ts_img.tmean()).write(
+        ts_path.replace('ts', 'demeaned'), chunk_vols=7)
+    np.testing.assert_allclose(nib.load(out).get_fdata(),
+                               ts - ts.mean(3, keepdims=True), atol=1e-3)
+
+
+def test_bptf(images, tmp_path):
+    ts_path = images[0]
+    temporal_filter(ts_path, f'{tmp_path}/hp.nii', hp_sigma=5)
+    ts_img = Img(ts_path)
+    np.testing.assert_allclose(
+        ts_img.bptf(5).add(ts_img.tmean()).compute(),
+        nib.load(f'{tmp_path}/hp.nii').get_fdata(), rtol=1e-5)
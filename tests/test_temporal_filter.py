@@ -0,0 +1,72 @@
+import os
+import shutil
+import subprocess
+import numpy as np
+import nibabel as nib
+import pytest
+from utils.temporal_filter import temporal_filter
+
+
+def _fsl_bptf(series, hp_sigma):
+
+    """ the high-pass loop of FSL's bandpass_temporal_filter (newimagefns) """
+
+    half_width = int(hp_sigma * 3)
+    out = np.empty_like(series)
+    c0 = 0
+    for t in range(len(series)):
+        A = B = C = D = N = 0
+        for tt in range(max(t - half_width, 0),
+                        min(t + half_width, len(series) - 1) + 1):
+            dt = tt - t
+            w = np.exp(-.5 * dt ** 2 / hp_sigma ** 2)
+            A += w * dt
+            B += w * series[tt]
+            C += w * dt * dt
+            D += w * dt * series[tt]
+            N += w
+        denom = C * N - A * A
+        if denom != 0:
+            c = (B * C - A * D) / denom
+            if t == 0:
+                c0 = c
+            out[t] = c0 + series[t] - c
+        else:
+            out[t] = series[t]
+    return out
+
+
+def _timeseries(path, n_vols=60):
+    rng = np.random.default_rng(0)
+    t = np.arange(n_vols)
+    data = (1000 + rng.normal(0, 10, (4, 3, 2, n_vols)) + 2 * t +
+            50 * np.sin(t / 10)).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+    return data
+
+
+def test_bptf_matches_fsl_loop(tmp_path):
+    data = _timeseries(f'{tmp_path}/ts.nii')
+    temporal_filter(f'{tmp_path}/ts.nii', f'{tmp_path}/hp.nii', hp_sigma=7.5,
+                    n_procs=2)
+    out = nib.load(f'{tmp_path}/hp.nii').get_fdata()
+    series = data.reshape(-1, data.shape[3]).astype(np.float64)
+    expected = np.stack([_fsl_bptf(s, 7.5) for s in series]) + \
+        series.mean(1, keepdims=True)
+    np.testing.assert_allclose(out.reshape(series.shape), expected,
+                               rtol=1e-5)
+
+
+@pytest.mark.skipif(shutil.which('fslmaths') is None,
+                    reason='FSL is not installed')
+def test_bptf_matches_fslmaths(tmp_path):
+    ts = f'{tmp_path}/ts.nii'
+    _timeseries(ts)
+    subprocess.run(f'fslmaths {ts} -Tmean {tmp_path}/mean && '
+                   f'fslmaths {ts} -bptf 7.5 -1 -add {tmp_path}/mean '
+                   f'{tmp_path}/fsl -odt float', shell=True, check=True,
+                   env=dict(os.environ, FSLOUTPUTTYPE='NIFTI'))
+    temporal_filter(ts, f'{tmp_path}/hp.nii', hp_sigma=7.5, n_procs=2)
+    np.testing.assert_allclose(nib.load(f'{tmp_path}/hp.nii').get_fdata(),
+                               nib.load(f'{tmp_path}/fsl.nii').get_fdata(),
+                               rtol=1e-4)
@@ -0,0 +1,50 @@
+import os
+import os.path as op
+import json
+import numpy as np
+import nibabel as nib
+from utils.test_NORDIC import test_NORDIC as run_test_NORDIC
+
+FUNC = 'sub-M001/ses-1/func/sub-M001_ses-1_task-restingState_run-1'
+
+
+def _make_dataset(root):
+
+    """ a tiny session: real and imaginary parts, with measured mag/phase """
+
+    rng = np.random.default_rng(0)
+    shape = (8, 8, 3, 31)  # 30 volumes and a noise volume
+    real = rng.normal(100, 10, shape).astype(np.float32)
+    imag = rng.normal(50, 10, shape).astype(np.float32)
+    for part, data in [('real', real), ('imag', imag),
+                       ('mag', np.hypot(real, imag)),
+                       ('phase', np.arctan2(imag, real))]:
+        nib.save(nib.Nifti1Image(data, np.eye(4)),
+                 f'{root}/{FUNC}_part-{part}_bold.nii')
+    with open(f'{root}/{FUNC}_part-mag_bold.json', 'w') as f:
+        json.dump({'RepetitionTime': 2.}, f)
+    for src in ['dataset_description.json', 'participants.json', 'README']:
+        with open(f'{root}/{src}', 'w') as f:
+            f.write('{}')
+
+
+def test_rerun(tmp_path, monkeypatch):
+
+    """ the stage can be run again after its cleanup """
+
+    for directory in ['func', 'anat', 'fmap']:
+        os.makedirs(tmp_path / f'sub-M001/ses-1/{directory}')
+    _make_dataset(tmp_path)
+    monkeypatch.chdir(tmp_path)
+
+    run_test_NORDIC('numpy', n_procs=2)
+    calc = FUNC.replace('run-1', 'acq-calc')
+    assert not op.exists(f'{FUNC}_part-real_bold.nii')
+    assert op.exists(f'{calc}_part-phase_bold.nii')
+    out = ('derivatives/NORDIC_mag-calc_phase-calc_noise-vol/sub-M001/ses-1/'
+           'func/sub-M001_ses-1_task-restingState_part-mag_bold.nii')
+    mtime = os.stat(out).st_mtime_ns
+
+    run_test_NORDIC('numpy', n_procs=2)
+    assert os.stat(out).st_mtime_ns == mtime
+    assert nib.load(out).shape[3] == 30
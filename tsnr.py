@@ -0,0 +1,72 @@
+"""
+single-pass temporal mean, standard deviation and tSNR maps
+
+Equivalent to fslmaths -Tmean, -Tstd (n - 1 denominator) and -div, but the
+timeseries is read only once, in chunks of volumes. Per-chunk means and sums
+of squared deviations are merged into running totals in float64 (the
+parallel form of Welford's algorithm, Chan et al. 1979), which stays
+accurate for long runs with a large mean signal. The maps can instead be
+made from the high-pass filtered or detrended timeseries (see
+temporal_filter.py), computed slab by slab without writing it to disk.
+"""
+
+import numpy as np
+from .nifti_io import iter_chunks, load_header, output_header, write_volumes
+from .temporal_filter import iter_filtered_slabs
+
+
+def temporal_stats(timeseries, chunk_vols=16, hp_sigma=None, order=None):
+
+    """
+    returns voxelwise (mean, std, tSNR) arrays; tSNR is 0 where std is 0.
+    hp_sigma / order: stats of the timeseries after temporal_filter
+    """
+
+    if hp_sigma is not None or order is not None:
+        return _filtered_stats(timeseries, hp_sigma, order)
+    n, mean, m2 = 0, 0., 0.
+    for chunk in iter_chunks(timeseries, chunk_vols):
+        n_chunk = chunk.shape[3]
+        mean_chunk = chunk.mean(axis=3, dtype=np.float64)
+        m2_chunk = np.square(chunk - mean_chunk[..., None]).sum(axis=3)
+        delta = mean_chunk - mean
+        n += n_chunk
+        mean = mean + delta * (n_chunk / n)
+        m2 = m2 + m2_chunk + np.square(delta) * ((n - n_chunk) * n_chunk / n)
+    std = np.sqrt(m2 / (n - 1)) if n > 1 else np.zeros_like(mean)
+    return mean, std, _tsnr(mean, std)
+
+
+def _tsnr(mean, std):
+    return np.divide(mean, std, out=np.zeros_like(mean), where=std > 0)
+
+
+def _filtered_stats(timeseries, hp_sigma, order):
+
+    """ stats of each filtered slab, which holds all volumes """
+
+    header = load_header(timeseries)
+    mean = np.zeros(header.get_data_shape()[:3])
+    std = np.zeros_like(mean)
+    for z, slab in iter_filtered_slabs(timeseries, hp_sigma, order):
+        mean[:, :, z] = slab.mean(axis=3, dtype=np.float64)
+        if slab.shape[3] > 1:
+            std[:, :, z] = slab.std(axis=3, ddof=1, dtype=np.float64)
+    return mean, std, _tsnr(mean, std)
+
+
+def write_temporal_stats(timeseries, tsnr_out=None, mean_out=None,
+                         std_out=None, chunk_vols=16, hp_sigma=None,
+                         order=None):
+
+    """
+    computes the maps in one pass and writes those given an output path
+    (float32, geometry of timeseries). Returns (mean, std, tSNR) arrays.
+    """
+
+    stats = temporal_stats(timeseries, chunk_vols, hp_sigma, order)
+    header = output_header(timeseries, None)
+    for path, stat in zip([mean_out, std_out, tsnr_out], stats):
+        if path:
+            write_volumes(path, [stat], header)
+    return stats
@@ -8,6 +8,10 @@ import nighres
 import os.path as op
 import subprocess
 import itertools
+from . import build_cache
+from .img_math import Img
+from . import tracing
+from .compression import run_fsl
 
 def make_ROIs(overwrite):
     
@@ -41,40 +45,51 @@ def make_ROIs(overwrite):
             mgz_native = f'{fs_dir}/mri/orig/{hemi}.ribbon.mgz'
             ref_anat_mgz = f'{fs_dir}/mri/orig/001.mgz'
             nii = f'{fs_dir}/mri/orig/{hemi}.ribbon.nii.gz'
-            if not os.path.exists(nii) or overwrite:
+            if build_cache.needs_update([nii], inputs=[mgz_fs, ref_anat_mgz]) \
+                    or overwrite:
                 print(f'Converting {hemi} cortex from fs to native space...')
-                os.system(f'mri_vol2vol '
-                          f'--mov {mgz_fs} '
-                          f'--targ {ref_anat_mgz} '
-                          f'--regheader '
-                          f'--o {mgz_native} '
-                          f'--nearest '
-                          f'--no-save-reg')
-                print(f'Converting {hemi} cortex from mgz to nifti...')
-                os.system(f'mri_convert '
-                          f'--in_type mgz '
-                          f'--out_type nii '
-                          f'-rt nearest '
-                          f'{mgz_native} {nii}')
+                status = tracing.run(f'mri_vol2vol '
+                                     f'--mov {mgz_fs} '
+                                     f'--targ {ref_anat_mgz} '
+                                     f'--regheader '
+                                     f'--o {mgz_native} '
+                                     f'--nearest '
+                                     f'--no-save-reg')
+                if status == 0:
+                    print(f'Converting {hemi} cortex from mgz to nifti...')
+                    status = tracing.run(f'mri_convert '
+                                         f'--in_type mgz '
+                                         f'--out_type nii '
+                                         f'-rt nearest '
+                                         f'{mgz_native} {nii}')
+                if status == 0:
+                    build_cache.record([nii], inputs=[mgz_fs, ref_anat_mgz])
 
         cortex_highres = f'{fs_dir}/mri/orig/bi.ribbon.nii.gz'
-        if not op.isfile(cortex_highres) or overwrite:
+        ribbons = [f'{fs_dir}/mri/orig/{hemi}.ribbon.nii.gz'
+                   for hemi in ['lh', 'rh']]
+        if build_cache.needs_update([cortex_highres], inputs=ribbons) or \
+                overwrite:
             print(f'Combining left and right hemispheres...')
-            os.system(
-                f'fslmaths {fs_dir}/mri/orig/lh.ribbon.nii.gz -add'
-                f' {fs_dir}/mri/orig/rh.ribbon.nii.gz -bin {cortex_highres}')
+            Img(ribbons[0]).add(Img(ribbons[1])).bin().write(cortex_highres)
+            build_cache.record([cortex_highres], inputs=ribbons)
 
 
         # func space
         cortex_func = f'{roi_dir}/cortex.nii.gz'
-        if not op.isfile(cortex_func) or overwrite:
+        inputs = [cortex_highres, ref_func, highres2example_func]
+        if build_cache.needs_update([cortex_func], inputs=inputs) or \
+                overwrite:
             print('Transforming cortex mask to functional space...')
-            os.system(f'flirt '
-                      f'-in {fs_dir}/mri/orig/bi.ribbon.nii.gz '
-                      f'-ref {ref_func} '
-                      f'-out {cortex_func} '
-                      f'-applyxfm -init {highres2example_func} '
-                      f'-interp nearestneighbour')
+            status = run_fsl(f'flirt '
+                             f'-in {fs_dir}/mri/orig/bi.ribbon.nii.gz '
+                             f'-ref {ref_func} '
+                             f'-out {cortex_func} '
+                             f'-applyxfm -init {highres2example_func} '
+                             f'-interp nearestneighbour',
+                             [cortex_func.split('.nii')[0]])
+            if status == 0:
+                build_cache.record([cortex_func], inputs=inputs)
 
 
         # standard space masks
@@ -84,20 +99,26 @@ def make_ROIs(overwrite):
                 f'~/david/masks/**/{region}.nii.gz'))[0]
             mask_func = f'{roi_dir}/{region}.nii.gz'
 
-            if not os.path.exists(mask_func) or overwrite:
-                os.system(f'applywarp '
-                          f'-i {mask_std} '
-                          f'-r {ref_func} '
-                          f'-o {mask_func} '
-                          f'-w {reg_dir}/standard2example_func_warp '
-                          f'--interp=nn')
+            build_cache.run(f'applywarp '
+                            f'-i {mask_std} '
+                            f'-r {ref_func} '
+                            f'-o {mask_func} '
+                            f'-w {reg_dir}/standard2example_func_warp '
+                            f'--interp=nn',
+                            outputs=[mask_func],
+                            inputs=[mask_std, ref_func, f'{reg_dir}/'
+                                    f'standard2example_func_warp.nii.gz'],
+                            force=overwrite,
+                            fsl_images=[mask_func])
 
             # combine cortex mask with ROI mask
             mask_final = f'{roi_dir}/{region}_cortex.nii.gz'
-            if not os.path.isfile(mask_final) or overwrite:
+            inputs = [cortex_func, mask_func]
+            if build_cache.needs_update([mask_final], inputs=inputs) or \
+                    overwrite:
                 print('Combining ROI mask with cortical mask...')
-                os.system(f'fslmaths {roi_dir}/cortex.nii.gz '
-                          f'-mul {mask_func} {mask_final}')
+                Img(cortex_func).mul(Img(mask_func)).write(mask_final)
+                build_cache.record([mask_final], inputs=inputs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+"""
+pool of long-lived MATLAB engines
+
+Starting MATLAB and warming up its JIT takes 20-60 s, so engines are started
+once per pipeline run and reused for every call. Each call goes to whichever
+engine is free. If an engine has crashed, it is replaced and the call is
+retried once.
+"""
+
+import atexit
+import queue
+import threading
+import matlab.engine
+from . import tracing
+
+NORDIC_PATH = '/home/tonglab/david/repos/NORDIC_Raw'
+
+
+class EnginePool:
+
+    def __init__(self, n_engines=1, paths=(NORDIC_PATH,)):
+        self.paths = list(paths)
+        self.engines = []
+        self.free = queue.Queue()
+        self.add_engines(n_engines)
+
+    def _setup(self, eng):
+        for path in self.paths:
+            eng.addpath(path, nargout=0)
+        return eng
+
+    def add_engines(self, n_engines):
+
+        """ starts n_engines more engines, in parallel """
+
+        futures = [matlab.engine.start_matlab(background=True)
+                   for _ in range(n_engines)]
+        for future in futures:
+            eng = self._setup(future.result())
+            self.engines.append(eng)
+            self.free.put(eng)
+
+    def _restart(self, eng):
+        try:
+            eng.quit()
+        except Exception:
+            pass
+        new = self._setup(matlab.engine.start_matlab())
+        self.engines[self.engines.index(eng)] = new
+        return new
+
+    def call(self, func, *args, nargout=0):
+
+        """ calls a MATLAB function on the next free engine """
+
+        eng = self.free.get()
+        try:
+            try:
+                with tracing.span(f'matlab {func}', 'matlab'):
+                    return getattr(eng, func)(*args, nargout=nargout)
+            except (matlab.engine.EngineError,
+                    matlab.engine.RejectedExecutionError):
+                print(f'MATLAB engine died during {func}, restarting...')
+                eng = self._restart(eng)
+                return getattr(eng, func)(*args, nargout=nargout)
+        finally:
+            self.free.put(eng)
+
+    def shutdown(self):
+        for eng in self.engines:
+            try:
+                eng.quit()
+            except Exception:
+                pass
+        self.engines = []
+        self.free = queue.Queue()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_engine_pool(n_engines=1):
+
+    """
+    returns the process-wide engine pool, starting it (or adding engines to
+    it) so that it has at least n_engines. The engines are shut down when the
+    process exits.
+    """
+
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = EnginePool(n_engines)
+            atexit.register(_pool.shutdown)
+        elif len(_pool.engines) < n_engines:
+            _pool.add_engines(n_engines - len(_pool.engines))
+    return _pool
@@ -4,105 +4,170 @@ import os
 import os.path as op
 import json
 import glob
-import shutil
 import pandas as pd
 
 from .test_NORDIC import test_NORDIC
+from . import build_cache
+from .container_pool import container_job, run_containers
+from .work_cache import work_dir, work_path, reserve, release, evict
+
+subjects = ['M001']#json.load(open('participants.json', 'r+'))
 
-def preprocess(n_procs):
 
-    subjects = ['M001']#json.load(open('participants.json', 'r+'))
+def preprocess(n_procs):
 
     # NORDIC correction
     test_NORDIC()
 
-    # run data quality measures for each
+    run_mriqc(n_procs)
+    run_fmriprep(n_procs)
+    convert_anatomicals()
+
+
+def _mriqc_cmd(indir, outdir, workdir, version, n_procs, mem_gb, level):
+    return f'docker run --rm ' \
+           f'--mount type=bind,src={indir},dst=/data ' \
+           f'--mount type=bind,src={outdir},dst=/out ' \
+           f'--mount type=bind,src={workdir},dst=/work ' \
+           f'--memory={mem_gb}g ' \
+           f'--memory-swap={mem_gb * 2}g ' \
+           f'nipreps/mriqc:{version} ' \
+           f'--nprocs {n_procs} ' \
+           f'--verbose-reports ' \
+           f'--resource-monitor ' \
+           f'-f ' \
+           f'-w /work ' \
+           f'/data /out ' \
+           f'{level}'
+
+
+def run_mriqc(n_procs, mem_gb=None, min_procs=1, min_mem_gb=8):
+
+    # run data quality measures for the raw data and each NORDIC variant
+    version = '23.1.0'
+    datasets = {}  # name: (indir, outdir)
     for preproc_dir in [''] + glob.glob('derivatives/NORDIC*'):
-
-        # mriqc (data quality measures)
-        version = '23.1.0'
         indir = op.abspath(preproc_dir)
         outdir = op.join(indir, f'derivatives/mriqc-{version}')
         os.makedirs(outdir, exist_ok=True)
-        workdir = op.join(indir, f'derivatives/mriqc-work')
-        if op.isdir(workdir):
-            shutil.rmtree(workdir)
-        os.makedirs(workdir)
-
-        # individual subjects
-        new_subjects = False
-        cmd_base = f'docker run --rm ' \
-                   f'--mount type=bind,src={indir},dst=/data ' \
-                   f'--mount type=bind,src={outdir},dst=/out ' \
-                   f'--mount type=bind,src={workdir},dst=/work ' \
-                   f'--memory=32g ' \
-                   f'--memory-swap=64g ' \
-                   f'nipreps/mriqc:{version} ' \
-                   f'--nprocs {n_procs} ' \
-                   f'--verbose-reports ' \
-                   f'--resource-monitor ' \
-                   f'-f ' \
-                   f'-w /work ' \
-                   f'/data /out '
+        datasets[op.basename(preproc_dir) or 'raw'] = (indir, outdir)
+
+    # individual subjects of all datasets, in parallel under one core / memory
+    # budget, with a separate work dir each. Work dirs are kept between runs
+    # so that nipype can reuse what it has cached.
+    jobs, job_datasets, workdirs = [], {}, []
+    for dataset, (indir, outdir) in datasets.items():
         for subject in subjects:
             if not op.isdir(f'{outdir}/sub-{subject}'):
-                cmd = cmd_base + f'participant --participant-label {subject}'
-                print(cmd)
-                os.system(cmd)
-                new_subjects = True
-
-        # group level
+                sub_workdir = work_dir('mriqc', version, subject, dataset)
+                workdirs.append(sub_workdir)
+                name = f'{dataset}/sub-{subject}'
+                job_datasets[name] = dataset
+                jobs.append(container_job(
+                    name,
+                    lambda procs, mem, i=indir, o=outdir, w=sub_workdir,
+                    s=subject: _mriqc_cmd(
+                        i, o, w, version, procs, mem,
+                        f'participant --participant-label {s}'),
+                    op.join(indir, f'derivatives/logs/mriqc-{version}/'
+                                   f'sub-{subject}.log')))
+    with reserve(workdirs):
+        exit_codes = run_containers(jobs, n_procs, mem_gb, min_procs,
+                                    min_mem_gb)
+
+    # group level, once all participants have finished
+    group_jobs, group_workdirs = [], {}
+    for dataset, (indir, outdir) in datasets.items():
+        new_subjects = dataset in job_datasets.values()
         if not os.path.isfile(f'{outdir}/group_bold.html') or new_subjects:
-            cmd = cmd_base + 'group'
-            print(cmd)
-            os.system(cmd)
-
-        shutil.rmtree(workdir)
-
+            group_workdirs[dataset] = work_dir('mriqc', version, 'group',
+                                               dataset)
+            group_jobs.append(container_job(
+                dataset,
+                lambda procs, mem, i=indir, o=outdir,
+                w=group_workdirs[dataset]: _mriqc_cmd(
+                    i, o, w, version, procs, mem, 'group'),
+                op.join(indir, f'derivatives/logs/mriqc-{version}/'
+                               f'group.log')))
+    with reserve(group_workdirs.values()):
+        group_codes = run_containers(group_jobs, n_procs, mem_gb, 1, 4)
+
+    # a dataset's work dirs are only cleaned up once its group report is
+    # complete, otherwise a rerun resumes from them
+    for dataset in datasets:
+        if group_codes.get(dataset, 0) == 0 and not any(
+                code for name, code in exit_codes.items()
+                if job_datasets[name] == dataset):
+            release([work_path('mriqc', version, subject, dataset)
+                     for subject in subjects + ['group']])
+    evict()
+
+    failed = [name for name, code in
+              list(exit_codes.items()) + list(group_codes.items()) if code]
+    if failed:
+        raise RuntimeError(f'mriqc failed for {failed}')
+
+
+def run_fmriprep(n_procs, mem_gb=None):
 
     # fMRIprep (preprocessing)
 
     # These are performed on individual basis as fmriprep does not check which
-    # subjects are already processed
-    # TODO: allow to run these in parallel if > 16 cores, 8 cores per subject
+    # subjects are already processed. Subjects run in parallel with 8 cores
+    # each if there are enough, each with its own work directory, which is
+    # kept if the subject fails so that a rerun can resume from it
     # https://fmriprep.org/en/stable/faq.html#running-subjects-in-parallel
     version = '23.0.2'
     indir = op.abspath('')
     outdir = op.abspath(f'derivatives/fmriprep-{version}')
     os.makedirs(outdir, exist_ok=True)
-    workdir = op.abspath('derivatives/fmriprep_work')
-    if op.isdir(workdir):
-        shutil.rmtree(workdir)
-    os.makedirs(workdir)
     subjdir = op.abspath(os.environ['SUBJECTS_DIR'])
 
+    def fmriprep_cmd(subject, workdir, n_procs, mem_gb):
+        return f'docker run --rm ' \
+               f'--mount type=bind,src={indir},dst=/data ' \
+               f'--mount type=bind,src={outdir},dst=/out ' \
+               f'--mount type=bind,src={subjdir},dst=/fs_subjects ' \
+               f'--mount type=bind,src={workdir},dst=/work ' \
+               f'--memory={mem_gb}g ' \
+               f'--memory-swap={mem_gb * 2}g ' \
+               f'nipreps/fmriprep:{version} ' \
+               f'--resource-monitor ' \
+               f'--anat-only ' \
+               f'--skip-bids-validation ' \
+               f'--nprocs {n_procs} ' \
+               f'--mem-mb {mem_gb * 1000} ' \
+               f'--fs-license-file /fs_subjects/license.txt ' \
+               f'--fs-subjects-dir /fs_subjects ' \
+               f'--output-spaces func ' \
+               f'-w /work ' \
+               f'/data /out ' \
+               f'participant --participant-label {subject}'
+
+    jobs, workdirs = [], {}
     for subject in subjects:
         if not op.isdir(f'{outdir}/sub-{subject}'):
-            cmd = f'docker run --rm ' \
-                  f'--mount type=bind,src={indir},dst=/data ' \
-                  f'--mount type=bind,src={outdir},dst=/out ' \
-                  f'--mount type=bind,src={subjdir},dst=/fs_subjects ' \
-                  f'--mount type=bind,src={workdir},dst=/work ' \
-                  f'--memory=32g ' \
-                  f'--memory-swap=64g ' \
-                  f'nipreps/fmriprep:{version} ' \
-                  f'--clean-workdir ' \
-                  f'--resource-monitor ' \
-                  f'--anat-only ' \
-                  f'--skip-bids-validation ' \
-                  f'--nprocs {n_procs} ' \
-                  f'--mem-mb 64000 ' \
-                  f'--fs-license-file /fs_subjects/license.txt ' \
-                  f'--fs-subjects-dir /fs_subjects ' \
-                  f'--output-spaces func ' \
-                  f'-w /work ' \
-                  f'/data /out ' \
-                  f'participant --participant-label {subject}'
-            print(cmd)
-            os.system(cmd)
-
-    shutil.rmtree(workdir)
+            workdirs[subject] = work_dir('fmriprep', version, subject)
+            jobs.append(container_job(
+                subject,
+                lambda procs, mem, s=subject, w=workdirs[subject]:
+                    fmriprep_cmd(s, w, procs, mem),
+                f'derivatives/logs/fmriprep-{version}/sub-{subject}.log'))
+    with reserve(workdirs.values()):
+        exit_codes = run_containers(jobs, n_procs, mem_gb)
+
+    # there is no group level, so each subject's work dir is released as soon
+    # as it has succeeded
+    release([workdirs[subject] for subject, code in exit_codes.items()
+             if not code])
+    evict()
+
+    failed = [subject for subject, code in exit_codes.items() if code]
+    if failed:
+        raise RuntimeError(f'fmriprep failed for subjects {failed}')
+
 
+def convert_anatomicals():
 
     fs_dir = f'{os.environ["SUBJECTS_DIR"]}/sub-{subjects[0]}'
 
@@ -112,12 +177,12 @@ def preprocess(n_procs):
 
         # convert to nifti
         nii = f'{mgz[:-4]}.nii'
-        if not op.isfile(nii):
-            os.system(f'mri_convert {mgz} {nii}')
+        build_cache.run(f'mri_convert {mgz} {nii}',
+                        outputs=[nii], inputs=[mgz])
 
         # extract brain
         nii_brain = f'{mgz[:-4]}_brain.nii.gz'
-        if not op.isfile(nii_brain):
-            os.system(f'mri_synthstrip -i {nii} -o {nii_brain}')# -g')
+        build_cache.run(f'mri_synthstrip -i {nii} -o {nii_brain}',# -g',
+                        outputs=[nii_brain], inputs=[nii])
 
 
@@ -0,0 +1,52 @@
+"""
+helpers for sizing parallel work to the machine's cores and memory
+"""
+
+import os
+import threading
+
+
+def _meminfo(field):
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith(f'{field}:'):
+                return int(line.split()[1]) / 1024 ** 2  # kB to GB
+    raise KeyError(field)
+
+
+def total_memory_gb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+
+
+def available_memory_gb():
+    return _meminfo('MemAvailable')
+
+
+def n_cores():
+    return len(os.sched_getaffinity(0))
+
+
+def measure_peak_memory(func, *args, interval=.5, **kwargs):
+
+    """
+    runs func and returns (its result, peak memory used in GB). Memory is
+    measured as the drop in system-wide available memory, so it includes any
+    external processes (e.g. MATLAB, FSL) that func starts.
+    """
+
+    baseline = available_memory_gb()
+    lowest = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            lowest[0] = min(lowest[0], available_memory_gb())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        done.set()
+        sampler.join()
+    return result, baseline - lowest[0]
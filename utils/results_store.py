@@ -0,0 +1,93 @@
+"""
+append-only columnar store for per-ROI results (tSNR, QC metrics)
+
+Each table is a Parquet dataset under STORE_DIR, hive-partitioned by
+subject/preproc/postproc/region, e.g.
+
+    derivatives/results/tSNR/subject=M001/preproc=NORDIC/postproc=.../region=V1/
+
+Every partition holds one file named by the fingerprint of the inputs its
+rows were computed from (e.g. the tSNR map and the ROI mask), so a result is
+only recomputed when has() finds no file for its current fingerprint, and
+writing it replaces the partition's previous file. query() reads only the
+partitions and columns asked for.
+"""
+
+import os
+import os.path as op
+import glob
+import json
+import hashlib
+from urllib.parse import quote
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from . import build_cache
+
+STORE_DIR = 'derivatives/results'  # relative to the dataset root
+KEYS = ('subject', 'preproc', 'postproc', 'region')
+
+
+def fingerprint(*inputs, params=None):
+
+    """ fingerprint of the contents of the input files and any parameters """
+
+    sha = hashlib.sha1()
+    for path in inputs:
+        sha.update(build_cache.content_hash(path).encode())
+    sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+def _partition_dir(table, partition):
+    assert set(partition) == set(KEYS), f'partition must give {KEYS}'
+    return op.join(STORE_DIR, table, *[
+        f'{key}={quote(str(partition[key]), safe="")}' for key in KEYS])
+
+
+def has(table, partition, fp):
+
+    """ True if the partition holds results computed from fingerprint fp """
+
+    return op.isfile(f'{_partition_dir(table, partition)}/{fp}.parquet')
+
+
+def write(table, partition, fp, df):
+
+    """
+    stores the rows of df (without the partition columns) as the results of
+    the partition for fingerprint fp, replacing any earlier results
+    """
+
+    out_dir = _partition_dir(table, partition)
+    os.makedirs(out_dir, exist_ok=True)
+    tmp = f'{out_dir}/.{fp}.{os.getpid()}.tmp'
+    pq.write_table(pa.Table.from_pandas(df.reset_index(drop=True),
+                                        preserve_index=False), tmp)
+    os.replace(tmp, f'{out_dir}/{fp}.parquet')
+    for path in glob.glob(f'{out_dir}/*.parquet'):
+        if op.basename(path) != f'{fp}.parquet':
+            os.remove(path)
+
+
+def query(table, columns=None, **conditions):
+
+    """
+    returns the stored rows as a DataFrame, reading only the given columns
+    (default: all) of the partitions matching the conditions, e.g.
+    query('tSNR', ['preproc', 'mean'], subject='M001', region=['V1', 'V2'])
+    """
+
+    root = op.join(STORE_DIR, table)
+    if not glob.glob(f'{root}/**/*.parquet', recursive=True):
+        return pd.DataFrame(columns=columns)
+    dataset = ds.dataset(root, format='parquet', partitioning=ds.partitioning(
+        pa.schema([(key, pa.string()) for key in KEYS]), flavor='hive'))
+    condition = None
+    for key, values in conditions.items():
+        values = [values] if isinstance(values, str) or \
+            not hasattr(values, '__iter__') else values
+        expr = ds.field(key).isin([str(value) for value in values])
+        condition = expr if condition is None else condition & expr
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
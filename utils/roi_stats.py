@@ -0,0 +1,129 @@
+"""
+statistics of a map within many ROIs at once
+
+Replaces per-ROI fslstats calls (-k mask -m / -s / -p / -x / -H). The ROI
+masks (or a label image) are loaded once into flat (ROI, voxel) index
+pairs, so overlapping masks such as cortical depths are supported. Each map
+is then loaded once and every statistic for every ROI comes from a few
+np.bincount reductions and a single sort of the masked values.
+"""
+
+import numpy as np
+import pandas as pd
+from .nifti_io import load_data
+
+
+def load_map(image):
+
+    """ 3D float array from a path or array (single-volume 4D is squeezed) """
+
+    if isinstance(image, str):
+        image = load_data(image, np.float32)
+    image = np.asarray(image)
+    if image.ndim == 4 and image.shape[3] == 1:
+        image = image[..., 0]
+    return image
+
+
+def load_rois(masks=None, labels=None, names=None):
+
+    """
+    masks: {name: mask path or array}; voxels != 0 are in the ROI.
+    labels: label image (path or array) whose values > 0 are ROIs, named by
+        names {value: name} (default: all values, named by value).
+    Returns the ROI index used by roi_stats.
+    """
+
+    roi_names, ids, voxels, shape = [], [], [], None
+    for name, mask in (masks or {}).items():
+        mask = load_map(mask)
+        shape = shape or mask.shape
+        assert mask.shape == shape, f'{name}: mask shape {mask.shape}'
+        idx = np.flatnonzero(mask)
+        ids.append(np.full(len(idx), len(roi_names)))
+        voxels.append(idx)
+        roi_names.append(name)
+    if labels is not None:
+        labels = load_map(labels).astype(int)
+        shape = shape or labels.shape
+        assert labels.shape == shape, f'label image shape {labels.shape}'
+        names = names or {value: value for value in np.unique(labels)
+                          if value > 0}
+        lookup = np.full(labels.max() + 1, -1)
+        for value, name in names.items():
+            lookup[value] = len(roi_names)
+            roi_names.append(name)
+        idx = np.flatnonzero(labels > 0)
+        roi = lookup[labels.ravel()[idx]]
+        ids.append(roi[roi >= 0])
+        voxels.append(idx[roi >= 0])
+    assert roi_names, 'no ROIs given'
+    return dict(names=roi_names, shape=shape, ids=np.concatenate(ids),
+                voxels=np.concatenate(voxels))
+
+
+def roi_stats(image, rois, percentiles=(), bins=None, hist_range=None):
+
+    """
+    image: map (path or 3D array); rois: from load_rois.
+    Returns a DataFrame indexed by ROI name with columns n_voxels, mean, std
+    (n - 1), min, max, peak_x/y/z (voxel coordinates of the maximum, as
+    fslstats -x) and p{q} for each percentile q (linear interpolation).
+    If bins is given, column hist holds the voxel counts in bins equal bins
+    over hist_range (default: range of all ROI voxels), as fslstats -H, and
+    column bin_edges their edges. Non-finite voxels are ignored.
+    """
+
+    image = load_map(image)
+    assert image.shape == rois['shape'], f'map shape {image.shape}'
+    n_rois = len(rois['names'])
+    values = image.ravel()[rois['voxels']].astype(np.float64)
+    finite = np.isfinite(values)
+    ids, voxels, values = rois['ids'][finite], rois['voxels'][finite], \
+        values[finite]
+
+    counts = np.bincount(ids, minlength=n_rois)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(ids, values, n_rois) / counts
+        ss = np.bincount(ids, np.square(values - mean[ids]), n_rois)
+        std = np.where(counts > 1, np.sqrt(ss / (counts - 1)), 0.)
+    std[counts == 0] = np.nan
+
+    # values sorted within each ROI give min, max, peaks and percentiles. A
+    # trailing sentinel keeps the indices of empty ROIs valid.
+    order = np.lexsort((values, ids))
+    ids, values = ids[order], values[order]
+    sorted_values = np.append(values, np.nan)
+    sorted_voxels = np.append(voxels[order], 0)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    last = starts + np.maximum(counts - 1, 0)
+    has = counts > 0
+    df = pd.DataFrame({'n_voxels': counts, 'mean': mean, 'std': std},
+                      index=pd.Index(rois['names'], name='roi'))
+    df['min'] = np.where(has, sorted_values[starts], np.nan)
+    df['max'] = np.where(has, sorted_values[last], np.nan)
+    peaks = np.unravel_index(sorted_voxels[last], image.shape)
+    for axis, peak in zip('xyz', peaks):
+        df[f'peak_{axis}'] = np.where(has, peak, -1)
+    for q in percentiles:
+        position = starts + q / 100 * (last - starts)
+        lo = np.floor(position).astype(int)
+        hi = np.minimum(lo + 1, last)
+        value = sorted_values[lo] + (position - lo) * (
+            sorted_values[hi] - sorted_values[lo])
+        df[f'p{q:g}'] = np.where(has, value, np.nan)
+
+    if bins:
+        if hist_range is None:
+            hist_range = (values.min(), values.max()) if len(values) \
+                else (0., 1.)
+        lo, hi = hist_range
+        edges = np.linspace(lo, hi, bins + 1)
+        inside = (values >= lo) & (values <= hi)
+        b = np.clip(((values[inside] - lo) / ((hi - lo) or 1) *
+                     bins).astype(int), 0, bins - 1)
+        hist = np.bincount(ids[inside] * bins + b,
+                           minlength=n_rois * bins).reshape(n_rois, bins)
+        df['hist'] = list(hist)
+        df['bin_edges'] = [edges] * n_rois
+    return df
@@ -1,18 +1,46 @@
 import os
 import os.path as op
 import datetime
-import matlab.engine
 import sys
-import glob
 import shutil
+from . import bids_index, build_cache
+from .complex_conversion import real_imag_to_mag_phase
+from .compression import HOT, nifti_ext
+from .nifti_io import n_volumes, sidecar_tr, trim_volumes
 
-def run_NORDIC(subjects, noise_vol=True):
+
+def apply_NORDIC(mag, phase, outpath, arg, backend='matlab', n_procs=None):
+
+    """
+    runs NIFTI_NORDIC, either from the NORDIC_Raw MATLAB package (via the
+    MATLAB engine pool) or the NumPy implementation (no MATLAB licence needed)
+    """
+
+    if backend == 'numpy':
+        from .nordic_numpy import NIFTI_NORDIC
+        NIFTI_NORDIC(mag, phase, outpath, arg, n_procs)
+    elif backend == 'matlab':
+        from .matlab_pool import get_engine_pool
+        get_engine_pool().call(
+            'NIFTI_NORDIC', mag, phase, outpath, arg, nargout=0)
+    else:
+        raise ValueError(f'unknown NORDIC backend: {backend}')
+
+
+def nordic_params(arg, backend):
+
+    """ build cache parameters (MATLAB outputs predate the backend option) """
+
+    return arg if backend == 'matlab' else dict(arg, backend=backend)
+
+
+def run_NORDIC(subjects, noise_vol=True, backend='matlab'):
 
     for subject in subjects:
         for s, session in enumerate(subjects[subject]):
             funcdir = f"sub-{subject}/ses-{s + 1}/func"
-            funcscans = sorted(glob.glob(f"sub-{subject}/ses-{s + 1}/func/"
-                                        f"*part-mag_bold.nii"))
+            funcscans = sorted(bids_index.glob(
+                f"sub-{subject}/ses-{s + 1}/func/*part-mag_bold.nii"))
 
             for funcscan in funcscans:
 
@@ -24,56 +52,56 @@ def run_NORDIC(subjects, noise_vol=True):
                 phase = mag.replace('part-mag', 'part-phase')
                 real = mag.replace('part-mag', 'part-real')
                 imag = mag.replace('part-mag', 'part-imag')
-                complex = mag.replace('part-mag', 'part-complex')
 
-                # calculate phase
-                if not len(glob.glob(f'{phase}*')):
-                    # complex
-                    print('calculating complex from real and imaginary...')
-                    os.system(f'fslcomplex -complex {real} {imag} {complex}')
-
-                    # phase
-                    print('calculating phase from complex...')
-                    os.system(f'fslcomplex -realphase {complex} {phase}')
-                    os.system(f'fslcpgeom {imag} {phase}')  # get the original geometry header info back
-
-                    # delete complex
-                    [os.remove(complex) for complex in glob.glob(f'{complex}*')]
+                # calculate phase (unless measured phase is available), as a
+                # hot intermediate read by NORDIC
+                phase_calc = f'{phase}{nifti_ext(HOT)}'
+                real_imag = [f'{real}.nii', f'{imag}.nii']
+                if not len(bids_index.glob(f'{phase}*')) or (
+                        op.isfile(phase_calc) and build_cache.needs_update(
+                            [phase_calc], inputs=real_imag)):
+                    # phase, with the geometry of the imaginary image
+                    print('calculating phase from real and imaginary...')
+                    real_imag_to_mag_phase(real, imag, phase_out=phase_calc)
+                    build_cache.record([phase_calc], inputs=real_imag)
 
                 # run NORDIC preprocessing
                 outdir = f"derivatives/NORDIC/{funcdir}"
                 os.makedirs(outdir, exist_ok=True)
                 outpath = f'{outdir}/{os.path.basename(mag)}'
-                if not len(glob.glob(f'{outpath}*')):
+                arg = {'phase_filter_width': 10.}  # float. Default = 10.
+                if noise_vol:
+                    arg['noise_volume_last'] = 1  # 1 = last, 0 = no noise
+                    arg['use_magn_for_gfactor'] = 1  # remove key to disable
+                else:
+                    arg['noise_volume_last'] = 0
+                inputs = [funcscan] + bids_index.glob(f'{phase}.nii*')
+                params = nordic_params(arg, backend)
+                if build_cache.needs_update([f'{outpath}.nii.gz'],
+                                            inputs=inputs, params=params):
                     print('running NORDIC preprocessing...')
-                    arg = {'phase_filter_width': 10.}  # float. Default = 10.
-                    if noise_vol:
-                        arg['noise_volume_last'] = 1  # 1 = last, 0 = no noise
-                        arg['use_magn_for_gfactor'] = 1  # remove key to disable
-                    else:
-                        arg['noise_volume_last'] = 0
-                    eng = matlab.engine.start_matlab()
-                    eng.addpath('/home/tonglab/david/repos/NORDIC_Raw')
-                    eng.NIFTI_NORDIC(mag, phase, outpath, arg, nargout=0)
-                    eng.quit()
-
-                    # trim mag and NORDIC data and change TR in header
-                    num_func_vols = int(os.popen(f'fslnvols {mag}').read()[0:-1])
+                    apply_NORDIC(mag, phase, outpath, arg, backend)
+
+                    # trim noise volume and set TR in header, compressing
+                    # in the same pass
                     print(f'trimming noise volume from preprocessed timeseries...')
-                    os.system(f'fslroi {outpath} {outpath} 0 {num_func_vols - 1}')
+                    trim_volumes(f'{outpath}.nii', n_volumes(mag) - 1,
+                                 tr=sidecar_tr(mag),
+                                 out_path=f'{outpath}.nii.gz')
                     os.remove(f'{outpath}.nii')
-                    os.system(f'fslmerge -tr {outpath} {outpath} 4.217')
+                    build_cache.record([f'{outpath}.nii.gz'],
+                                       inputs=inputs, params=params)
 
             # copy json files
-            json_paths = glob.glob(f"sub-{subject}/ses-"
-                              f"{s + 1}/func/*part-mag_bold.json")
+            json_paths = bids_index.glob(f"sub-{subject}/ses-"
+                                         f"{s + 1}/func/*part-mag_bold.json")
             for json_path in json_paths:
                 if not op.isfile(f"derivatives/NORDIC/{json_path}"):
                     shutil.copy(json_path, f"derivatives/NORDIC/{json_path}")
 
             # make links to anat and fmap data
-            otherdirs = glob.glob(f"sub-{subject}/ses-{s + 1}/anat")
-            otherdirs += glob.glob(f"sub-{subject}/ses-{s + 1}/fmap")
+            otherdirs = bids_index.glob(f"sub-{subject}/ses-{s + 1}/anat")
+            otherdirs += bids_index.glob(f"sub-{subject}/ses-{s + 1}/fmap")
             for otherdir in otherdirs:
                 outdir = f"derivatives/NORDIC/{otherdir}"
                 if not op.exists(outdir):
@@ -0,0 +1,120 @@
+"""
+temporal high-pass filtering and detrending of 4D images
+
+bptf_matrix reproduces the high-pass part of fslmaths -bptf (FSL 5.0.7 and
+later): at each time point a line is fitted to the timeseries by
+Gaussian-weighted least squares (sigma in volumes, window +/- 3 sigma), its
+value there is subtracted and the value of the fit at the first time point
+(c0) is added, so the output is x - fit + c0. The fitted values are fixed
+linear combinations of the timeseries, so the filter is a single T x T matrix
+applied to all voxels at once. detrend_matrix gives the residuals of a
+projection onto Legendre polynomials up to a given order (plain polynomial
+detrending by least squares). The filtered timeseries then has the voxel's
+temporal mean added, as fslmaths -bptf ... -add Tmean does; the filters are
+applied slab by slab with matrix products in a thread pool.
+"""
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .nifti_io import iter_slabs, n_volumes, output_header, SlabWriter
+from .resources import n_cores
+
+
+def highpass_matrix(n_vols, hp_sigma):
+
+    """
+    T x T matrix giving, for each time point, the Gaussian-weighted running
+    line fit of fslmaths -bptf hp_sigma -1 (hp_sigma in volumes)
+    """
+
+    half_width = int(hp_sigma * 3)
+    t = np.arange(n_vols)
+    dt = t[None, :] - t[:, None]  # dt[t, tt] = tt - t
+    w = np.exp(-.5 * dt ** 2 / hp_sigma ** 2) * (np.abs(dt) <= half_width)
+    n, a, c = w.sum(1), (w * dt).sum(1), (w * dt ** 2).sum(1)
+    denom = c * n - a ** 2
+    fit = np.zeros((n_vols, n_vols))
+    ok = denom != 0
+    fit[ok] = w[ok] * (c[ok, None] - a[ok, None] * dt[ok]) / denom[ok, None]
+    return fit
+
+
+def bptf_matrix(n_vols, hp_sigma):
+
+    """
+    T x T matrix of fslmaths -bptf hp_sigma -1, i.e. x - fit + c0, where c0 is
+    the fit at the first time point. As in fslmaths, time points whose fit is
+    undefined are left unchanged, and c0 is 0 if the first one's is.
+    """
+
+    fit = highpass_matrix(n_vols, hp_sigma)
+    ok = fit.any(1)
+    return np.eye(n_vols) - fit + np.outer(ok, fit[0])
+
+
+def detrend_matrix(n_vols, order):
+
+    """
+    T x T matrix giving the residuals of a projection onto Legendre
+    polynomials of degree 0 to order
+    """
+
+    basis = np.polynomial.legendre.legvander(
+        np.linspace(-1, 1, n_vols), order)
+    return np.eye(n_vols) - basis @ np.linalg.pinv(basis)
+
+
+def filter_matrix(n_vols, hp_sigma=None, order=None):
+
+    """ matrix of the high-pass filter or, if order is given, detrend """
+
+    assert (hp_sigma is None) != (order is None), \
+        'give one of hp_sigma and order'
+    return bptf_matrix(n_vols, hp_sigma) if order is None else \
+        detrend_matrix(n_vols, order)
+
+
+def _filter_slab(slab, filt):
+    series = slab.reshape(-1, slab.shape[3]).astype(np.float32)
+    filtered = series @ filt.T + series.mean(1, keepdims=True)
+    return filtered.reshape(slab.shape)
+
+
+def iter_filtered_slabs(timeseries, hp_sigma=None, order=None, slab_size=4,
+                        n_procs=None):
+
+    """
+    yields (slice, filtered float32 slab) in order, filtering up to n_procs
+    slabs at a time
+    """
+
+    n_procs = n_procs or n_cores()
+    filt = None
+    with ThreadPoolExecutor(n_procs) as pool:
+        pending = []
+        for z, slab in iter_slabs(timeseries, slab_size):
+            if filt is None:
+                filt = filter_matrix(slab.shape[3], hp_sigma, order).astype(
+                    np.float32)
+            pending.append((z, pool.submit(_filter_slab, slab, filt)))
+            if len(pending) >= n_procs:
+                z, future = pending.pop(0)
+                yield z, future.result()
+        for z, future in pending:
+            yield z, future.result()
+
+
+def temporal_filter(timeseries, out_path, hp_sigma=None, order=None,
+                    slab_size=4, n_procs=None):
+
+    """
+    writes the filtered timeseries (float32), e.g. hp_sigma=15 for
+    fslmaths {timeseries} -bptf 15 -1 -add {Tmean} {out_path}, or order=1 for
+    linear detrending
+    """
+
+    header = output_header(timeseries, n_volumes(timeseries))
+    with SlabWriter(out_path, header) as writer:
+        for z, slab in iter_filtered_slabs(timeseries, hp_sigma, order,
+                                           slab_size, n_procs):
+            writer.write(z, slab)
@@ -3,20 +3,28 @@
 import os
 import os.path as op
 import datetime
-import matlab.engine
 import sys
-import glob
 import shutil
 from itertools import product as itp
-import gzip
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from . import bids_index, build_cache
+from .complex_conversion import real_imag_to_mag_phase
+from .nifti_io import n_volumes, sidecar_tr, trim_volumes
+from .run_NORDIC import apply_NORDIC, nordic_params
+from .staging import stage_file
+from .compression import HOT, nifti_ext
+from .resources import n_cores, available_memory_gb, measure_peak_memory
 
 
-def test_NORDIC():
+def test_NORDIC(backend='matlab', n_procs=None):
 
     """
     This function tests the TSNR gains for all possible combinations of
     magnitude/phase components, i.e., whether we take them directly from the
     scanner or calculate them from other components.
+    backend: 'matlab' (NORDIC_Raw package) or 'numpy' (see nordic_numpy.py)
+    n_procs: cores shared by the configurations (default: all)
     """
 
     subject, session = 'M001', '1'
@@ -24,7 +32,11 @@ def test_NORDIC():
     anat_dir = f'{session_dir}/anat'
     func_dir = f'{session_dir}/func'
     fmap_dir = f'{session_dir}/fmap'
-    funcscans = glob.glob(f'{func_dir}/*restingState*run-1*part-mag_bold.nii')
+    funcscans = bids_index.glob(f'{func_dir}/*restingState*run-1*part-mag_bold.nii')
+    if not funcscans:  # renamed by a previous run (see below)
+        funcscans = [path.replace('acq-meas', 'run-1') for path in
+                     bids_index.glob(f'{func_dir}/*restingState*acq-meas*'
+                                     f'part-mag_bold.nii')]
     assert len(funcscans) == 1
     funcscan = funcscans[0]
 
@@ -45,128 +57,173 @@ def test_NORDIC():
 
 
     # Calculated versions of the magnitude and phase components
-    funcscan = funcscan.split('.nii')[0]  # remove extension, let FSL handle it
+    funcscan = funcscan.split('.nii')[0]  # remove extension
     mag_calc = funcscan.replace('run-1', f'acq-calc')
     phase_calc = mag_calc.replace('part-mag', 'part-phase')
-    if not op.isfile(mag_calc+'.nii.gz') or not op.isfile(phase_calc+'.nii.gz'):
-
-        print('calculating complex from real and imaginary...')
-        real = funcscan.replace('part-mag', 'part-real')
-        imag = funcscan.replace('part-mag', 'part-imag')
-        complex = funcscan.replace('part-mag', 'part-complex')
-        os.system(f'fslcomplex -complex {real} {imag} {complex}')
-
-        # magnitude
-        if not op.isfile(mag_calc):
-            print('calculating magnitude from complex...')
-            os.system(f'fslcomplex -realabs {complex} {mag_calc}')
-            # retain the original geometry header info
-            os.system(f'fslcpgeom {imag} {mag_calc}')
-
-        # phase
-        if not op.isfile(phase_calc):
-            print('calculating phase from complex...')
-            os.system(f'fslcomplex -realphase {complex} {phase_calc}')
-            # retain the original geometry header info
-            os.system(f'fslcpgeom {imag} {phase_calc}')
-
-        # delete complex
-        [os.remove(complex) for complex in glob.glob(f'{complex}*')]
-
-    # run NORDIC preprocessing
-    for mag_type, phase_type, noise_type in itp(
-            ['meas', 'calc'], ['meas', 'calc'], ['vol', 'est']):
-
-        nordic = f'NORDIC_mag-{mag_type}_phase-{phase_type}_noise-{noise_type}'
-        out_dir = f'derivatives/{nordic}/{func_dir}'
-        mag_cor = (f'{out_dir}/sub-{subject}_ses-{session}_task-restingState_'
-                   f'part-mag_bold')
-        if not op.isfile(mag_cor + '.nii'):
-
-            print('running NORDIC preprocessing...')
-            os.makedirs(out_dir, exist_ok=True)
-
-            # copy mag image to output directory, remove noise volume if
-            # necessary
-            mag_srcs = glob.glob(
-                f'{func_dir}/*acq-{mag_type}*part-mag_bold.nii*')
-            assert len(mag_srcs) == 1, 'multiple/no candidates for mag image'
-            mag_src = mag_srcs[0]
-            mag_dst = f'{out_dir}/{os.path.basename(mag_src)}'
-            if not op.isfile(mag_dst):
-                shutil.copy(mag_src, mag_dst)
-                if noise_type == 'est':
-                    os.system(f'fslroi {mag_dst} {mag_dst} 0 -1')
-
-            # copy phase image to output directory, remove noise volume if
-            # necessary
-            phase_srcs = glob.glob(
-                f'{func_dir}/*acq-{phase_type}*part-phase_bold.nii*')
-            assert len(phase_srcs) == 1, 'multiple/no candidates for phase image'
-            phase_src = phase_srcs[0]
-            phase_dst = f'{out_dir}/{os.path.basename(phase_src)}'
-            if not op.isfile(phase_dst):
-                shutil.copy(phase_src, phase_dst)
-                if noise_type == 'est':
-                    os.system(f'fslroi {phase_dst} {phase_dst} 0 30')
-
-            arg = {'phase_filter_width': 10.}  # float. Default = 10.
-            if noise_type == 'vol':
-                arg['noise_volume_last'] = 1  # 1 = last, 0 = no noise
-                arg['use_magn_for_gfactor'] = 1  # remove key to disable
+    real = funcscan.replace('part-mag', 'part-real')
+    imag = funcscan.replace('part-mag', 'part-imag')
+    # hot intermediates, read by every configuration that uses them
+    calc_paths = [f'{mag_calc}{nifti_ext(HOT)}',
+                  f'{phase_calc}{nifti_ext(HOT)}']
+    real_imag = [f'{real}.nii', f'{imag}.nii']
+    if build_cache.needs_update(calc_paths, inputs=real_imag):
+
+        assert all(op.isfile(path) for path in real_imag), \
+            f'{calc_paths} cannot be remade, {real_imag} have been deleted'
+        print('calculating magnitude and phase from real and imaginary...')
+        real_imag_to_mag_phase(real, imag, *calc_paths)
+        build_cache.record(calc_paths, inputs=real_imag)
+
+    # measured and calculated magnitude images
+    mag_paths = {'meas': f'{funcscan.replace("run-1", "acq-meas")}.nii',
+                 'calc': calc_paths[0]}
+
+    # run NORDIC preprocessing for each configuration. The configurations
+    # only share their (read-only) input images, so they run in parallel,
+    # with as many workers as fit in the free memory. The memory needed by
+    # one job is measured on the first configuration that runs NORDIC.
+    paths = dict(subject=subject, session=session, session_dir=session_dir,
+                 anat_dir=anat_dir, func_dir=func_dir, fmap_dir=fmap_dir,
+                 funcscan=funcscan, mag_paths=mag_paths)
+    configs = list(itp(['meas', 'calc'], ['meas', 'calc'], ['vol', 'est']))
+    n_procs = n_procs or n_cores()
+    sources = bids_index.glob(f'{func_dir}/*acq-*part-*_bold.nii*')
+    modes = {path: os.stat(path).st_mode for path in sources}
+    for path in sources:
+        os.chmod(path, 0o444)
+    try:
+        peak_gb = None
+        while configs and peak_gb is None:
+            ran_nordic, peak = measure_peak_memory(
+                _run_config, *configs.pop(0), paths, backend, n_procs)
+            if ran_nordic:
+                peak_gb = max(peak, .5)
+        if configs:
+            n_workers = max(1, min(len(configs), n_procs,
+                                   int(available_memory_gb() // peak_gb)))
+            print(f'running {len(configs)} NORDIC configurations, '
+                  f'{n_workers} at a time ({peak_gb:.1f} GB each)')
+            if backend == 'matlab':
+                # NORDIC runs in MATLAB engines owned by this process (see
+                # matlab_pool), so the configurations run in threads sharing
+                # its engine pool, one engine per worker
+                from .matlab_pool import get_engine_pool
+                get_engine_pool(n_workers)
+                executor = ThreadPoolExecutor(n_workers)
             else:
-                arg['noise_volume_last'] = 0
-            eng = matlab.engine.start_matlab()
-            eng.addpath('/home/tonglab/david/repos/NORDIC_Raw')
-            eng.NIFTI_NORDIC(mag_dst, phase_dst, mag_cor, arg, nargout=0)
-            eng.quit()
-
-        # trim mag and NORDIC data and change TR in header
-        num_func_vols = int(os.popen(f'fslnvols {mag_cor}').read()[0:-1])
-        if num_func_vols == 31:
-            print(f'trimming noise volume from preprocessed timeseries...')
-            os.system(f'fslroi {mag_cor} {mag_cor} 0 30')
-
-            # delete original nifti
-            os.remove(mag_cor + '.nii')
-
-            # change TR in header (creates gzipped nifti)
-            os.system(f'fslmerge -tr {mag_cor} {mag_cor} 4.217')
-
-            # unzip the new nifti
-            with gzip.open(mag_cor + '.nii.gz', 'rb') as f_in:
-                with open(mag_cor + '.nii', 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-
-            # delete the gzipped nifti and original mag + phase images
-            os.remove(mag_cor + '.nii.gz')
-            [os.remove(i) for i in glob.glob(op.join(out_dir, '*_acq-*'))]
-
-        # copy json files
-        json_srcs = glob.glob(f'{session_dir}/func/'
-                              f'*restingState*part-mag_bold.json')
-        for json_src in json_srcs:
-            json_dst = f'derivatives/{nordic}/{json_src.replace("_run-1", "")}'
-            if not op.isfile(json_dst):
-                shutil.copy(json_src, json_dst)
-
-        # make links to anat and fmap data
-        anat_dst = f'{op.dirname(out_dir)}/anat'
-        if not op.isdir(anat_dst):
-            os.system(f'ln -s {op.abspath(anat_dir)} {anat_dst}')
-        fmap_dst = f'{op.dirname(out_dir)}/fmap'
-        if not op.isdir(fmap_dst):
-            os.system(f'ln -s {op.abspath(fmap_dir)} {fmap_dst}')
-
-        # copy other files to statisfy bids requirements
-        for src in ['dataset_description.json', 'participants.json', 'README']:
-            if not op.isfile(f'derivatives/{nordic}/{src}'):
-                shutil.copy(src, f'derivatives/{nordic}/{src}')
-
-        # delete imaginary, real, and phase images
-        for cpnt in ['real', 'imag', 'phase']:
-            for path in glob.glob(f'{func_dir}/*part-{cpnt}*'):
-                os.remove(path)
+                executor = ProcessPoolExecutor(
+                    n_workers, mp_context=mp.get_context('spawn'))
+            with executor as pool:
+                futures = [pool.submit(_run_config, *config, paths, backend,
+                                       max(1, n_procs // n_workers))
+                           for config in configs]
+                [future.result() for future in futures]
+    finally:
+        for path, mode in modes.items():
+            if op.exists(path):
+                os.chmod(path, mode)
+
+    # delete imaginary and real images. The measured and calculated phase
+    # images are kept, as they are inputs to NORDIC on later runs.
+    for cpnt in ['real', 'imag']:
+        for path in bids_index.glob(f'{func_dir}/*part-{cpnt}*'):
+            os.remove(path)
+
+
+def _run_config(mag_type, phase_type, noise_type, paths, backend, n_procs):
+
+    """
+    runs one NORDIC configuration into its own derivatives dataset, returning
+    whether NORDIC itself had to be run
+    """
+
+    subject, session = paths['subject'], paths['session']
+    session_dir, anat_dir = paths['session_dir'], paths['anat_dir']
+    func_dir, fmap_dir = paths['func_dir'], paths['fmap_dir']
+    mag_paths = paths['mag_paths']
+    ran_nordic = False
+
+    nordic = f'NORDIC_mag-{mag_type}_phase-{phase_type}_noise-{noise_type}'
+    out_dir = f'derivatives/{nordic}/{func_dir}'
+    mag_cor = (f'{out_dir}/sub-{subject}_ses-{session}_task-restingState_'
+               f'part-mag_bold')
+    arg = {'phase_filter_width': 10.}  # float. Default = 10.
+    if noise_type == 'vol':
+        arg['noise_volume_last'] = 1  # 1 = last, 0 = no noise
+        arg['use_magn_for_gfactor'] = 1  # remove key to disable
+    else:
+        arg['noise_volume_last'] = 0
+    inputs = [mag_paths[mag_type],
+              mag_paths[phase_type].replace('part-mag', 'part-phase')]
+    params = nordic_params(arg, backend)
+    if build_cache.needs_update([mag_cor + '.nii'], inputs=inputs,
+                                params=params):
+
+        print('running NORDIC preprocessing...')
+        os.makedirs(out_dir, exist_ok=True)
+
+        # stage mag image in output directory (linked, as NORDIC only reads
+        # it), remove noise volume if necessary
+        mag_srcs = bids_index.glob(
+            f'{func_dir}/*acq-{mag_type}*part-mag_bold.nii*')
+        assert len(mag_srcs) == 1, 'multiple/no candidates for mag image'
+        mag_src = mag_srcs[0]
+        mag_dst = f'{out_dir}/{os.path.basename(mag_src)}'
+        if not op.isfile(mag_dst):
+            if noise_type == 'est':
+                trim_volumes(mag_src, n_volumes(mag_src) - 1, out_path=mag_dst)
+            else:
+                stage_file(mag_src, mag_dst)
+
+        # stage phase image in output directory, remove noise volume if
+        # necessary
+        phase_srcs = bids_index.glob(
+            f'{func_dir}/*acq-{phase_type}*part-phase_bold.nii*')
+        assert len(phase_srcs) == 1, 'multiple/no candidates for phase image'
+        phase_src = phase_srcs[0]
+        phase_dst = f'{out_dir}/{os.path.basename(phase_src)}'
+        if not op.isfile(phase_dst):
+            if noise_type == 'est':
+                trim_volumes(phase_src, n_volumes(phase_src) - 1,
+                             out_path=phase_dst)
+            else:
+                stage_file(phase_src, phase_dst)
+
+        apply_NORDIC(mag_dst, phase_dst, mag_cor, arg, backend, n_procs)
+        build_cache.record([mag_cor + '.nii'], inputs=inputs,
+                           params=params)
+        ran_nordic = True
+
+    # trim NORDIC data in place and change TR in header
+    if n_volumes(mag_cor) == 31:
+        print(f'trimming noise volume from preprocessed timeseries...')
+        trim_volumes(f'{mag_cor}.nii', 30, tr=sidecar_tr(paths['funcscan']))
+
+        # delete original mag + phase images
+        [os.remove(i) for i in bids_index.glob(op.join(out_dir, '*_acq-*'))]
+
+    # copy json files
+    json_srcs = bids_index.glob(f'{session_dir}/func/'
+                                f'*restingState*part-mag_bold.json')
+    for json_src in json_srcs:
+        json_dst = f'derivatives/{nordic}/{json_src.replace("_run-1", "")}'
+        if not op.isfile(json_dst):
+            shutil.copy(json_src, json_dst)
+
+    # make links to anat and fmap data
+    anat_dst = f'{op.dirname(out_dir)}/anat'
+    if not op.isdir(anat_dst):
+        os.system(f'ln -s {op.abspath(anat_dir)} {anat_dst}')
+    fmap_dst = f'{op.dirname(out_dir)}/fmap'
+    if not op.isdir(fmap_dst):
+        os.system(f'ln -s {op.abspath(fmap_dir)} {fmap_dst}')
+
+    # copy other files to statisfy bids requirements
+    for src in ['dataset_description.json', 'participants.json', 'README']:
+        if not op.isfile(f'derivatives/{nordic}/{src}'):
+            shutil.copy(src, f'derivatives/{nordic}/{src}')
+
+    return ran_nordic
 
 
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+"""
+timing and resource trace of a pipeline run
+
+Every external command (run) and Python stage (span) is recorded with its
+start and end times, exit code, CPU time and peak memory. A command is
+measured with os.wait4, which returns the resource usage of the command and
+of the processes it waited for. Containers are run by the docker daemon
+rather than by the command, so for docker only the wall time is meaningful.
+A command's peak memory is only known if it exceeds this process's own peak,
+as Linux starts a child's peak from its parent's. A span records the CPU
+time of its own thread. A span has no peak memory of its own, as stages share
+the process: it records the process's peak so far (process_peak_rss_mb),
+which includes any stages that ran before or alongside it.
+
+Recording is on once start_run() has been called, e.g. by pipeline.py.
+Each event is appended as one JSON line to events.jsonl in the run's
+directory. That directory is passed on through the environment, so events
+from worker processes are kept too. finish_run() turns the events into
+trace.json, in Chrome's trace event format (open it in chrome://tracing or
+https://ui.perfetto.dev), and summary.txt, the time spent in each command and
+stage.
+"""
+
+import os
+import os.path as op
+import json
+import time
+import datetime
+import resource
+import subprocess
+import threading
+from contextlib import contextmanager
+import pandas as pd
+
+TRACE_DIR = 'derivatives/logs/trace'  # relative to the dataset root
+_ENV = 'PIPELINE_TRACE_DIR'
+
+
+def start_run():
+
+    """ starts recording into a new run directory, which is returned """
+
+    run_dir = op.abspath(
+        f'{TRACE_DIR}/{datetime.datetime.now():%Y%m%d_%H%M%S}')
+    os.makedirs(run_dir, exist_ok=True)
+    os.environ[_ENV] = run_dir
+    return run_dir
+
+
+def _record(name, cat, start, end, exit_code, cpu_s, peak_rss_mb, **args):
+    run_dir = os.environ.get(_ENV)
+    if not run_dir:
+        return
+    event = dict(name=name, cat=cat, start=start, end=end,
+                 exit_code=exit_code, cpu_s=cpu_s, peak_rss_mb=peak_rss_mb,
+                 pid=os.getpid(), tid=threading.get_native_id(), **args)
+    # a single O_APPEND write, so lines from concurrent writers never mix
+    fd = os.open(f'{run_dir}/events.jsonl',
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(event) + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+def command_name(cmd):
+
+    """ the program a shell command runs (the image, for docker) """
+
+    words = [word for word in cmd.split() if '=' not in word]
+    if not words:
+        return cmd
+    program = op.basename(words[0])
+    if program == 'docker':
+        images = [word for word in words[2:] if not word.startswith('-')]
+        return f'docker {images[0]}' if images else program
+    return program
+
+
+def run(cmd, name=None, **kwargs):
+
+    """
+    runs a shell command, as os.system does, and returns its exit code.
+    name: label in the trace (default: the program run).
+    kwargs: passed to subprocess.Popen, e.g. stdout.
+    """
+
+    start = time.time()
+    proc = subprocess.Popen(cmd, shell=True, **kwargs)
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    own_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = usage.ru_maxrss / 1024 if usage.ru_maxrss > own_peak \
+        else None  # not distinguishable from this process's peak
+    _record(name or command_name(cmd), 'command', start, time.time(),
+            proc.returncode, usage.ru_utime + usage.ru_stime, peak_rss_mb,
+            cmd=cmd)
+    return proc.returncode
+
+
+@contextmanager
+def span(name, cat='stage'):
+
+    """ records the code run in the with block, e.g. a pipeline stage """
+
+    start, cpu = time.time(), time.thread_time()
+    exit_code = 1
+    try:
+        yield
+        exit_code = 0
+    finally:
+        _record(name, cat, start, time.time(), exit_code,
+                time.thread_time() - cpu, None, process_peak_rss_mb=(
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                    1024))
+
+
+def _load_events(run_dir):
+    path = f'{run_dir}/events.jsonl'
+    if not op.isfile(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def chrome_trace(events):
+
+    """ events as a dict in Chrome's trace event format """
+
+    t0 = min([event['start'] for event in events], default=0)
+    fields = ['name', 'cat', 'start', 'end', 'pid', 'tid']
+    return {'displayTimeUnit': 'ms',
+            'traceEvents': [
+                {'name': event['name'],
+                 'cat': event['cat'],
+                 'ph': 'X',
+                 'ts': round((event['start'] - t0) * 1e6),
+                 'dur': round((event['end'] - event['start']) * 1e6),
+                 'pid': event['pid'],
+                 'tid': event['tid'],
+                 'args': {key: value for key, value in event.items()
+                          if key not in fields}}
+                for event in events]}
+
+
+def summary(events):
+
+    """ count, wall and CPU time, peak memory and failures per name """
+
+    df = pd.DataFrame(events, columns=['name', 'cat', 'start', 'end',
+                                       'exit_code', 'cpu_s', 'peak_rss_mb',
+                                       'process_peak_rss_mb'])
+    df['wall_s'] = df['end'] - df['start']
+    table = df.groupby(['cat', 'name']).agg(
+        count=('wall_s', 'size'),
+        wall_s=('wall_s', 'sum'),
+        max_wall_s=('wall_s', 'max'),
+        cpu_s=('cpu_s', 'sum'),
+        peak_rss_mb=('peak_rss_mb', 'max'),
+        process_peak_rss_mb=('process_peak_rss_mb', 'max'),
+        failed=('exit_code', lambda codes: int((codes != 0).sum())))
+    return table.sort_values('wall_s', ascending=False).round(1)
+
+
+def finish_run():
+
+    """
+    stops recording and writes trace.json and summary.txt into the run
+    directory. Returns the summary table.
+    """
+
+    run_dir = os.environ.pop(_ENV)
+    events = _load_events(run_dir)
+    with open(f'{run_dir}/trace.json', 'w') as f:
+        json.dump(chrome_trace(events), f)
+    table = summary(events)
+    with open(f'{run_dir}/summary.txt', 'w') as f:
+        f.write(table.to_string() + '\n')
+    return table
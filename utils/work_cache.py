@@ -0,0 +1,99 @@
+"""
+persistent work directories for nipype containers (mriqc, fmriprep)
+
+Each participant's run gets its own work directory, kept between runs and
+keyed by tool, container version, dataset and participant, so that a rerun
+after a crash or a change reuses the nodes nipype has already cached.
+release() deletes directories once their results are final (e.g. after a
+successful group-level run), and evict() deletes the least recently used
+ones while the cache is over its disk quota. reserve() holds directories
+while containers use them, and evict() never deletes a held directory.
+"""
+
+import os
+import os.path as op
+import glob
+import fcntl
+import shutil
+from contextlib import contextmanager, ExitStack
+
+WORK_ROOT = 'derivatives/work_cache'  # relative to the dataset root
+QUOTA_GB = 500
+_MARKER = '.last_used'  # touched on each use, for LRU eviction
+
+
+def work_path(tool, version, participant, dataset='raw'):
+    return op.abspath(f'{WORK_ROOT}/{tool}-{version}/{dataset}/'
+                      f'sub-{participant}')
+
+
+def work_dir(tool, version, participant, dataset='raw'):
+
+    """ work directory for a run, created if needed and marked as used """
+
+    path = work_path(tool, version, participant, dataset)
+    os.makedirs(path, exist_ok=True)
+    with open(f'{path}/{_MARKER}', 'w'):
+        pass
+    return path
+
+
+@contextmanager
+def reserve(paths):
+
+    """ protects work directories from eviction while in use """
+
+    with ExitStack() as stack:
+        for path in paths:
+            lock = stack.enter_context(open(f'{path}.lock', 'w'))
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        yield
+
+
+def release(paths):
+
+    """ deletes work directories that are no longer needed """
+
+    for path in paths:
+        if op.isdir(path):
+            print(f'removing work directory {path}')
+            shutil.rmtree(path)
+        if op.isfile(f'{path}.lock'):
+            os.remove(f'{path}.lock')
+
+
+def _size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.lstat(op.join(root, name)).st_blocks * 512
+    return size
+
+
+def evict(quota_gb=QUOTA_GB):
+
+    """
+    deletes the least recently used work directories that are not in use
+    until the cache fits in quota_gb, returning the deleted paths
+    """
+
+    paths = [op.dirname(marker) for marker in
+             glob.glob(f'{WORK_ROOT}/*/*/*/{_MARKER}')]
+    sizes = {path: _size(path) for path in paths}
+    total = sum(sizes.values())
+    evicted = []
+    for path in sorted(paths, key=lambda p: op.getmtime(f'{p}/{_MARKER}')):
+        if total <= quota_gb * 1024 ** 3:
+            break
+        with open(f'{path}.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # in use
+            print(f'evicting work directory {path} '
+                  f'({sizes[path] / 1024 ** 3:.1f} GB)')
+            shutil.rmtree(path)
+            os.remove(f'{path}.lock')
+        total -= sizes[path]
+        evicted.append(path)
+    return evicted